@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Debug logging overhead benchmark of the client transitions.
+
+Measures, with the ``dhcpcanon`` loggers at INFO level (the default) and at
+DEBUG level, the time of the work a transition does that logs: generating
+the DISCOVER and REQUEST packets, the retransmission and renewing timeouts
+and the lease information printed when BOUND.
+It also measures the debug arguments that are not computed anymore at INFO
+level (the packet summary and the timer date), which is what every
+transition paid before the debug calls were guarded.
+The log records are written to ``os.devnull``.
+
+Usage::
+
+    python3 benchmarks/debuglog.py [-n NUMBER] [-r RUNS]
+
+"""
+import argparse
+import logging
+import os
+import statistics
+import timeit
+
+from dhcpcanon.dhcpcap import DHCPCAP
+from dhcpcanon.dhcpcaplease import DHCPCAPLease
+from dhcpcanon.timers import (future_dt_str, gen_timeout_request_renew,
+                              gen_timeout_resend, nowutc)
+
+LOGGERS = ['dhcpcanon', 'dhcpcanon.timers']
+
+LEASE = DHCPCAPLease(address='192.168.1.23', server_id='192.168.1.1',
+                     next_server='192.168.1.1', router='192.168.1.1',
+                     subnet_mask='255.255.255.0',
+                     broadcast_address='192.168.1.255',
+                     domain='localdomain', name_server='192.168.1.1',
+                     subnet='192.168.1.0', lease_time='43200',
+                     renewal_time='21600', rebinding_time='37800',
+                     interface='eth0', subnet_mask_cidr='24',
+                     network='192.168.1.0/24')
+
+
+def setup_logging():
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s %(levelname)s %(name)s %(message)s'))
+    root = logging.getLogger()
+    root.handlers = [handler]
+
+
+def set_level(level):
+    for name in LOGGERS:
+        logging.getLogger(name).setLevel(level)
+
+
+def gen_cases():
+    client = DHCPCAP(iface='eth0', client_mac='00:01:02:03:04:05',
+                     lease=LEASE, xid=0x12345678)
+    discover = client.gen_discover()
+    return [
+        ('discover', client.gen_discover),
+        ('request', client.gen_request),
+        ('timeout resend', lambda: gen_timeout_resend(1)),
+        ('timeout renew', lambda: gen_timeout_request_renew(LEASE)),
+        ('info lease', LEASE.info_lease),
+        ('debug args', lambda: (discover.summary(),
+                                future_dt_str(nowutc(), 4))),
+    ]
+
+
+def measure(func, number, runs):
+    return [t / number * 1e6 for t in
+            timeit.repeat(func, number=number, repeat=runs)]
+
+
+def report(name, times):
+    print('%-30s median %9.2fus min %9.2fus max %9.2fus (%d runs)' %
+          (name, statistics.median(times), min(times), max(times),
+           len(times)))
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-n', '--number', type=int, default=1000,
+                        help='calls per run')
+    parser.add_argument('-r', '--runs', type=int, default=5)
+    args = parser.parse_args()
+    setup_logging()
+    cases = gen_cases()
+    for level in (logging.INFO, logging.DEBUG):
+        set_level(level)
+        for name, func in cases:
+            report('%s (%s)' % (name, logging.getLevelName(level)),
+                   measure(func, args.number, args.runs))
+
+
+if __name__ == '__main__':
+    main()
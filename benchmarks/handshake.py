@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""End to end benchmark of the client against the DHCP server stand-in.
+
+Runs the asyncio client against ``dhcpcanon.server.DHCPServer``, with the
+injected ``--latency``, ``--drop-rate`` and ``--nak-rate``, and measures:
+
+- ``handshake``: the time from starting a client until it is bound, and the
+  DISCOVERs and REQUESTs it sent, ie its retransmissions.
+- ``renew``: the load of ``--clients`` clients renewing leases of
+  ``--lease-time`` seconds during ``--duration`` seconds: the messages the
+  server received per second and how many clients stayed bound.
+
+By default the client and the server talk over in-memory transports and it
+runs unprivileged. With ``--netns`` they talk over a veth pair in a network
+namespace, which needs root; the namespace is removed when it finishes.
+The clients do not configure the interface, the leases are only bound.
+
+Usage::
+
+    python3 benchmarks/handshake.py [handshake|renew] [-n RUNS]
+        [--clients N] [--lease-time SECS] [--duration SECS]
+        [--latency SECS] [--drop-rate P] [--nak-rate P] [--seed N]
+        [--netns]
+
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from dhcpcanon.dhcpcapasync import DHCPCAPAsyncFSM
+from dhcpcanon.dhcpcapsock import LoopbackTransport, RawTransport
+from dhcpcanon.server import DHCPServer, raw_socket
+from dhcpcanon.timers import TimerHeap
+
+NETNS = 'dhcpcanon-bench'
+IFACE = 'bench0'
+SERVER_IFACE = 'bench1'
+
+
+class BenchFSM(DHCPCAPAsyncFSM):
+    """Client that only binds the leases, without configuring the
+    interface."""
+
+    def configure(self):
+        self.run_script()
+
+
+def gen_client_mac(i):
+    return '02:00:00:00:%02x:%02x' % (i // 256 % 256, i % 256)
+
+
+def gen_clients(args, server, loop, number):
+    """Create ``number`` clients and start serving them.
+
+    Return the clients and what to close when they are stopped.
+
+    """
+    scheduler = TimerHeap(loop)
+    fsms = []
+    if args.iface:
+        socks = [raw_socket(args.server_iface)]
+        transports = [RawTransport()] * number
+    else:
+        transports = [LoopbackTransport() for _ in range(number)]
+        socks = [transport.peer for transport in transports]
+    server.start(socks)
+    for i, transport in enumerate(transports):
+        fsms.append(BenchFSM(iface=args.iface or IFACE,
+                             client_mac=gen_client_mac(i), loop=loop,
+                             scheduler=scheduler, transport=transport))
+    return fsms, transports + socks
+
+
+async def wait_bound(fsms):
+    await asyncio.gather(*[fsm.wait_bound() for fsm in fsms])
+
+
+def stop_clients(server, fsms, closeables):
+    for fsm in fsms:
+        fsm.stop()
+    server.stop()
+    for closeable in closeables:
+        closeable.close()
+
+
+def gen_server(args, seed):
+    return DHCPServer(lease_time=args.lease_time, latency=args.latency,
+                      drop_rate=args.drop_rate, nak_rate=args.nak_rate,
+                      pool_size=max(args.clients, 1) + 10, seed=seed)
+
+
+def run_handshake(args, seed):
+    """Return the seconds to bound and the messages the client sent."""
+    loop = asyncio.new_event_loop()
+    server = gen_server(args, seed)
+    fsms, closeables = gen_clients(args, server, loop, 1)
+    fsm = fsms[0]
+    try:
+        t0 = time.perf_counter()
+        fsm.start()
+        loop.run_until_complete(asyncio.wait_for(wait_bound(fsms),
+                                                 args.timeout))
+        elapsed = time.perf_counter() - t0
+    finally:
+        stop_clients(server, fsms, closeables)
+        loop.close()
+    return elapsed, server.stats['received discover'], \
+        server.stats['received request']
+
+
+def run_renew(args, seed):
+    """Return the server statistics and the clients bound at the end."""
+    loop = asyncio.new_event_loop()
+    server = gen_server(args, seed)
+    fsms, closeables = gen_clients(args, server, loop, args.clients)
+    try:
+        for fsm in fsms:
+            fsm.start()
+        loop.run_until_complete(asyncio.wait_for(wait_bound(fsms),
+                                                 args.timeout))
+        bound_stats = dict(server.stats)
+        loop.run_until_complete(asyncio.sleep(args.duration))
+        bound = sum(1 for fsm in fsms if fsm.client.lease.address and
+                    fsm.bound.is_set())
+    finally:
+        stop_clients(server, fsms, closeables)
+        loop.close()
+    stats = {k: v - bound_stats.get(k, 0) for k, v in server.stats.items()}
+    return stats, bound
+
+
+def report(name, values, unit='s'):
+    print('%-24s median %9.4f%s min %9.4f%s max %9.4f%s (%d runs)' %
+          (name, statistics.median(values), unit, min(values), unit,
+           max(values), unit, len(values)))
+
+
+def run_in_netns(argv):
+    """Run the benchmark again in a network namespace with a veth pair."""
+    subprocess.check_call(['ip', 'netns', 'add', NETNS])
+    try:
+        for cmd in (['link', 'add', IFACE, 'type', 'veth', 'peer', 'name',
+                     SERVER_IFACE],
+                    ['link', 'set', IFACE, 'up'],
+                    ['link', 'set', SERVER_IFACE, 'up']):
+            subprocess.check_call(['ip', '-n', NETNS] + cmd)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+            [p for p in [env.get('PYTHONPATH')] if p])
+        argv = [a for a in argv if a != '--netns']
+        subprocess.check_call(['ip', 'netns', 'exec', NETNS, sys.executable,
+                               os.path.abspath(__file__), '--iface', IFACE,
+                               '--server-iface', SERVER_IFACE] + argv,
+                              env=env)
+    finally:
+        subprocess.check_call(['ip', 'netns', 'delete', NETNS])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('mode', nargs='?', default='handshake',
+                        choices=['handshake', 'renew'])
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=50,
+                        help='clients renewing at once in renew mode')
+    parser.add_argument('--lease-time', type=int, default=43200,
+                        help='lease time given by the server')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds measuring the renew load')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the server delays every reply')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='probability the server ignores a message')
+    parser.add_argument('--nak-rate', type=float, default=0.0,
+                        help='probability the server NAKs a valid request')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the faults of the first run')
+    parser.add_argument('--timeout', type=float, default=120,
+                        help='seconds waiting for the clients to be bound')
+    parser.add_argument('--netns', action='store_true',
+                        help='run over a veth pair in a network namespace')
+    parser.add_argument('--iface', help=argparse.SUPPRESS)
+    parser.add_argument('--server-iface', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.netns:
+        run_in_netns(sys.argv[1:])
+        return
+    if args.mode == 'handshake':
+        results = [run_handshake(args, args.seed + i)
+                   for i in range(args.runs)]
+        times, discovers, requests = zip(*results)
+        report('time to bound', times)
+        report('DISCOVERs sent', discovers, '')
+        report('REQUESTs sent', requests, '')
+        return
+    stats, bound = run_renew(args, args.seed)
+    for name in sorted(stats):
+        print('%-24s %8d %8.2f/s' %
+              (name, stats[name], stats[name] / args.duration))
+    print('%-24s %8d of %d' % ('clients bound', bound, args.clients))
+
+
+if __name__ == '__main__':
+    main()
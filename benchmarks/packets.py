@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Packet path micro-benchmarks of the DHCP client.
+
+Measures, with the packets and clients of the test fixtures
+(``tests/dhcpcap_pkts.py`` and ``tests/dhcpcap_objs.py``), the functions
+every exchange goes through: generating the DISCOVER and REQUEST (scapy and
+template), parsing and classifying the replies, creating and checking the
+lease, setting its times and initializing the script environment.
+
+``--save`` stores the median times in a JSON file and ``--compare`` fails
+when a median is more than ``--threshold`` percent over the stored one.
+Baselines are only comparable on the same machine and Python and scapy
+versions, which are stored with them. ``benchmarks/packets.json`` is the
+baseline before the optimisations of these paths.
+
+Usage::
+
+    python3 benchmarks/packets.py [-n RUNS] [--save FILE]
+                                  [--compare FILE] [--threshold PERCENT]
+                                  [NAME ...]
+
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+
+import scapy
+
+from dhcpcanon.clientscript import ClientScript
+from dhcpcanon.constants import STATE_BOUND
+from dhcpcanon.dhcpcappkt import parse_reply
+from dhcpcanon.dhcpcaputils import isack, isnak, isoffer
+from dhcpcap_objs import client_init, client_request
+from dhcpcap_pkts import dhcp_ack, dhcp_offer
+
+SENT_DT = datetime(2017, 6, 23)
+
+
+def gen_cases():
+    """Return the benchmark names and functions."""
+    client_init.xid = client_request.xid = 0x12345678
+    offer_frame, ack_frame = bytes(dhcp_offer), bytes(dhcp_ack)
+    offer, ack = parse_reply(offer_frame), parse_reply(ack_frame)
+    attrs = offer.options_attrs()
+    attrs.update(interface='eth0', address=offer.address,
+                 next_server=offer.next_server)
+    lease = client_request.lease
+    script = ClientScript('/bin/true')
+    return [
+        ('gen_discover', client_init.gen_discover),
+        ('gen_discover_raw', client_init.gen_discover_raw),
+        ('gen_request', client_request.gen_request),
+        ('gen_request_raw', client_request.gen_request_raw),
+        ('parse_reply', lambda: parse_reply(ack_frame)),
+        ('isoffer/isack/isnak scapy',
+         lambda: (isoffer(dhcp_ack), isack(dhcp_ack), isnak(dhcp_ack))),
+        ('isoffer/isack/isnak reply',
+         lambda: (isoffer(ack), isack(ack), isnak(ack))),
+        ('handle_offer_ack scapy',
+         lambda: client_init.handle_offer_ack(dhcp_offer)),
+        ('handle_offer_ack reply',
+         lambda: client_init.handle_offer_ack(parse_reply(offer_frame))),
+        ('gen_check_lease_attrs',
+         lambda: client_init.gen_check_lease_attrs(dict(attrs))),
+        ('set_times', lambda: lease.set_times(SENT_DT)),
+        ('script_init', lambda: script.script_init(lease, STATE_BOUND)),
+    ]
+
+
+def measure(func, runs):
+    """Return the microseconds per call of ``runs`` runs of ``func``."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return [t / number * 1e6 for t in timer.repeat(repeat=runs,
+                                                   number=number)]
+
+
+def report(name, times, baseline=None):
+    median = statistics.median(times)
+    line = '%-28s median %10.2fus min %10.2fus max %10.2fus' % (
+        name, median, min(times), max(times))
+    if baseline:
+        line += ' %+7.1f%%' % ((median / baseline - 1) * 100)
+    print(line)
+    return median
+
+
+def environment():
+    return dict(python=platform.python_version(), scapy=scapy.VERSION,
+                machine=platform.machine())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run, all by default')
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('--save', metavar='FILE',
+                        help='store the median times in FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the median times with the ones '
+                             'stored in FILE')
+    parser.add_argument('--threshold', type=float, default=20,
+                        help='percentage over the stored median time that '
+                             'is a regression (default: %(default)s)')
+    args = parser.parse_args()
+    baselines = dict()
+    if args.compare:
+        with open(args.compare) as fd:
+            stored = json.load(fd)
+        if stored['environment'] != environment():
+            print('Baseline environment %s differs from %s.' %
+                  (stored['environment'], environment()))
+        baselines = stored['medians']
+    cases = [(name, func) for name, func in gen_cases()
+             if not args.names or name in args.names]
+    medians = dict()
+    regressions = []
+    for name, func in cases:
+        baseline = baselines.get(name)
+        medians[name] = report(name, measure(func, args.runs), baseline)
+        if baseline and \
+                medians[name] > baseline * (1 + args.threshold / 100):
+            regressions.append(name)
+    if args.save:
+        medians = {name: round(median, 2) for name, median in medians.items()}
+        with open(args.save, 'w') as fd:
+            json.dump(dict(environment=environment(), medians=medians), fd,
+                      indent=2, sort_keys=True)
+            fd.write('\n')
+    if regressions:
+        print('Over the %.0f%% threshold: %s.' %
+              (args.threshold, ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Default route and address lookup benchmark with a large routing table.
+
+Creates a network namespace with two veth pairs, an address and a default
+route on the first one and a synthetic main table of ``--routes`` routes
+through the second one, and measures in it the lookups ``set_net`` does
+when the address or the default route already exist: the kernel filtered
+dumps of ``netutils.NetlinkContext`` and, unless ``--no-baseline``, the
+previous full dump of the main table.
+It needs to run as root and removes the namespace when it finishes.
+
+Usage::
+
+    sudo python3 benchmarks/routes.py [-r ROUTES] [-n RUNS] [--no-baseline]
+
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+NETNS = 'dhcpcanon-bench'
+IFACE = 'bench0'
+ADDRESS = '192.168.1.23'
+ROUTER = '192.168.1.1'
+
+SETUP = """
+link add bench0 type veth peer name bench1
+link add bench2 type veth peer name bench3
+link set bench0 up
+link set bench1 up
+link set bench2 up
+link set bench3 up
+address add 192.168.1.23/24 dev bench0
+address add 10.0.0.1/8 dev bench2
+route add default via 192.168.1.1 dev bench0
+"""
+
+LOOKUP_CODE = """
+import time
+from dhcpcanon.netutils import get_netlink
+nl = get_netlink()
+index = nl.link_index(%(iface)r)
+for _ in range(%(runs)d):
+    t0 = time.perf_counter()
+    assert nl.default_gateways(index) == [%(router)r]
+    assert list(nl.addresses(index)) == [%(address)r]
+    print('filtered', time.perf_counter() - t0)
+if %(baseline)r:
+    from pyroute2 import IPRoute
+    ipr = IPRoute()
+    t0 = time.perf_counter()
+    ipr.get_routes(table=254)[0].get_attrs('RTA_GATEWAY')
+    ipr.get_addr(index=index)[0].get_attrs('IFA_ADDRESS')
+    print('full dump', time.perf_counter() - t0)
+"""
+
+
+def ip(*args):
+    subprocess.check_call(('ip', '-n', NETNS) + args)
+
+
+def setup_netns(routes):
+    subprocess.check_call(['ip', 'netns', 'add', NETNS])
+    with tempfile.NamedTemporaryFile('w', suffix='.batch') as fd:
+        fd.write(SETUP)
+        for i in range(routes):
+            fd.write('route add %d.%d.%d.0/24 via 10.0.0.2 dev bench2\n' %
+                     (11 + i // 65536, i // 256 % 256, i % 256))
+        fd.flush()
+        ip('-batch', fd.name)
+
+
+def run_lookups(runs, baseline):
+    code = LOOKUP_CODE % dict(iface=IFACE, runs=runs, router=ROUTER,
+                              address=ADDRESS, baseline=baseline)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [p for p in [env.get('PYTHONPATH')] if p])
+    output = subprocess.check_output(
+        ['ip', 'netns', 'exec', NETNS, sys.executable, '-c', code], env=env)
+    times = dict()
+    for line in output.decode().splitlines():
+        name, seconds = line.rsplit(' ', 1)
+        times.setdefault(name, []).append(float(seconds))
+    return times
+
+
+def report(name, times):
+    print('%-20s median %.4fs min %.4fs max %.4fs (%d runs)' %
+          (name, statistics.median(times), min(times), max(times),
+           len(times)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-r', '--routes', type=int, default=100000,
+                        help='routes in the synthetic main table')
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('--no-baseline', action='store_true',
+                        help='do not measure the full dump, which takes '
+                             'seconds with large tables')
+    args = parser.parse_args()
+    t0 = time.perf_counter()
+    try:
+        setup_netns(args.routes)
+        print('%d routes added in %.1fs' %
+              (args.routes, time.perf_counter() - t0))
+        times = run_lookups(args.runs, not args.no_baseline)
+    finally:
+        subprocess.check_call(['ip', 'netns', 'delete', NETNS])
+    for name, values in times.items():
+        report(name, values)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Start up benchmark of the dhcpcanon entry point.
+
+Measures, in fresh processes, the time ``dhcpcanon --version`` takes and the
+time from starting ``dhcpcanon`` until the first DISCOVER is sent.
+The second measure opens raw sockets and sends a DISCOVER on the given
+interface (``lo`` by default), so it needs to run as root.
+
+Usage::
+
+    sudo python3 benchmarks/startup.py [-i IFACE] [-n RUNS] [--budget SECS]
+
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+VERSION_CODE = """
+import sys
+from dhcpcanon.dhcpcanon import main
+sys.argv = ['dhcpcanon', '--version']
+main()
+"""
+
+FIRST_DISCOVER_CODE = """
+import os
+import sys
+from dhcpcanon.dhcpcanon import main
+from dhcpcanon import dhcpcapfsm
+send_frame = dhcpcapfsm.DHCPCAPFSM.send_frame
+
+
+def first_send_frame(self, frame):
+    send_frame(self, frame)
+    os.write(1, b'FIRST DISCOVER\\n')
+    os._exit(0)
+
+
+dhcpcapfsm.DHCPCAPFSM.send_frame = first_send_frame
+sys.argv = ['dhcpcanon', %r]
+main()
+"""
+
+
+def time_version():
+    t0 = time.perf_counter()
+    subprocess.check_call([sys.executable, '-c', VERSION_CODE],
+                          stdout=subprocess.DEVNULL)
+    return time.perf_counter() - t0
+
+
+def time_first_discover(iface, timeout=30):
+    t0 = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-c',
+                             FIRST_DISCOVER_CODE % iface],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    try:
+        for line in proc.stdout:
+            if line.strip() == b'FIRST DISCOVER':
+                return time.perf_counter() - t0
+            if time.perf_counter() - t0 > timeout:
+                break
+    finally:
+        proc.kill()
+        proc.wait()
+    raise RuntimeError('dhcpcanon did not send a DISCOVER, '
+                       'is it running as root?')
+
+
+def report(name, times):
+    print('%-20s median %.3fs min %.3fs max %.3fs (%d runs)' %
+          (name, statistics.median(times), min(times), max(times),
+           len(times)))
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-i', '--iface', default='lo',
+                        help='interface where to send the DISCOVER')
+    parser.add_argument('-n', '--runs', type=int, default=5)
+    parser.add_argument('--budget', type=float,
+                        help='fail if the median time to the first DISCOVER '
+                             'is greater than this number of seconds')
+    args = parser.parse_args()
+    report('--version', [time_version() for _ in range(args.runs)])
+    median = report('first DISCOVER', [time_first_discover(args.iface)
+                                       for _ in range(args.runs)])
+    if args.budget is not None and median > args.budget:
+        print('Start up time %.3fs is over the budget of %.3fs.' %
+              (median, args.budget))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -46,4 +46,6 @@ __license__ = """
     along with this package. If not, see <http://www.gnu.org/licenses/>.
 """
 __all__ = ('clientscript', 'conflog', 'dhcpcapfsm', 'dhcpcaplease',
-           'dhcpcaputils', 'timers', 'constants', 'dhcpcap')
+           'dhcpcaputils', 'timers', 'constants', 'dhcpcap', 'dhcpcappkt',
+           'dhcpcapsock', 'dhcpcapasync',
+           'dhcpcapdaemon', 'offers', 'hooks', 'server')
@@ -4,18 +4,276 @@
 """Class to Initialize and call external script."""
 from __future__ import absolute_import, unicode_literals
 
+import functools
 import logging
 import os
+import struct
 import subprocess
+import threading
+from collections import deque
 
 import attr
 
-from .constants import (ENV_OPTIONS_REQ, LEASEATTRS2ENVKEYS,
+from .constants import (ENV_OPTIONS_REQ, HOOK_HELPER_ENV, LEASEATTRS2ENVKEYS,
                         LEASEATTRS_SAMEAS_ENVKEYS, SCRIPT_ENV_KEYS,
-                        SCRIPT_PATH, STATES2REASONS)
+                        SCRIPT_PATH, SCRIPT_TIMEOUT, SCRIPT_WORKERS,
+                        STATES2REASONS)
 
 logger = logging.getLogger('dhcpcanon')
 
+# script runner shared by all the interfaces, see get_script_runner
+script_runner = None
+# hook helpers shared by all the interfaces, by script, see get_hook_helper
+hook_helpers = dict()
+
+
+def run_script(scriptname, env, timeout=SCRIPT_TIMEOUT):
+    """Run the external script and return its exit status.
+
+    The script is killed when it runs for more than ``timeout`` seconds.
+    None is returned when it can not be run or it is killed.
+
+    """
+    logger.info('Calling script %s', scriptname)
+    logger.info('with env %s', env)
+    try:
+        proc = subprocess.Popen([scriptname], env=env,
+                                stderr=subprocess.STDOUT)
+    except OSError as e:
+        logger.error('Can not run script %s: %s', scriptname, e)
+        return None
+    try:
+        proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        logger.error('Script %s killed after %s seconds.', scriptname,
+                     timeout)
+        return None
+    return proc.returncode
+
+
+class ScriptRunner(object):
+    """Run the external scripts in a bounded pool of threads.
+
+    The FSMs continue receiving packets and running their timers while the
+    scripts run. The scripts of an interface are run in the order they are
+    submitted, one at a time, and at most ``workers`` scripts run at once.
+    When a script finishes, ``callback(reason, returncode)`` is called in
+    the worker thread.
+
+    """
+
+    def __init__(self, workers=SCRIPT_WORKERS, timeout=SCRIPT_TIMEOUT):
+        from concurrent.futures import ThreadPoolExecutor
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        # scripts waiting for the running one of the same interface
+        self.pending = dict()
+
+    def submit(self, iface, scriptname, env, callback=None):
+        """Run the script after the previous ones of ``iface``."""
+        with self.lock:
+            if iface in self.pending:
+                self.pending[iface].append((scriptname, env, callback))
+                return
+            self.pending[iface] = deque()
+        self.start(iface, scriptname, env, callback)
+
+    def start(self, iface, scriptname, env, callback):
+        future = self.executor.submit(run_script, scriptname, env,
+                                      self.timeout)
+        future.add_done_callback(functools.partial(self.done, iface,
+                                                   env.get('reason'),
+                                                   callback))
+
+    def done(self, iface, reason, callback, future):
+        """Call the callback and start the next script of ``iface``.
+
+        The next script is started even when this one or its callback
+        failed, so that the scripts of the interface are not blocked.
+
+        """
+        try:
+            returncode = future.result()
+        except Exception:
+            logger.error('Script for %s %s failed', iface, reason,
+                         exc_info=True)
+            returncode = None
+        logger.debug('Script for %s %s exited with %s.', iface, reason,
+                     returncode)
+        try:
+            if callback is not None:
+                callback(reason, returncode)
+        except Exception:
+            logger.error('Script callback failed', exc_info=True)
+        finally:
+            self.start_next(iface)
+
+    def start_next(self, iface):
+        """Start the next pending script of ``iface``, if any."""
+        with self.lock:
+            if self.pending[iface]:
+                scriptname, env, callback = self.pending[iface].popleft()
+            else:
+                del self.pending[iface]
+                self.idle.notify_all()
+                return
+        self.start(iface, scriptname, env, callback)
+
+    def close(self):
+        """Wait for the submitted scripts and stop the threads."""
+        with self.lock:
+            while self.pending:
+                self.idle.wait()
+        self.executor.shutdown(wait=True)
+
+
+def encode_record(env):
+    """Encode the environment of a script as a hook helper record.
+
+    The record is the length of the entries as a 4 bytes big endian
+    integer, followed by the ``key=value`` entries separated by NUL bytes.
+
+    """
+    entries = b'\0'.join(('%s=%s' % (k, v)).encode('utf-8')
+                         for k, v in sorted(env.items()))
+    return struct.pack('!I', len(entries)) + entries
+
+
+def read_record(stream):
+    """Read a hook helper record from a binary stream.
+
+    Return the environment as a dict, None when the stream ends.
+
+    """
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+    length = struct.unpack('!I', header)[0]
+    entries = stream.read(length).decode('utf-8')
+    return dict(entry.split('=', 1) for entry in entries.split('\0')
+                if entry)
+
+
+class HookHelper(object):
+    """Send the transitions to a long lived hook helper process.
+
+    The script is started once, with ``DHCPCANON_HELPER=1`` in its
+    environment, and instead of being run on every transition it reads
+    from its standard input a record with the environment of each
+    transition, see :func:`encode_record` and :func:`read_record`.
+    It is started again if it exits, the records written while it was
+    exiting are lost.
+
+    It can be used as the ``runner`` of a :class:`ClientScript`. The records
+    are written by a thread, in the order they are submitted, so that the
+    FSMs do not wait for the helper. ``callback(reason, 0)`` is called when
+    the record is written and ``callback(reason, None)`` when it can not be
+    written.
+
+    """
+
+    def __init__(self, scriptname):
+        import queue
+        self.scriptname = scriptname
+        self.proc = None
+        self.records = queue.Queue()
+        self.thread = threading.Thread(target=self.write_records,
+                                       name='hook-helper')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, iface, scriptname, env, callback=None):
+        """Send the environment of a transition to the helper."""
+        self.records.put((env, callback))
+
+    def start(self):
+        logger.info('Starting hook helper %s', self.scriptname)
+        env = {HOOK_HELPER_ENV: '1', 'client': 'dhcpcanon',
+               'pid': str(os.getpid())}
+        self.proc = subprocess.Popen([self.scriptname], env=env,
+                                     stdin=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+
+    def write(self, record):
+        """Write a record, starting the helper again if it exited."""
+        for attempt in range(2):
+            try:
+                if self.proc is None or self.proc.poll() is not None:
+                    self.start()
+                self.proc.stdin.write(record)
+                self.proc.stdin.flush()
+                return True
+            except OSError as e:
+                logger.warning('Hook helper %s failed: %s', self.scriptname,
+                               e)
+                if self.proc is not None and self.proc.poll() is None:
+                    self.proc.kill()
+                    self.proc.wait()
+        return False
+
+    def write_records(self):
+        while True:
+            item = self.records.get()
+            if item is None:
+                return
+            env, callback = item
+            returncode = 0 if self.write(encode_record(env)) else None
+            if callback is not None:
+                try:
+                    callback(env.get('reason'), returncode)
+                except Exception:
+                    logger.error('Script callback failed', exc_info=True)
+
+    def close(self):
+        """Send the pending records and wait for the helper to exit."""
+        self.records.put(None)
+        self.thread.join()
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.stdin.close()
+            try:
+                self.proc.wait(timeout=SCRIPT_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+
+
+def get_hook_helper(scriptname):
+    """Return the shared :class:`HookHelper` of a script, creating it once.
+    """
+    if scriptname not in hook_helpers:
+        hook_helpers[scriptname] = HookHelper(scriptname)
+    return hook_helpers[scriptname]
+
+
+def get_script_runner():
+    """Return the shared :class:`ScriptRunner`, creating it once."""
+    global script_runner
+    if script_runner is None:
+        script_runner = ScriptRunner()
+    return script_runner
+
+
+def get_runner(scriptname, helper=False):
+    """Return the shared runner for a script, a hook helper if ``helper``.
+    """
+    if helper:
+        return get_hook_helper(scriptname)
+    return get_script_runner()
+
+
+def close_script_runner():
+    """Wait for the scripts, closing the shared runner and hook helpers."""
+    global script_runner
+    if script_runner is not None:
+        script_runner.close()
+        script_runner = None
+    while hook_helpers:
+        hook_helpers.popitem()[1].close()
+
 
 @attr.s
 class ClientScript(object):
@@ -26,10 +284,15 @@ class ClientScript(object):
     or `nm-dhcp-helper
     <https://github.com/NetworkManager/NetworkManager/tree/master/src/dhcp>`_.
 
+    With a ``runner``, :meth:`script_go` submits the script to it, passing
+    ``callback``, instead of waiting for the script to finish.
+
     """
 
     scriptname = attr.ib(default=None)
     env = attr.ib(default=attr.Factory(dict))
+    runner = attr.ib(default=None, cmp=False, repr=False)
+    callback = attr.ib(default=None, cmp=False, repr=False)
 
     def __attrs_post_init__(self, scriptfile=None, env=None):
         """."""
@@ -55,10 +318,11 @@ class ClientScript(object):
             self.env['medium'] = self.env.get('medium') or str(medium)
             self.env['client'] = str('dhcpcanon')
             self.env['pid'] = str(os.getpid())
+            views = lease.views
             for k in LEASEATTRS_SAMEAS_ENVKEYS:
-                self.env[k] = str(lease.__getattribute__(k))
+                self.env[k] = views[k]
             for k, v in LEASEATTRS2ENVKEYS.items():
-                self.env[v] = str(lease.__getattribute__(k))
+                self.env[v] = views[k]
             self.env.update(ENV_OPTIONS_REQ)
         else:
             logger.debug('There is not script path.')
@@ -68,13 +332,10 @@ class ClientScript(object):
         scriptname = self.scriptname or scriptname
         if scriptname is not None:
             env = self.env or env
-            logger.info('Calling script %s', scriptname)
-            logger.info('with env %s', env)
-            proc = subprocess.Popen([scriptname], env=env,
-                                    stderr=subprocess.STDOUT)
-            try:
-                (stdout, stderr) = proc.communicate()
+            if self.runner is not None:
+                # the environment changes with the next script_init
+                self.runner.submit(env.get('interface'), scriptname,
+                                   dict(env), self.callback)
                 return True
-            except TypeError as e:
-                logger.error(e)
+            return run_script(scriptname, env) is not None
         return False
@@ -1,10 +1,23 @@
 # -*- coding: utf-8 -*-
 # vim:ts=4:sw=4:expandtab
 # Copyright 2016, 2017 juga (juga at riseup dot net), MIT license.
-"""Logging configuration."""
+"""Logging configuration.
+
+The handlers of the loggers write to syslog and stdout, which can block when
+journald stalls or the reader of stdout does not read.
+:func:`configure_logging` moves them to a thread, fed by a bounded queue that
+drops the records when it is full, so that logging does not delay the FSMs.
+
+"""
+import atexit
 import logging
+import logging.config
+import logging.handlers
+import queue
 import sys
 
+from .constants import LOG_QUEUE_SIZE
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': True,
@@ -73,3 +86,69 @@ LOGGING = {
         }
     }
 }
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """Put the records in a bounded queue, dropping them when it is full.
+
+    The records dropped are counted in ``dropped`` and reported with a
+    warning before the next record that fits in the queue.
+
+    """
+
+    def __init__(self, maxsize=LOG_QUEUE_SIZE):
+        super(BoundedQueueHandler, self).__init__(queue.Queue(maxsize))
+        self.dropped = 0
+        self.reported = 0
+
+    def enqueue(self, record):
+        try:
+            if self.dropped > self.reported:
+                self.queue.put_nowait(logging.LogRecord(
+                    record.name, logging.WARNING, __file__, 0,
+                    '%d log records dropped' % (self.dropped - self.reported),
+                    None, None))
+                self.reported = self.dropped
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class QueueListener(logging.handlers.QueueListener):
+    """QueueListener that can be stopped when the queue is full."""
+
+    def enqueue_sentinel(self):
+        # the thread empties the queue, wait for it instead of failing
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread is not None:
+            super(QueueListener, self).stop()
+
+
+def configure_logging(config=LOGGING, maxsize=LOG_QUEUE_SIZE):
+    """Configure the logging, running the handlers in threads.
+
+    The handlers of every logger in ``config`` are replaced by a
+    :class:`BoundedQueueHandler` with a queue of ``maxsize`` records, read
+    by a :class:`QueueListener` that runs the handlers.
+    The loggers with the same handlers share the queue.
+    The listeners are returned, and stopped at exit.
+
+    """
+    logging.config.dictConfig(config)
+    queues = dict()
+    for name in config.get('loggers', {}):
+        log = logging.getLogger(name)
+        handlers = tuple(log.handlers)
+        if not handlers:
+            continue
+        if handlers not in queues:
+            queue_handler = BoundedQueueHandler(maxsize)
+            listener = QueueListener(
+                queue_handler.queue, *handlers, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            queues[handlers] = (queue_handler, listener)
+        log.handlers = [queues[handlers][0]]
+    return [listener for queue_handler, listener in queues.values()]
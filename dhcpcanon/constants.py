@@ -29,18 +29,86 @@ TIMEOUT_SELECTING = 60
 TIMEOUT_REQUESTING = 60
 TIMEOUT_REQUEST_RENEWING = 226800
 TIMEOUT_REQUEST_REBINDING = 75600
+TIMEOUT_REBOOTING = 60
 
 MAX_DELAY_SELECTING = 10
 RENEW_PERC = 0.5
 REBIND_PERC = 0.875
+# cancelled timers kept in the timer heap before compacting it
+MIN_TIMERS_CANCELLED_COMPACT = 64
+# log records waiting to be written before dropping them
+LOG_QUEUE_SIZE = 1024
+# bytes read at once from the netlink sockets
+NETLINK_BUFFER_SIZE = 65536
+# socket option to filter netlink dumps in the kernel, linux/netlink.h
+SOL_NETLINK = 270
+NETLINK_GET_STRICT_CHK = 12
+RT_TABLE_MAIN = 254
 
 # DHCP number packet retransmissions
 MAX_ATTEMPTS_DISCOVER = 5
-MAX_OFFERS_COLLECTED = 1
+# offers collected before selecting one when no offer satisfies the policy
+MAX_OFFERS_COLLECTED = 8
+# seconds collecting offers since the first one is received
+OFFER_WINDOW = 1
 MAX_ATTEMPTS_REQUEST = 5
+# REQUESTs sent in INIT-REBOOT before falling back to INIT
+MAX_ATTEMPTS_REBOOT = 2
+
+# DHCP server stand-in, see server.py
+##############
+SERVER_LEASE_TIME = 43200
+# seconds waiting for frames before checking whether to stop
+SERVER_POLL_INTERVAL = 0.1
 
 # DHCP packet
 ##############
+ETHER_TYPE_IP = 0x0800
+IP_PROTO_UDP = 17
+IP_TTL = 64
+BOOTP_OP_REQUEST = 1
+BOOTP_OP_REPLY = 2
+BOOTP_HTYPE_ETHER = 1
+BOOTP_MAGIC_COOKIE = b'c\x82Sc'
+
+DHCP_OPTION_PAD = 0
+DHCP_OPTION_SUBNET_MASK = 1
+DHCP_OPTION_ROUTER = 3
+DHCP_OPTION_NAME_SERVER = 6
+DHCP_OPTION_DOMAIN = 15
+DHCP_OPTION_BROADCAST_ADDRESS = 28
+DHCP_OPTION_REQUESTED_ADDR = 50
+DHCP_OPTION_LEASE_TIME = 51
+DHCP_OPTION_MESSAGE_TYPE = 53
+DHCP_OPTION_SERVER_ID = 54
+DHCP_OPTION_PRL = 55
+DHCP_OPTION_RENEWAL_TIME = 58
+DHCP_OPTION_REBINDING_TIME = 59
+DHCP_OPTION_CLIENT_ID = 61
+DHCP_OPTION_END = 255
+
+# codes of DHCP_OFFER_OPTIONS, named as scapy does
+DHCP_OFFER_OPTIONS_CODES = {
+    DHCP_OPTION_SERVER_ID: 'server_id',
+    DHCP_OPTION_SUBNET_MASK: 'subnet_mask',
+    DHCP_OPTION_BROADCAST_ADDRESS: 'broadcast_address',
+    DHCP_OPTION_ROUTER: 'router',
+    DHCP_OPTION_DOMAIN: 'domain',
+    DHCP_OPTION_NAME_SERVER: 'name_server',
+    DHCP_OPTION_LEASE_TIME: 'lease_time',
+    DHCP_OPTION_RENEWAL_TIME: 'renewal_time',
+    DHCP_OPTION_REBINDING_TIME: 'rebinding_time',
+}
+
+DHCPDISCOVER = 1
+DHCPOFFER = 2
+DHCPREQUEST = 3
+DHCPDECLINE = 4
+DHCPACK = 5
+DHCPNAK = 6
+DHCPRELEASE = 7
+DHCPINFORM = 8
+
 DHCP_OFFER_OPTIONS = [
     'server_id', 'subnet_mask', 'broadcast_address',
     'router', 'domain', 'name_server', 'lease_time', 'renewal_time',
@@ -57,6 +125,8 @@ STATE_BOUND = 4
 STATE_RENEWING = 5
 STATE_REBINDING = 6
 STATE_END = 7
+STATE_INIT_REBOOT = 8
+STATE_REBOOTING = 9
 
 STATES2NAMES = {
     STATE_ERROR: 'ERROR',
@@ -68,6 +138,8 @@ STATES2NAMES = {
     STATE_RENEWING: 'RENEWING',
     STATE_REBINDING: 'REBINDING',
     STATE_END: 'END',
+    STATE_INIT_REBOOT: 'INIT_REBOOT',
+    STATE_REBOOTING: 'REBOOTING',
 }
 
 # NM integration
@@ -91,6 +163,8 @@ STATES2REASONS = {
     # that it can be passed to NetworkManager, as dhclient does, ie:
     # "STOP", "EXPIRE"
 }
+# reason when the lease expires, before going to INIT
+REASON_EXPIRE = 'EXPIRE'
 
 # systemd events
 DHCP_EVENTS = {
@@ -147,6 +221,11 @@ LEASE_ATTRS2LEASE_FILE = {
     'expiry': 'expiry',
 }
 
+# lease file statement with the client MAC, not a lease attribute
+LEASE_FILE_HARDWARE = 'hardware ethernet'
+# lease file values written between quotes
+LEASE_FILE_QUOTED = ['interface', 'option domain-name']
+
 LEASE_ATTRS2LEASE_LOG = {
     'interface': 'interface',
 
@@ -206,8 +285,25 @@ XID_MIN = 1
 XID_MAX = 900000000
 
 SCRIPT_PATH = '/sbin/dhcpcanon-script'
+# scripts run at once, and seconds before killing a script
+SCRIPT_WORKERS = 4
+SCRIPT_TIMEOUT = 30
+# environment variable set when the script is started as a hook helper
+HOOK_HELPER_ENV = 'DHCPCANON_HELPER'
+# entry point group of the Python hooks
+HOOKS_ENTRY_POINT_GROUP = 'dhcpcanon.hooks'
 PID_PATH = '/var/run/dhcpcanon.pid'
 LEASE_PATH = '/var/lib/dhcp/dhcpcanon.leases'
+# suffix of the file locked while the lease file is updated
+LEASE_LOCK_SUFFIX = '.lock'
+# addresses parsed to IPv4Address that are kept to be shared by the leases
+LEASE_ADDRESS_CACHE_SIZE = 1024
 CONF_PATH = '/etc/dhcp/dhcpcanon.conf'
 RESOLVCONF = '/sbin/resolvconf'
 RESOLVCONF_ADMIN = '/usr/bin/resolvconf-admin'
+RESOLVED_SERVICE = 'systemd-resolved.service'
+
+# DNS backends, in order of preference
+DNS_BACKEND_RESOLVED = 'systemd-resolved'
+DNS_BACKEND_RESOLVCONF_ADMIN = 'resolvconf-admin'
+DNS_BACKEND_RESOLVCONF = 'resolvconf'
@@ -6,29 +6,29 @@
 
 import argparse
 import logging
-import logging.config
-
-from lockfile.pidlockfile import (PIDLockFile, AlreadyLocked,
-                                  LockTimeout, LockFailed)
-from scapy.config import conf
-
-# in python3 this seems to be the only way to to disable:
-# WARNING: Failed to execute tcpdump.
-conf.logLevel = logging.ERROR
 
 from . import __version__
-from .conflog import LOGGING
-from .constants import (CLIENT_PORT, SERVER_PORT, SCRIPT_PATH, PID_PATH)
-from .dhcpcapfsm import DHCPCAPFSM
+from .conflog import configure_logging
+from .constants import (CLIENT_PORT, LEASE_PATH, SERVER_PORT, SCRIPT_PATH,
+                        PID_PATH)
 
-logging.config.dictConfig(LOGGING)
 logger = logging.getLogger('dhcpcanon')
 
 
 def main():
+    # NOTE: scapy, netaddr, pyroute2, dbus and lockfile are imported only in
+    # the code paths that need them, so that --version or --help do not load
+    # any of them and only scapy is loaded before the first DISCOVER.
+    configure_logging()
     parser = argparse.ArgumentParser()
-    parser.add_argument('interface', nargs='?',
-                        help='interface to configure with DHCP')
+    parser.add_argument('interface', nargs='*',
+                        help='interface to configure with DHCP. '
+                             'More than one only in daemon mode.')
+    parser.add_argument('-d', '--daemon',
+                        help='Configure all the given interfaces, or all '
+                             'the interfaces found when none is given, '
+                             'from one process.',
+                        action='store_true')
     parser.add_argument('-v', '--verbose',
                         help='Set logging level to debug',
                         action='store_true')
@@ -50,6 +50,18 @@ def main():
              'dhclient-script(8) for a description of this file.'
              'If dhcpcanon is running with NetworkManager, it will'
              'be called with the script nm-dhcp-helper.')
+    parser.add_argument(
+        '--script-helper', action='store_true',
+        help='Start the -sf script once and send it the environment of '
+             'every transition on its standard input, instead of running '
+             'it on every transition. The script is started with '
+             'DHCPCANON_HELPER=1 and reads records made of a 4 bytes big '
+             'endian length and NUL separated key=value entries.')
+    parser.add_argument(
+        '--hook', action='append', dest='hooks', metavar='NAME',
+        help='Python hook installed in the dhcpcanon.hooks entry point '
+             'group to call with the lease on every transition. It can '
+             'be given several times.')
     parser.add_argument(
         '-pf', metavar='pid-file', nargs='?',
         const=PID_PATH,
@@ -57,8 +69,61 @@ def main():
              'default /var/run/dhcpcanon.pid is used. '
              'This option is used by NetworkManager to check whether '
              'dhcpcanon is already running.')
+    parser.add_argument(
+        '-lf', metavar='lease-file', nargs='?',
+        const=LEASE_PATH,
+        help='Path to the lease database file. If unspecified, the '
+             'default /var/lib/dhcp/dhcpcanon.leases is used. '
+             'Without this option, leases are not stored and a new lease '
+             'is always obtained with a full DISCOVER. With it, a stored '
+             'lease that has not expired is requested again when the '
+             'link-layer address did not change.')
+    parser.add_argument(
+        '--offer-policy', default='first',
+        choices=['first', 'latency', 'lease', 'server'],
+        help='How to select the offer to request: the first one received '
+             '(default), the one received the soonest, the one with the '
+             'longest lease or the one from the preferred servers '
+             '(--server-id). The offers are collected during '
+             '--offer-window seconds after the first one.')
+    parser.add_argument(
+        '--offer-window', type=float,
+        help='Seconds to collect offers after the first one.')
+    parser.add_argument(
+        '--server-id', action='append', dest='server_ids',
+        help='Preferred server identifier, in order of preference, '
+             'for the server offer policy.')
+    parser.add_argument(
+        '--max-latency', type=float,
+        help='Request at once an offer received in less than these '
+             'seconds after the DISCOVER, for the latency offer policy.')
+    parser.add_argument(
+        '--min-lease-time', type=int,
+        help='Request at once an offer with a lease of at least these '
+             'seconds, for the lease offer policy.')
     args = parser.parse_args()
-    logger.debug('args %s', args)
+    if len(args.interface) > 1 and not args.daemon:
+        parser.error('more than one interface requires --daemon')
+    from .offers import gen_offer_policy
+    try:
+        offer_policy = gen_offer_policy(args.offer_policy,
+                                        window=args.offer_window,
+                                        server_ids=args.server_ids,
+                                        max_latency=args.max_latency,
+                                        min_lease_time=args.min_lease_time)
+    except TypeError:
+        parser.error('--server-id, --max-latency and --min-lease-time '
+                     'require --offer-policy server, latency and lease')
+    from .hooks import load_hooks
+    try:
+        hooks = load_hooks(args.hooks)
+    except ValueError as e:
+        parser.error(str(e))
+
+    from scapy.config import conf
+    # in python3 this seems to be the only way to to disable:
+    # WARNING: Failed to execute tcpdump.
+    conf.logLevel = logging.ERROR
 
     # do not put interfaces in promiscuous mode
     conf.sniff_promisc = conf.promisc = 0
@@ -67,11 +132,13 @@ def main():
     if args.verbose:
         logger.setLevel(logging.DEBUG)
     logger.debug('args %s', args)
-    if args.interface:
-        conf.iface = args.interface
-    logger.debug('interface %s' % conf.iface)
+    if args.interface and not args.daemon:
+        conf.iface = args.interface[0]
+    logger.debug('interface %s', conf.iface)
     if args.pf is not None:
         # This is only needed for nm
+        from lockfile.pidlockfile import (PIDLockFile, AlreadyLocked,
+                                          LockTimeout, LockFailed)
         pf = PIDLockFile(args.pf, timeout=5)
         try:
             pf.acquire()
@@ -81,12 +148,33 @@ def main():
             pf.acquire()
         except (LockTimeout, LockFailed) as e:
             logger.error(e)
+    if args.daemon:
+        from .dhcpcaputils import discover_ifaces
+        from .dhcpcapdaemon import DHCPCAPDaemon
+        daemon = DHCPCAPDaemon(args.interface or discover_ifaces(),
+                               server_port=SERVER_PORT,
+                               client_port=CLIENT_PORT,
+                               scriptfile=args.sf,
+                               delay_selecting=args.delay_selecting,
+                               lease_file=args.lf,
+                               offer_policy=offer_policy,
+                               script_helper=args.script_helper,
+                               hooks=hooks)
+        daemon.run()
+        return
+    from .clientscript import close_script_runner
+    from .dhcpcapfsm import DHCPCAPFSM
     dhcpcap = DHCPCAPFSM(iface=conf.iface,
                          server_port=SERVER_PORT,
                          client_port=CLIENT_PORT,
                          scriptfile=args.sf,
-                         delay_selecting=args.delay_selecting)
+                         delay_selecting=args.delay_selecting,
+                         lease_file=args.lf,
+                         offer_policy=offer_policy,
+                         script_helper=args.script_helper,
+                         hooks=hooks)
     dhcpcap.run()
+    close_script_runner()
 
 
 if __name__ == '__main__':
@@ -9,7 +9,6 @@ from __future__ import absolute_import
 import logging
 
 import attr
-from netaddr import IPNetwork
 from scapy.arch import get_if_raw_hwaddr
 from scapy.config import conf
 from scapy.layers.dhcp import BOOTP, DHCP
@@ -18,8 +17,12 @@ from scapy.layers.l2 import Ether
 from scapy.utils import mac2str, str2mac
 
 from .constants import (BROADCAST_ADDR, BROADCAST_MAC, CLIENT_PORT,
-                        DHCP_EVENTS, DHCP_OFFER_OPTIONS, META_ADDR,
-                        SERVER_PORT, PRL)
+                        DHCP_EVENTS, DHCP_OFFER_OPTIONS,
+                        DHCP_OPTION_CLIENT_ID, DHCP_OPTION_MESSAGE_TYPE,
+                        DHCP_OPTION_PRL, DHCP_OPTION_REQUESTED_ADDR,
+                        DHCP_OPTION_SERVER_ID, DHCPDISCOVER, DHCPREQUEST,
+                        META_ADDR, SERVER_PORT, PRL)
+from .dhcpcappkt import DHCPCAPReply, gen_template, mac2bytes
 from .dhcpcaputils import gen_xid
 from .dhcpcaplease import DHCPCAPLease
 
@@ -62,6 +65,8 @@ class DHCPCAP(object):
             self.xid = gen_xid()
         logger.debug('Modifying Lease obj, setting iface.')
         self.lease.interface = self.iface
+        # not an attrs attribute, so that it is not compared nor printed
+        self.templates = dict()
 
     def gen_ether_ip(self):
         """Generates link layer and IP layer part of DHCP packet.
@@ -154,7 +159,8 @@ class DHCPCAP(object):
                 "end"
             ])
         )
-        logger.debug('Generated discover %s.', dhcp_discover.summary())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Generated discover %s.', dhcp_discover.summary())
         return dhcp_discover
 
     def gen_request(self):
@@ -189,11 +195,40 @@ class DHCPCAP(object):
                 ("message-type", "request"),
                 ("client_id", mac2str(self.client_mac)),
                 ("param_req_list", self.prl),
-                ("requested_addr", self.lease.address),
-                ("server_id", self.lease.server_id),
+                ("requested_addr", self.lease.views['address']),
+                ("server_id", self.lease.views['server_id']),
                 "end"])
         )
-        logger.debug('Generated request %s.', dhcp_req.summary())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Generated request %s.', dhcp_req.summary())
+        return dhcp_req
+
+    def gen_request_reboot(self):
+        """
+        Generate DHCP REQUEST packet in INIT-REBOOT state.
+
+        [:rfc:`2131#section-4.3.2`]::
+
+            'server identifier' MUST NOT be filled in, 'requested IP address'
+            option MUST be filled in with client's notion of its previously
+            assigned address. 'ciaddr' MUST be zero.
+
+        Same comments as in gen_request apply.
+
+        """
+        dhcp_req = (
+            self.gen_ether_ip() /
+            self.gen_udp() /
+            self.gen_bootp() /
+            DHCP(options=[
+                ("message-type", "request"),
+                ("client_id", mac2str(self.client_mac)),
+                ("param_req_list", self.prl),
+                ("requested_addr", self.lease.views['address']),
+                "end"])
+        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Generated request %s.', dhcp_req.summary())
         return dhcp_req
 
     def gen_request_unicast(self):
@@ -213,7 +248,8 @@ class DHCPCAP(object):
                 ("param_req_list", self.prl),
                 "end"])
         )
-        logger.debug('Generated request %s.', dhcp_req.summary())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Generated request %s.', dhcp_req.summary())
         return dhcp_req
 
     def gen_decline(self):
@@ -240,7 +276,8 @@ class DHCPCAP(object):
                 "end"])
         )
         logger.debug('Generated decline.')
-        logger.debug(dhcp_decline.summary())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(dhcp_decline.summary())
         return dhcp_decline
 
     def gen_release(self):
@@ -266,7 +303,8 @@ class DHCPCAP(object):
                 "end"])
         )
         logger.debug('Generated release.')
-        logger.debug(dhcp_release.summary())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(dhcp_release.summary())
         return dhcp_release
 
     def gen_inform(self):
@@ -290,9 +328,86 @@ class DHCPCAP(object):
                 "end"])
         )
         logger.debug('Generated inform.')
-        logger.debug(dhcp_inform.summary())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(dhcp_inform.summary())
         return dhcp_inform
 
+    def get_template(self, message_type, unicast=False, addrs=()):
+        """Return the packet template for the given message type.
+
+        ``addrs`` are the codes of the address options, patched on every
+        transmission, that the packet contains.
+        The template is serialized again only when the fields that are not
+        patched on every transmission changed, ie. when the client is
+        reconfigured or, for unicast packets, when it gets bound.
+
+        """
+        key = (message_type, unicast, addrs)
+        invariants = (self.client_mac, self.client_port, self.server_port,
+                      self.prl)
+        if unicast:
+            invariants += (self.server_mac, self.client_ip, self.server_ip)
+        cached = self.templates.get(key)
+        if cached is not None and cached[0] == invariants:
+            return cached[1]
+        logger.debug('Generating template for message type %s.',
+                     message_type)
+        options = [
+            (DHCP_OPTION_MESSAGE_TYPE, bytes(bytearray([message_type]))),
+            (DHCP_OPTION_CLIENT_ID, mac2bytes(self.client_mac)),
+            (DHCP_OPTION_PRL, bytes(self.prl)),
+        ]
+        options += [(code, b'\x00' * 4) for code in addrs]
+        if unicast:
+            template = gen_template(self.client_mac, self.server_mac,
+                                    self.client_ip, self.server_ip,
+                                    self.client_port, self.server_port,
+                                    options, ciaddr=self.client_ip)
+        else:
+            template = gen_template(self.client_mac, BROADCAST_MAC,
+                                    META_ADDR, BROADCAST_ADDR,
+                                    self.client_port, self.server_port,
+                                    options)
+        self.templates[key] = (invariants, template)
+        return template
+
+    def gen_discover_raw(self):
+        """Generate DHCP DISCOVER packet bytes from the template.
+
+        Byte-identical to the serialization of :meth:`gen_discover`.
+
+        """
+        return self.get_template(DHCPDISCOVER).patch(self.xid)
+
+    def gen_request_raw(self):
+        """Generate DHCP REQUEST packet bytes from the template.
+
+        Byte-identical to the serialization of :meth:`gen_request`.
+
+        """
+        return self.get_template(
+            DHCPREQUEST,
+            addrs=(DHCP_OPTION_REQUESTED_ADDR, DHCP_OPTION_SERVER_ID)).patch(
+            self.xid, self.lease.address, self.lease.server_id)
+
+    def gen_request_reboot_raw(self):
+        """Generate DHCP REQUEST packet bytes in INIT-REBOOT state.
+
+        Byte-identical to the serialization of :meth:`gen_request_reboot`.
+
+        """
+        return self.get_template(
+            DHCPREQUEST, addrs=(DHCP_OPTION_REQUESTED_ADDR,)).patch(
+            self.xid, self.lease.address)
+
+    def gen_request_unicast_raw(self):
+        """Generate DHCP REQUEST unicast packet bytes from the template.
+
+        Byte-identical to the serialization of :meth:`gen_request_unicast`.
+
+        """
+        return self.get_template(DHCPREQUEST, unicast=True).patch(self.xid)
+
     def gen_check_lease_attrs(self, attrs_dict):
         """Generate network mask in CIDR format and subnet.
 
@@ -300,6 +415,8 @@ class DHCPCAP(object):
         will be raised and catched in the FSM.
 
         """
+        # NOTE: netaddr is only needed once an offer is received
+        from netaddr import IPNetwork
         # without some minimal options given by the server, is not possible
         # to create new lease
         assert attrs_dict['subnet_mask']
@@ -337,18 +454,32 @@ class DHCPCAP(object):
         return attrs_dict
 
     def handle_offer_ack(self, pkt, time_sent_request=None):
-        """Create a lease object with the values in OFFER/ACK packet."""
-        attrs_dict = dict()
-        for opt in pkt[DHCP].options:
-            if isinstance(opt, tuple) and opt[0] in DHCP_OFFER_OPTIONS:
-                v = opt[1] if len(opt[1:]) < 2 else ' '.join(opt[1:])
-                v = str(v.decode('utf8')) if isinstance(v, bytes) else str(v)
-                attrs_dict[opt[0]] = v
-        attrs_dict.update({
-            "interface": self.iface,
-            "address": pkt[BOOTP].yiaddr,
-            "next_server": pkt[BOOTP].siaddr,
-        })
+        """Create a lease object with the values in OFFER/ACK packet.
+
+        The packet is either a :class:`dhcpcappkt.DHCPCAPReply` or a scapy
+        packet.
+
+        """
+        if isinstance(pkt, DHCPCAPReply):
+            attrs_dict = pkt.options_attrs()
+            attrs_dict.update({
+                "interface": self.iface,
+                "address": pkt.address,
+                "next_server": pkt.next_server,
+            })
+        else:
+            attrs_dict = dict()
+            for opt in pkt[DHCP].options:
+                if isinstance(opt, tuple) and opt[0] in DHCP_OFFER_OPTIONS:
+                    v = opt[1] if len(opt[1:]) < 2 else ' '.join(opt[1:])
+                    v = str(v.decode('utf8')) if isinstance(v, bytes) \
+                        else str(v)
+                    attrs_dict[opt[0]] = v
+            attrs_dict.update({
+                "interface": self.iface,
+                "address": pkt[BOOTP].yiaddr,
+                "next_server": pkt[BOOTP].siaddr,
+            })
         # this function changes the dict
         self.gen_check_lease_attrs(attrs_dict)
         logger.debug('Creating Lease obj.')
@@ -362,19 +493,24 @@ class DHCPCAP(object):
         logger.debug('Modifying obj DHCPCAP, setting lease.')
         self.lease = self.handle_offer_ack(pkt)
 
-    def handle_ack(self, pkt, time_sent_request):
+    def handle_ack(self, pkt, time_sent_request, sent_time=None):
         """."""
         logger.debug("Handling ACK.")
         logger.debug('Modifying obj DHCPCAP, setting server data.')
-        self.server_mac = pkt[Ether].src
-        self.server_ip = pkt[IP].src
-        self.server_port = pkt[UDP].sport
+        if isinstance(pkt, DHCPCAPReply):
+            self.server_mac = pkt.server_mac
+            self.server_ip = pkt.server_ip
+            self.server_port = pkt.server_port
+        else:
+            self.server_mac = pkt[Ether].src
+            self.server_ip = pkt[IP].src
+            self.server_port = pkt[UDP].sport
         event = DHCP_EVENTS['IP_ACQUIRE']
         # FIXME:0 check the fields match the previously offered ones?
         # FIXME:50 create a new object also on renewing/rebinding
         # or only set_times?
         lease = self.handle_offer_ack(pkt, time_sent_request)
-        lease.set_times(time_sent_request)
+        lease.set_times(time_sent_request, sent_time)
         if self.lease is not None:
             if (self.lease.address != lease.address or
                     self.lease.subnet_mask != lease.subnet_mask or
@@ -384,6 +520,6 @@ class DHCPCAP(object):
                 event = DHCP_EVENTS['RENEW']
         logger.debug('Modifying obj DHCPCAP, setting lease, client ip, event.')
         self.lease = lease
-        self.client_ip = self.lease.address
+        self.client_ip = self.lease.views['address']
         self.event = event
         return event
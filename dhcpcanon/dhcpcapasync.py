@@ -0,0 +1,557 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab
+# Copyright 2016, 2017 juga (juga at riseup dot net), MIT license.
+"""DCHP client implementation of the Anonymity Profiles [:rfc:`7844`] on
+asyncio.
+
+:class:`DHCPCAPAsyncFSM` has the same states and transitions as
+:class:`dhcpcapfsm.DHCPCAPFSM`, but instead of a scapy Automaton, with a
+thread and a select loop per client, it is driven by an asyncio event loop:
+the listening socket is watched with ``loop.add_reader`` and the timeouts are
+kept in a :class:`timers.TimerHeap`. Many clients can run on the same loop
+and share the same timer heap.
+
+"""
+from __future__ import absolute_import, unicode_literals
+
+import asyncio
+import logging
+
+from scapy.data import MTU
+
+from .clientscript import ClientScript, get_runner
+from .constants import (CLIENT_PORT, MAX_ATTEMPTS_DISCOVER,
+                        MAX_ATTEMPTS_REBOOT, MAX_ATTEMPTS_REQUEST,
+                        MAX_OFFERS_COLLECTED, REASON_EXPIRE, SERVER_PORT,
+                        STATE_BOUND, STATE_END, STATE_ERROR, STATE_INIT,
+                        STATE_INIT_REBOOT, STATE_PREINIT, STATE_REBINDING,
+                        STATE_REBOOTING, STATE_RENEWING, STATE_REQUESTING,
+                        STATE_SELECTING, STATES2NAMES, STATES2REASONS)
+from .dhcpcap import DHCPCAP
+from .dhcpcaplease import read_lease, remove_lease, write_lease
+from .dhcpcappkt import parse_reply, pkt2bytes
+from .dhcpcapsock import RawTransport, gen_bpf
+from .dhcpcaputils import get_client_mac, isack, isnak, isoffer
+from .hooks import call_hooks
+from .netutils import set_net
+from .offers import Offer, gen_offer_policy
+from .timers import (TimerHeap, gen_delay_selecting,
+                     gen_timeout_request_rebind, gen_timeout_request_renew,
+                     gen_timeout_resend, monotime, nowutc)
+
+logger = logging.getLogger(__name__)
+
+# timers that are cancelled on every state change
+RETRANSMISSION_TIMER = 'retransmission'
+# timers that are only cancelled when a new lease is bound or on INIT
+LEASE_TIMERS = ['renewing', 'rebinding', 'expiry']
+
+
+class DHCPCAPAsyncFSM(object):
+    """DHCP client Finite State Machine (FSM) on an asyncio event loop.
+
+    The sockets are opened on :meth:`start` with ``transport``, by default a
+    :class:`dhcpcapsock.RawTransport`, unless they are given. They only
+    need ``fileno``, ``recv`` and ``send`` methods.
+    Without ``scheduler``, a :class:`timers.TimerHeap` is created for this
+    client.
+    When ``lease_file`` is given, the leases are stored there and a stored
+    lease that has not expired is requested in INIT-REBOOT state.
+    ``offer_policy`` selects the offer to request, see :mod:`offers`.
+    With ``script_helper``, the script is started once and the transitions
+    are sent to it, see :class:`clientscript.HookHelper`.
+    ``hooks`` are called every time the script would be, see :mod:`hooks`.
+
+    """
+
+    def __init__(self, iface=None, server_port=None, client_port=None,
+                 client_mac=None, xid=None, scriptfile=None,
+                 delay_selecting=False, delay_before_selecting=None,
+                 timeout_select=None, listen_sock=None, send_sock=None,
+                 loop=None, scheduler=None, lease_file=None,
+                 offer_policy=None, script_helper=False, hooks=None,
+                 transport=None):
+        logger.debug('Inizializating async FSM.')
+        self.loop = loop or asyncio.get_event_loop()
+        self.scheduler = scheduler or TimerHeap(self.loop)
+        self.iface = iface
+        if client_mac is None:
+            client_mac = get_client_mac(iface)
+        self.client_mac = client_mac
+        self.server_port = server_port or SERVER_PORT
+        self.client_port = client_port or CLIENT_PORT
+        self.delay_selecting = delay_selecting
+        self.delay_before_selecting = delay_before_selecting
+        self.timeout_select = timeout_select
+        self.lease_file = lease_file
+        self.offer_policy = offer_policy or gen_offer_policy()
+        self.listen_sock = listen_sock
+        self.send_sock = send_sock
+        self.transport = transport or RawTransport()
+        self.timers = dict()
+        self.bound = None
+        self.hooks = hooks or []
+        if scriptfile is not None:
+            self.script = ClientScript(
+                scriptfile, runner=get_runner(scriptfile, script_helper),
+                callback=self.script_done)
+        else:
+            self.script = None
+        self.reset(xid)
+        self.current_state = STATE_PREINIT
+        self.run_script()
+
+    def __str__(self):
+        return str({'current_state': self.current_state,
+                    'discover_attempts': self.discover_attempts,
+                    'request_attempts': self.request_attempts,
+                    'time_sent_request': self.time_sent_request,
+                    'client': self.client})
+
+    def reset(self, xid=None):
+        """Reset object attributes when state is INIT."""
+        logger.debug('Reseting attributes.')
+        self.client = DHCPCAP(iface=self.iface, client_mac=self.client_mac,
+                              xid=xid)
+        self.iface = self.client.iface
+        self.client.server_port = self.server_port
+        self.client.client_port = self.client_port
+        self.time_sent_request = None
+        self.time_sent_request_mono = None
+        self.time_sent_discover = None
+        self.discover_attempts = 0
+        self.request_attempts = 0
+        self.offers = list()
+
+    def start(self):
+        """Open the sockets, if not given, and enter in INIT state."""
+        if self.listen_sock is None:
+            self.listen_sock = self.transport.listen_socket(iface=self.iface)
+        if self.send_sock is None:
+            self.send_sock = self.transport.send_socket(iface=self.iface)
+        self.bound = asyncio.Event()
+        self.loop.add_reader(self.listen_sock.fileno(), self.on_readable)
+        self.INIT()
+
+    def stop(self):
+        """Close the sockets and cancel the timers, entering in END state."""
+        if self.current_state == STATE_END:
+            logger.debug('Already stopped.')
+            return
+        if self.listen_sock is not None:
+            self.loop.remove_reader(self.listen_sock.fileno())
+        self.close()
+        self.cancel_timers(LEASE_TIMERS + [RETRANSMISSION_TIMER])
+        self.END()
+
+    def close(self):
+        """Close the sockets, they are opened again by :meth:`start`."""
+        for sock in (self.listen_sock, self.send_sock):
+            if sock is not None:
+                sock.close()
+        self.listen_sock = None
+        self.send_sock = None
+
+    async def wait_bound(self):
+        """Wait until the client gets a lease."""
+        await self.bound.wait()
+
+    def run_script(self, reason=None):
+        """Call the hooks and the script, when there is one, for the
+        current state or ``reason``.
+
+        Return whether there is a script.
+
+        """
+        state = reason or self.current_state
+        call_hooks(self.hooks, self.client.lease,
+                   STATES2REASONS.get(state, state))
+        if self.script is not None:
+            self.script.script_init(self.client.lease, state)
+            self.script.script_go()
+            return True
+        return False
+
+    def script_done(self, reason, returncode):
+        """Report a finished script to the event loop, from its thread."""
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.on_script_done, reason,
+                                           returncode)
+
+    def on_script_done(self, reason, returncode):
+        if returncode != 0:
+            logger.warning('(%s) script for %s exited with %s.', self.iface,
+                           reason, returncode)
+        else:
+            logger.debug('(%s) script for %s finished.', self.iface, reason)
+
+    def configure(self):
+        """Configure the network with the script or with set_net."""
+        if not self.run_script():
+            try:
+                set_net(self.client.lease)
+            except Exception:
+                logger.error('Can not set IP', exc_info=True)
+
+    def load_lease(self):
+        """Load the stored lease, if it can be reused in INIT-REBOOT."""
+        if self.lease_file is None:
+            return None
+        lease = read_lease(self.client.iface, self.client.client_mac,
+                           self.lease_file)
+        if lease is not None:
+            logger.debug('Found lease for %s in %s.', lease.address,
+                         self.lease_file)
+            self.client.lease = lease
+        return lease
+
+    def forget_lease(self):
+        """Remove the stored lease.
+
+        See :func:`dhcpcapfsm.DHCPCAPFSM.forget_lease`.
+
+        """
+        if self.lease_file is None:
+            return
+        try:
+            remove_lease(self.client.iface, self.lease_file)
+        except (IOError, OSError) as e:
+            logger.error('Can not write lease file %s: %s',
+                         self.lease_file, e)
+
+    def store_lease(self):
+        """Store the lease, when there is a lease file."""
+        if self.lease_file is None:
+            return
+        try:
+            write_lease(self.client.lease, self.client.client_mac,
+                        self.lease_file)
+        except (IOError, OSError) as e:
+            logger.error('Can not write lease file %s: %s',
+                         self.lease_file, e)
+
+    # TIMERS
+    #########
+
+    def set_timer(self, name, delay, callback):
+        """Call ``callback`` after ``delay`` seconds, replacing timer name."""
+        self.cancel_timers([name])
+        self.timers[name] = self.scheduler.call_later(delay, callback)
+        logger.debug('Set timer %s in %s to %s.', name,
+                     STATES2NAMES[self.current_state], delay)
+
+    def cancel_timers(self, names):
+        for name in names:
+            timer = self.timers.pop(name, None)
+            if timer is not None:
+                timer.cancel()
+
+    # SEND
+    #######
+
+    def attach_filter(self):
+        """Attach a BPF filter for the current xid, when supported.
+
+        See :func:`dhcpcapfsm.DHCPCAPFSM.attach_filter`.
+
+        """
+        if not hasattr(self.listen_sock, 'attach_filter'):
+            return
+        self.listen_sock.attach_filter(
+            gen_bpf(self.client.client_mac, self.client.client_port,
+                    self.client.server_port, self.client.xid))
+
+    def send_discover(self):
+        """Send discover and set the timeout to retransmit it."""
+        self.send_sock.send(self.client.gen_discover_raw())
+        self.time_sent_discover = self.loop.time()
+        if self.discover_attempts < MAX_ATTEMPTS_DISCOVER:
+            self.discover_attempts += 1
+        timeout = self.timeout_select or \
+            gen_timeout_resend(self.discover_attempts)
+        self.set_timer(RETRANSMISSION_TIMER, timeout, self.timeout_selecting)
+
+    def send_request(self):
+        """Send request and set the timeout to retransmit it.
+
+        See :func:`dhcpcapfsm.DHCPCAPFSM.send_request`.
+
+        """
+        if self.current_state == STATE_RENEWING:
+            frame = self.client.gen_request_unicast_raw()
+        elif self.current_state == STATE_REBOOTING:
+            frame = self.client.gen_request_reboot_raw()
+        else:
+            frame = self.client.gen_request_raw()
+        self.send_sock.send(frame)
+        self.time_sent_request = nowutc()
+        self.time_sent_request_mono = monotime()
+        logger.info('DHCPREQUEST of %s on %s to %s port %s',
+                    self.client.client_ip, self.client.iface,
+                    self.client.server_ip, self.client.server_port)
+        self.request_attempts += 1
+        if self.current_state == STATE_RENEWING:
+            self.set_timer(RETRANSMISSION_TIMER,
+                           gen_timeout_request_renew(self.client.lease),
+                           self.send_request)
+        elif self.current_state == STATE_REBINDING:
+            self.set_timer(RETRANSMISSION_TIMER,
+                           gen_timeout_request_rebind(self.client.lease),
+                           self.send_request)
+        elif self.current_state == STATE_REBOOTING:
+            self.set_timer(RETRANSMISSION_TIMER,
+                           gen_timeout_resend(self.request_attempts),
+                           self.timeout_rebooting)
+        else:
+            self.set_timer(RETRANSMISSION_TIMER,
+                           gen_timeout_resend(self.request_attempts),
+                           self.timeout_requesting)
+
+    # RECEIVE
+    ##########
+
+    def on_readable(self):
+        """Receive a frame and run the receive condition of the state."""
+        try:
+            pkt = self.listen_sock.recv(MTU)
+        except (BlockingIOError, InterruptedError):
+            return
+        if pkt is None:
+            return
+        reply = parse_reply(pkt2bytes(pkt))
+        if reply is None or reply.xid != self.client.xid:
+            return
+        if self.current_state == STATE_SELECTING:
+            if isoffer(reply):
+                self.receive_offer(reply)
+        elif self.current_state in (STATE_REQUESTING, STATE_RENEWING,
+                                    STATE_REBINDING, STATE_REBOOTING):
+            if isack(reply):
+                self.receive_ack(reply)
+            elif isnak(reply):
+                logger.info('DHCPNAK of %s from %s',
+                            self.client.client_ip, self.client.server_ip)
+                if self.current_state == STATE_REBOOTING:
+                    self.forget_lease()
+                self.INIT()
+
+    def receive_offer(self, reply):
+        """Receive offer on SELECTING state."""
+        logger.debug('C2: T, OFFER received')
+        latency = 0.0
+        if self.time_sent_discover is not None:
+            latency = self.loop.time() - self.time_sent_discover
+        offer = Offer(reply, latency)
+        if not self.offer_policy.acceptable(offer):
+            logger.debug('OFFER not acceptable.')
+            return
+        self.offers.append(offer)
+        if self.offer_policy.satisfies(offer) or \
+                len(self.offers) >= MAX_OFFERS_COLLECTED:
+            self.select_offer()
+            self.REQUESTING()
+            self.send_request()
+        elif len(self.offers) == 1:
+            # the window replaces the DISCOVER retransmission
+            self.set_timer(RETRANSMISSION_TIMER, self.offer_policy.window,
+                           self.timeout_selecting)
+
+    def select_offer(self):
+        """Select an offer from the offers received.
+
+        See :func:`dhcpcapfsm.DHCPCAPFSM.select_offer`.
+
+        """
+        offer = self.offer_policy.select(self.offers)
+        self.client.handle_offer(offer.reply)
+
+    def receive_ack(self, reply):
+        """Receive ACK on REQUESTING, RENEWING or REBINDING states."""
+        from netaddr import AddrFormatError
+        try:
+            self.client.handle_ack(reply, self.time_sent_request,
+                                   self.time_sent_request_mono)
+        except AddrFormatError as err:
+            logger.error(err)
+            self.SELECTING()
+            self.send_discover()
+            return
+        logger.info('DHCPACK of %s from %s',
+                    self.client.client_ip, self.client.server_ip)
+        self.BOUND()
+
+    # TIMEOUTS
+    ###########
+
+    def timeout_delay_before_selecting(self):
+        """Timeout delay selecting in INIT state."""
+        self.SELECTING()
+        self.send_discover()
+
+    def timeout_selecting(self):
+        """Timeout of selecting on SELECTING state.
+
+        See :func:`dhcpcapfsm.DHCPCAPFSM.timeout_selecting`.
+
+        """
+        if len(self.offers) > 0:
+            self.select_offer()
+            self.REQUESTING()
+            self.send_request()
+        elif self.discover_attempts >= MAX_ATTEMPTS_DISCOVER:
+            self.ERROR()
+        else:
+            self.send_discover()
+
+    def timeout_requesting(self):
+        """Timeout requesting in REQUESTING state."""
+        if self.request_attempts >= MAX_ATTEMPTS_REQUEST:
+            logger.debug('Maximum number %s of REQUESTs reached.',
+                         MAX_ATTEMPTS_REQUEST)
+            self.ERROR()
+            return
+        self.send_request()
+
+    def timeout_rebooting(self):
+        """Timeout requesting in REBOOTING state.
+
+        See :func:`dhcpcapfsm.DHCPCAPFSM.timeout_request_rebooting`.
+
+        """
+        if self.request_attempts >= MAX_ATTEMPTS_REBOOT:
+            logger.debug('Maximum number %s of REQUESTs reached.',
+                         MAX_ATTEMPTS_REBOOT)
+            self.INIT()
+            return
+        self.send_request()
+
+    def renewing_time_expires(self):
+        """Timeout renewing time (T1), transition to RENEWING."""
+        self.RENEWING()
+        self.send_request()
+
+    def rebinding_time_expires(self):
+        """Timeout rebinding time (T2), transition to REBINDING."""
+        self.REBINDING()
+        self.send_request()
+
+    def lease_expires(self):
+        """Timeout lease time, transition to INIT.
+
+        See :func:`dhcpcapfsm.DHCPCAPFSM.lease_expires`.
+
+        """
+        self.run_script(REASON_EXPIRE)
+        self.INIT()
+
+    # STATES
+    #########
+
+    def INIT(self):
+        """INIT state.
+
+        See :func:`dhcpcapfsm.DHCPCAPFSM.INIT`.
+
+        """
+        logger.debug('In state: INIT')
+        self.cancel_timers(LEASE_TIMERS + [RETRANSMISSION_TIMER])
+        if self.current_state is not STATE_PREINIT:
+            self.reset()
+        self.attach_filter()
+        self.bound.clear()
+        if self.current_state is STATE_PREINIT and self.load_lease():
+            self.INIT_REBOOT()
+            return
+        self.current_state = STATE_INIT
+        if self.delay_selecting:
+            if self.delay_before_selecting is None:
+                delay_before_selecting = gen_delay_selecting()
+            else:
+                delay_before_selecting = self.delay_before_selecting
+        else:
+            delay_before_selecting = 0
+        self.set_timer(RETRANSMISSION_TIMER, delay_before_selecting,
+                       self.timeout_delay_before_selecting)
+
+    def INIT_REBOOT(self):
+        """INIT-REBOOT state.
+
+        See :func:`dhcpcapfsm.DHCPCAPFSM.INIT_REBOOT`.
+
+        """
+        logger.debug('In state: INIT_REBOOT')
+        self.current_state = STATE_INIT_REBOOT
+        self.REBOOTING()
+        self.send_request()
+
+    def REBOOTING(self):
+        """REBOOTING state."""
+        logger.debug('In state: REBOOTING')
+        self.current_state = STATE_REBOOTING
+        self.request_attempts = 0
+
+    def SELECTING(self):
+        """SELECTING state."""
+        logger.debug('In state: SELECTING')
+        self.current_state = STATE_SELECTING
+
+    def REQUESTING(self):
+        """REQUESTING state."""
+        logger.debug('In state: REQUESTING')
+        self.current_state = STATE_REQUESTING
+        self.request_attempts = 0
+
+    def BOUND(self):
+        """BOUND state.
+
+        The renewing (T1), rebinding (T2) and lease expiry timers are set
+        to the lease times, which are relative to when the request was sent,
+        see :meth:`dhcpcaplease.DHCPCAPLease.set_times`.
+
+        """
+        logger.debug('In state: BOUND')
+        logger.info('(%s) state changed %s -> bound', self.client.iface,
+                    STATES2NAMES[self.current_state])
+        self.cancel_timers(LEASE_TIMERS + [RETRANSMISSION_TIMER])
+        self.current_state = STATE_BOUND
+        self.client.lease.info_lease()
+        self.store_lease()
+        self.configure()
+        lease = self.client.lease
+        self.set_timer('renewing', lease.time_left('renew'),
+                       self.renewing_time_expires)
+        self.set_timer('rebinding', lease.time_left('rebind'),
+                       self.rebinding_time_expires)
+        self.set_timer('expiry', lease.time_left('expiry'),
+                       self.lease_expires)
+        self.bound.set()
+
+    def RENEWING(self):
+        """RENEWING state."""
+        logger.debug('In state: RENEWING')
+        self.cancel_timers([RETRANSMISSION_TIMER])
+        self.current_state = STATE_RENEWING
+        self.request_attempts = 0
+        self.configure()
+
+    def REBINDING(self):
+        """REBINDING state."""
+        logger.debug('In state: REBINDING')
+        self.cancel_timers([RETRANSMISSION_TIMER])
+        self.current_state = STATE_REBINDING
+        self.request_attempts = 0
+        self.configure()
+
+    def END(self):
+        """END state."""
+        logger.debug('In state: END')
+        self.current_state = STATE_END
+        self.run_script()
+
+    def ERROR(self):
+        """ERROR state."""
+        logger.debug('In state: ERROR')
+        self.cancel_timers([RETRANSMISSION_TIMER])
+        self.current_state = STATE_ERROR
+        self.run_script()
+        self.INIT()
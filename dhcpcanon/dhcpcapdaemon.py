@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# Copyright 2016, 2017 juga (juga at riseup dot net), MIT license.
+"""Daemon mode of the DHCP client implementation of the Anonymity Profile
+([:rfc:`7844`]).
+
+One :class:`dhcpcapasync.DHCPCAPAsyncFSM` runs per interface, all of them on
+the same asyncio event loop and with the same :class:`timers.TimerHeap`, so
+that a host with several interfaces only loads the libraries and the logging
+configuration once, and the process only wakes up for the next deadline of
+all the clients.
+
+"""
+from __future__ import absolute_import
+
+import asyncio
+import logging
+import signal
+
+from .clientscript import close_script_runner
+from .dhcpcapasync import DHCPCAPAsyncFSM
+from .netutils import close_dns, close_netlink
+from .timers import TimerHeap
+
+logger = logging.getLogger(__name__)
+
+
+class DHCPCAPDaemon(object):
+    """Run a DHCP client per interface in a single process.
+
+    The keyword arguments are passed to every
+    :class:`dhcpcapasync.DHCPCAPAsyncFSM`.
+
+    """
+
+    def __init__(self, ifaces=None, loop=None, **kwargs):
+        self.loop = loop or asyncio.new_event_loop()
+        self.scheduler = TimerHeap(self.loop)
+        self.kwargs = kwargs
+        self.fsms = dict()
+        self.running = False
+        for iface in ifaces or []:
+            self.add_iface(iface)
+
+    def add_iface(self, iface, **kwargs):
+        """Add a client for ``iface``, starting it if the daemon runs.
+
+        ``kwargs`` override the daemon keyword arguments for this interface.
+
+        """
+        if iface in self.fsms:
+            logger.debug('Interface %s is already managed.', iface)
+            return self.fsms[iface]
+        fsm_kwargs = dict(self.kwargs)
+        fsm_kwargs.update(kwargs)
+        fsm = DHCPCAPAsyncFSM(iface=iface, loop=self.loop,
+                              scheduler=self.scheduler, **fsm_kwargs)
+        self.fsms[iface] = fsm
+        logger.info('Managing interface %s.', iface)
+        if self.running and not self.start_iface(iface):
+            return None
+        return fsm
+
+    def start_iface(self, iface):
+        """Start the client for ``iface``, removing it when it fails.
+
+        The other clients keep running, ie. when the interface disappeared.
+
+        """
+        fsm = self.fsms[iface]
+        try:
+            fsm.start()
+        except OSError as e:
+            logger.error('Can not start the client for %s: %s', iface, e)
+            fsm.close()
+            del self.fsms[iface]
+            return False
+        return True
+
+    def remove_iface(self, iface):
+        """Stop and remove the client for ``iface``."""
+        fsm = self.fsms.pop(iface)
+        if self.running:
+            fsm.stop()
+        logger.info('Not managing interface %s anymore.', iface)
+
+    def start(self):
+        """Start the clients of all the interfaces."""
+        self.running = True
+        for iface in list(self.fsms):
+            self.start_iface(iface)
+
+    def stop(self):
+        """Stop the clients of all the interfaces."""
+        for fsm in self.fsms.values():
+            fsm.stop()
+        self.scheduler.close()
+        close_netlink()
+        close_dns()
+        close_script_runner()
+        self.running = False
+
+    def shutdown(self):
+        """Stop the clients and the event loop."""
+        logger.info('Shutting down.')
+        self.stop()
+        self.loop.stop()
+
+    def run(self):
+        """Run the clients until SIGINT or SIGTERM is received."""
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, self.shutdown)
+        self.start()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
@@ -6,28 +6,33 @@ from __future__ import absolute_import, unicode_literals
 
 import logging
 
-from netaddr import AddrFormatError
-from scapy.arch import get_if_raw_hwaddr
 from scapy.automaton import ATMT, Automaton
 from scapy.config import conf
 from scapy.sendrecv import sendp
-from scapy.utils import str2mac
 
-from .clientscript import ClientScript
+from .clientscript import ClientScript, get_runner
 from .constants import (CLIENT_PORT, DELAY_SELECTING, FSM_ATTRS, LEASE_TIME,
-                        MAX_ATTEMPTS_DISCOVER, MAX_ATTEMPTS_REQUEST,
-                        MAX_OFFERS_COLLECTED, REBINDING_TIME, RENEWING_TIME,
+                        MAX_ATTEMPTS_DISCOVER, MAX_ATTEMPTS_REBOOT,
+                        MAX_ATTEMPTS_REQUEST, MAX_OFFERS_COLLECTED,
+                        REASON_EXPIRE, REBINDING_TIME, RENEWING_TIME,
                         SERVER_PORT, STATE_BOUND, STATE_END, STATE_ERROR,
-                        STATE_INIT, STATE_PREINIT, STATE_REBINDING,
-                        STATE_RENEWING, STATE_REQUESTING, STATE_SELECTING,
-                        STATES2NAMES, TIMEOUT_REQUEST_REBINDING,
-                        TIMEOUT_REQUEST_RENEWING, TIMEOUT_REQUESTING,
-                        TIMEOUT_SELECTING)
+                        STATE_INIT, STATE_INIT_REBOOT, STATE_PREINIT,
+                        STATE_REBINDING, STATE_REBOOTING, STATE_RENEWING,
+                        STATE_REQUESTING, STATE_SELECTING, STATES2NAMES,
+                        STATES2REASONS, TIMEOUT_REBOOTING,
+                        TIMEOUT_REQUEST_REBINDING, TIMEOUT_REQUEST_RENEWING,
+                        TIMEOUT_REQUESTING, TIMEOUT_SELECTING)
 from .dhcpcap import DHCPCAP
-from .dhcpcaputils import isack, isnak, isoffer
+from .dhcpcaplease import read_lease, remove_lease, write_lease
+from .dhcpcappkt import parse_reply, pkt2bytes
+from .dhcpcapsock import RawTransport, gen_bpf
+from .dhcpcaputils import get_client_mac, isack, isnak, isoffer
 from .timers import (gen_delay_selecting, gen_timeout_request_rebind,
-                     gen_timeout_request_renew, gen_timeout_resend, nowutc)
+                     gen_timeout_request_renew, gen_timeout_resend, monotime,
+                     nowutc)
+from .hooks import call_hooks
 from .netutils import set_net
+from .offers import Offer, gen_offer_policy
 
 logger = logging.getLogger(__name__)
 
@@ -45,35 +50,32 @@ class DHCPCAPFSM(Automaton):
     def __eq__(self, other):
         return self.__dict__ == other.__dict__
 
-    def reset(self, iface=None, client_mac=None, xid=None, scriptfile=None):
-        """Reset object attributes when state is INIT."""
+    def reset(self, xid=None):
+        """Reset object attributes when state is INIT.
+
+        The interface, link-layer address, ports and script are kept.
+
+        """
         logger.debug('Reseting attributes.')
-        if iface is None:
-            iface = conf.iface
-        if client_mac is None:
-            # scapy for python 3 returns byte, not tuple
-            tempmac = get_if_raw_hwaddr(iface)
-            if isinstance(tempmac, tuple) and len(tempmac) == 2:
-                mac = tempmac[1]
-            else:
-                mac = tempmac
-            client_mac = str2mac(mac)
-        self.client = DHCPCAP(iface=iface, client_mac=client_mac, xid=xid)
-        if scriptfile is not None:
-            self.script = ClientScript(scriptfile)
-        else:
-            self.script = None
+        self.client = DHCPCAP(iface=self.iface, client_mac=self.client_mac,
+                              xid=xid)
+        self.client.server_port = self.server_port
+        self.client.client_port = self.client_port
         self.time_sent_request = None
+        self.time_sent_request_mono = None
+        self.time_sent_discover = None
         self.discover_attempts = 0
         self.request_attempts = 0
-        self.current_state = STATE_PREINIT
         self.offers = list()
+        self.reply = None
 
     def __init__(self, iface=None, server_port=None,
                  client_port=None, client_mac=None, xid=None,
                  scriptfile=None, delay_selecting=False,
                  delay_before_selecting=None,
-                 timeout_select=None, debug_level=5, *args, **kargs):
+                 timeout_select=None, debug_level=5, lease_file=None,
+                 offer_policy=None, script_helper=False, hooks=None,
+                 transport=None, *args, **kargs):
         """Overwrites Automaton __init__ method.
 
         [ :rfc:`7844#section-3.4` ] ::
@@ -81,28 +83,86 @@ class DHCPCAPFSM(Automaton):
             randomized value, the DHCP client SHOULD use the new randomized
             value in the DHCP messages
 
+        When ``lease_file`` is given, the leases are stored there and a
+        stored lease that has not expired is requested in INIT-REBOOT state.
+        ``offer_policy`` selects the offer to request, see :mod:`offers`.
+        With ``script_helper``, the script is started once and the
+        transitions are sent to it, see :class:`clientscript.HookHelper`.
+        ``hooks`` are called every time the script would be, see
+        :mod:`hooks`.
+        The sockets are opened with ``transport``, by default a
+        :class:`dhcpcapsock.RawTransport`.
+
         """
         logger.debug('Inizializating FSM.')
+        transport = transport or RawTransport()
+        # listen without dissecting the frames, see master_filter
+        kargs.setdefault('recvsock', transport.listen_socket)
+        # the Automaton opens the send socket once when it starts running,
+        # and it is reused for every frame sent, see send_frame
+        kargs.setdefault('ll', transport.send_socket)
+        kargs.setdefault('iface', iface or conf.iface)
         super(DHCPCAPFSM, self).__init__(*args, **kargs)
         self.debug_level = debug_level
         self.delay_selecting = delay_selecting
         self.delay_before_selecting = delay_before_selecting
         self.timeout_select = timeout_select
-        self.reset(iface, client_mac, xid, scriptfile)
-        self.client.server_port = server_port or SERVER_PORT
-        self.client.client_port = client_port or CLIENT_PORT
-        self.socket_kargs = {
-            'filter': 'udp and src port {0} and dst port {1}'
-                      ' and ether dst {2}'.
-                      format(self.client.server_port,
-                             self.client.client_port,
-                             self.client.client_mac)
-        }
+        self.lease_file = lease_file
+        self.offer_policy = offer_policy or gen_offer_policy()
+        self.script_helper = script_helper
+        self.hooks = hooks or []
+        self.iface = iface or conf.iface
+        self.client_mac = client_mac or get_client_mac(self.iface)
+        self.server_port = server_port or SERVER_PORT
+        self.client_port = client_port or CLIENT_PORT
+        if scriptfile is not None:
+            self.script = ClientScript(
+                scriptfile, runner=get_runner(scriptfile, self.script_helper))
+        else:
+            self.script = None
+        self.reset(xid)
+        # the stored lease is only requested when INIT is entered first
+        self.current_state = STATE_PREINIT
+        self.run_hooks()
         if self.script is not None:
             self.script.script_init(self.client.lease, self.current_state)
             self.script.script_go()
         logger.debug('FSM thread id: %s.', self.threadid)
 
+    def run_hooks(self, reason=None):
+        """Call the hooks for the current state or ``reason``."""
+        call_hooks(self.hooks, self.client.lease,
+                   reason or STATES2REASONS[self.current_state])
+
+    def master_filter(self, pkt):
+        """Overwrites Automaton master_filter method.
+
+        Parse the received frame once with :func:`dhcpcappkt.parse_reply`
+        and drop it when it is not a DHCP reply, before any receive
+        condition runs. The receive conditions use the parsed reply stored
+        in ``self.reply``.
+
+        """
+        self.reply = parse_reply(pkt2bytes(pkt))
+        return self.reply is not None
+
+    def attach_filter(self):
+        """Attach a BPF filter for the current xid to the listening socket.
+
+        It replaces the tcpdump filter
+        ``udp and src port 67 and dst port 68 and ether dst client_mac``,
+        checking also that the frame is a BOOTP reply with our xid, so that
+        the rest of frames are dropped in the kernel.
+        It has to be called every time the xid changes.
+
+        """
+        listen_sock = getattr(self, 'listen_sock', None)
+        if not hasattr(listen_sock, 'attach_filter'):
+            return
+        bpf = gen_bpf(self.client.client_mac, self.client.client_port,
+                      self.client.server_port, self.client.xid)
+        listen_sock.attach_filter(bpf)
+
     def get_timeout(self, state, function):
         """Workaround to get timeout in the ATMT.timeout class method."""
         state = STATES2NAMES[state]
@@ -142,16 +202,36 @@ class DHCPCAPFSM(Automaton):
                 # set the new timeoute to self.timeout
                 i = self.timeout[state].index(timeout_fn_t)
                 self.timeout[state][i] = tuple(timeout_l)
+                # the Automaton waits for the timeouts in order, with
+                # (None, None) the last one
+                self.timeout[state].sort(
+                    key=lambda t: (t[0] is None, t[0] or 0))
                 logger.debug('Set state %s, function %s, to timeout %s',
                              state, function.atmt_condname, newtimeout)
+                break
+
+    def send_frame(self, frame):
+        """Send a frame through the Automaton's long-lived send socket.
+
+        If the Automaton is not running, and then it does not have the
+        socket, fall back to sendp, which opens a new socket every time.
+
+        """
+        send_sock = getattr(self, 'send_sock', None)
+        if send_sock is not None and \
+                not getattr(send_sock, 'closed', False):
+            send_sock.send(frame)
+        else:
+            sendp(conf.raw_layer(load=frame), iface=self.client.iface,
+                  verbose=False)
 
     def send_discover(self):
         """Send discover."""
         assert self.client
         assert self.current_state == STATE_INIT or \
             self.current_state == STATE_SELECTING
-        pkt = self.client.gen_discover()
-        sendp(pkt)
+        self.send_frame(self.client.gen_discover_raw())
+        self.time_sent_discover = monotime()
         # FIXME:20 check that this is correct,: all or only discover?
         if self.discover_attempts < MAX_ATTEMPTS_DISCOVER:
             self.discover_attempts += 1
@@ -178,16 +258,20 @@ class DHCPCAPFSM(Automaton):
             select one DHCPOFFER are implementation dependent.
 
         Nor [:rfc:`7844`] nor [:rfc:`2131`] specify the algorithm.
-        Here, currently the first offer is selected.
-
-        .. todo::
-
-           - Check other implementations algorithm to select offer.
+        Here, the offer is selected by the offer policy, by default the first
+        offer, see :mod:`offers`.
 
         """
         logger.debug('Selecting offer.')
-        pkt = self.offers[0]
-        self.client.handle_offer(pkt)
+        offer = self.offer_policy.select(self.offers)
+        self.client.handle_offer(offer.reply)
+
+    def gen_offer(self, reply):
+        """Return the :class:`offers.Offer` for a received reply."""
+        latency = 0.0
+        if self.time_sent_discover is not None:
+            latency = monotime() - self.time_sent_discover
+        return Offer(reply, latency)
 
     def send_request(self):
         """Send request.
@@ -207,12 +291,15 @@ class DHCPCAPFSM(Automaton):
         """
         assert self.client
         if self.current_state == STATE_BOUND:
-            pkt = self.client.gen_request_unicast()
+            pkt = self.client.gen_request_unicast_raw()
+        elif self.current_state in (STATE_INIT_REBOOT, STATE_REBOOTING):
+            pkt = self.client.gen_request_reboot_raw()
         else:
-            pkt = self.client.gen_request()
-        sendp(pkt)
+            pkt = self.client.gen_request_raw()
+        self.send_frame(pkt)
         logger.debug('Modifying FSM obj, setting time_sent_request.')
         self.time_sent_request = nowutc()
+        self.time_sent_request_mono = monotime()
         logger.info('DHCPREQUEST of %s on %s to %s port %s',
                     self.client.iface, self.client.client_ip,
                     self.client.server_ip, self.client.server_port)
@@ -220,7 +307,7 @@ class DHCPCAPFSM(Automaton):
         # NOTE: see previous TODO, maybe the MAX_ATTEMPTS_REQUEST needs to be
         # calculated per state.
         if self.request_attempts < MAX_ATTEMPTS_REQUEST:
-            self.request_attempts *= 2
+            self.request_attempts += 1
             logger.debug('Increased request attempts to %s',
                          self.request_attempts)
         if self.current_state == STATE_RENEWING:
@@ -233,6 +320,10 @@ class DHCPCAPFSM(Automaton):
             self.set_timeout(self.current_state,
                              self.timeout_request_rebinding,
                              timeout_rebinding)
+        elif self.current_state in (STATE_INIT_REBOOT, STATE_REBOOTING):
+            self.set_timeout(STATE_REBOOTING,
+                             self.timeout_request_rebooting,
+                             gen_timeout_resend(self.request_attempts))
         else:
             timeout_requesting = \
                 gen_timeout_resend(self.request_attempts)
@@ -240,15 +331,75 @@ class DHCPCAPFSM(Automaton):
                              self.timeout_requesting,
                              timeout_requesting)
 
+    def send_release(self):
+        """Send release.
+
+        Not sent on lease expiration, see
+        :func:`dhcpcapfsm.DHCPCAPFSM.lease_expires`.
+
+        """
+        self.send_frame(bytes(self.client.gen_release()))
+        logger.info('DHCPRELEASE of %s on %s to %s',
+                    self.client.client_ip, self.client.iface,
+                    self.client.server_ip)
+
+    def send_decline(self):
+        """Send decline."""
+        self.send_frame(bytes(self.client.gen_decline()))
+        logger.info('DHCPDECLINE of %s on %s to %s',
+                    self.client.client_ip, self.client.iface,
+                    self.client.server_ip)
+
+    def load_lease(self):
+        """Load the stored lease, if it can be reused in INIT-REBOOT."""
+        if self.lease_file is None:
+            return None
+        lease = read_lease(self.client.iface, self.client.client_mac,
+                           self.lease_file)
+        if lease is not None:
+            logger.debug('Found lease for %s in %s.', lease.address,
+                         self.lease_file)
+            self.client.lease = lease
+        return lease
+
+    def forget_lease(self):
+        """Remove the stored lease, eg. when the server NAKs it, so that it
+        is not requested again when the client is restarted."""
+        if self.lease_file is None:
+            return
+        try:
+            remove_lease(self.client.iface, self.lease_file)
+        except (IOError, OSError) as e:
+            logger.error('Can not write lease file %s: %s',
+                         self.lease_file, e)
+
+    def store_lease(self):
+        """Store the lease, when there is a lease file."""
+        if self.lease_file is None:
+            return
+        try:
+            write_lease(self.client.lease, self.client.client_mac,
+                        self.lease_file)
+        except (IOError, OSError) as e:
+            logger.error('Can not write lease file %s: %s',
+                         self.lease_file, e)
+
     def set_timers(self):
-        """Set renewal, rebinding times."""
+        """Set renewal, rebinding and lease expiry timeouts.
+
+        The Automaton timeouts are relative to the time the state is
+        entered, so they are set to the time left until the lease times,
+        every time BOUND, RENEWING or REBINDING are entered.
+
+        """
         logger.debug('setting timeouts')
-        self.set_timeout(self.current_state,
-                         self.renewing_time_expires,
-                         self.client.lease.renewal_time)
-        self.set_timeout(self.current_state,
-                         self.rebinding_time_expires,
-                         self.client.lease.rebinding_time)
+        lease = self.client.lease
+        self.set_timeout(STATE_BOUND, self.renewing_time_expires,
+                         lease.time_left('renew'))
+        self.set_timeout(STATE_RENEWING, self.rebinding_time_expires,
+                         lease.time_left('rebind'))
+        self.set_timeout(STATE_REBINDING, self.lease_expires,
+                         lease.time_left('expiry'))
 
     def process_received_ack(self, pkt):
         """Process a received ACK packet.
@@ -277,16 +428,17 @@ class DHCPCAPFSM(Automaton):
 
         """
         if isack(pkt):
+            from netaddr import AddrFormatError
             try:
-                self.event = self.client.handle_ack(pkt,
-                                                    self.time_sent_request)
+                self.event = self.client.handle_ack(
+                    pkt, self.time_sent_request, self.time_sent_request_mono)
             except AddrFormatError as err:
                 logger.error(err)
                 # NOTE: see previous TODO, maybe should go back to other state.
                 raise self.SELECTING()
             # NOTE: see previous TODO, not checking address with ARP.
-            logger.info('DHCPACK of %s from %s' %
-                        (self.client.client_ip, self.client.server_ip))
+            logger.info('DHCPACK of %s from %s', self.client.client_ip,
+                        self.client.server_ip)
             return True
         return False
 
@@ -323,6 +475,10 @@ class DHCPCAPFSM(Automaton):
         logger.debug('In state: INIT')
         if self.current_state is not STATE_PREINIT:
             self.reset()
+        # the sockets are created after __init__, and reset changes the xid
+        self.attach_filter()
+        if self.current_state is STATE_PREINIT and self.load_lease():
+            raise self.INIT_REBOOT()
         self.current_state = STATE_INIT
         # NOTE: see previous TODO, maybe this is not needed.
         if self.delay_selecting:
@@ -340,6 +496,27 @@ class DHCPCAPFSM(Automaton):
                              self.timeout_selecting,
                              self.timeout_select)
 
+    @ATMT.state()
+    def INIT_REBOOT(self):
+        """INIT-REBOOT state.
+
+        [:rfc:`2131#section-4.4.2`]::
+
+            The client begins in INIT-REBOOT state and sends a DHCPREQUEST
+            message.
+
+        Without the initial delay, see :func:`dhcpcapfsm.DHCPCAPFSM.INIT`.
+
+        """
+        logger.debug('In state: INIT_REBOOT')
+        self.current_state = STATE_INIT_REBOOT
+
+    @ATMT.state()
+    def REBOOTING(self):
+        """REBOOTING state."""
+        logger.debug('In state: REBOOTING')
+        self.current_state = STATE_REBOOTING
+
     @ATMT.state()
     def SELECTING(self):
         """SELECTING state."""
@@ -360,6 +537,8 @@ class DHCPCAPFSM(Automaton):
                     STATES2NAMES[self.current_state])
         self.current_state = STATE_BOUND
         self.client.lease.info_lease()
+        self.store_lease()
+        self.run_hooks()
         if self.script is not None:
             self.script.script_init(self.client.lease, self.current_state)
             self.script.script_go()
@@ -375,7 +554,13 @@ class DHCPCAPFSM(Automaton):
     def RENEWING(self):
         """RENEWING state."""
         logger.debug('In state: RENEWING')
+        # the state is entered again to retransmit the REQUEST, the hooks
+        # are only called on the transition
+        retransmit = self.current_state == STATE_RENEWING
         self.current_state = STATE_RENEWING
+        self.set_timers()
+        if not retransmit:
+            self.run_hooks()
         if self.script is not None:
             self.script.script_init(self.client.lease, self.current_state)
             self.script.script_go()
@@ -386,7 +571,13 @@ class DHCPCAPFSM(Automaton):
     def REBINDING(self):
         """REBINDING state."""
         logger.debug('In state: REBINDING')
+        # the state is entered again to retransmit the REQUEST, the hooks
+        # are only called on the transition
+        retransmit = self.current_state == STATE_REBINDING
         self.current_state = STATE_REBINDING
+        self.set_timers()
+        if not retransmit:
+            self.run_hooks()
         if self.script is not None:
             self.script.script_init(self.client.lease, self.current_state)
             self.script.script_go()
@@ -398,6 +589,7 @@ class DHCPCAPFSM(Automaton):
         """END state."""
         logger.debug('In state: END')
         self.current_state = STATE_END
+        self.run_hooks()
         if self.script is not None:
             self.script.script_init(self.client.lease, self.current_state)
             self.script.script_go()
@@ -410,12 +602,22 @@ class DHCPCAPFSM(Automaton):
         """ERROR state."""
         logger.debug('In state: ERROR')
         self.current_state = STATE_ERROR
+        self.run_hooks()
         if self.script is not None:
             self.script.script_init(self.client.lease, self.current_state)
             self.script.script_go()
         set_net(self.client.lease)
         raise self.INIT()
 
+    # CONDITIONS
+    #############
+
+    @ATMT.condition(INIT_REBOOT)
+    def init_reboot(self):
+        """Send the REQUEST for the stored lease on INIT-REBOOT state."""
+        logger.debug('C7. In INIT_REBOOT state, raise REBOOTING.')
+        raise self.REBOOTING()
+
     # TIMEOUTS
     ###########
 
@@ -435,26 +637,24 @@ class DHCPCAPFSM(Automaton):
         Not specifiyed in [:rfc:`7844`].
         See comments in :func:`dhcpcapfsm.DHCPCAPFSM.timeout_request`.
 
+        Once an offer is received, this is also the end of the window to
+        collect offers, see :func:`dhcpcapfsm.DHCPCAPFSM.receive_offer`.
+
         """
         logger.debug('C2.1: T In %s, timeout receiving response to select.',
                      self.current_state)
 
-        if len(self.offers) >= MAX_OFFERS_COLLECTED:
-            logger.debug('C2.2: T Maximum number of offers reached, '
-                         'raise REQUESTING.')
-            raise self.REQUESTING()
+        if len(self.offers) > 0:
+            logger.debug('C2.2: T Offers collected, raise REQUESTING.')
+            self.select_offer()
+            raise self.REQUESTING().action_parameters(selected=True)
 
         if self.discover_attempts >= MAX_ATTEMPTS_DISCOVER:
             logger.debug('C2.3: T Maximum number of discover retries is %s'
-                         ' and already sent %s.',
+                         ' and already sent %s, but no OFFERS were '
+                         'received, raise ERROR.',
                          MAX_ATTEMPTS_DISCOVER, self.discover_attempts)
-            if len(self.offers) <= 0:
-                logger.debug('C2.4: T. But no OFFERS where received, '
-                             'raise ERROR.')
-                raise self.ERROR()
-            logger.debug('C2.4: F. But there is some OFFERS, '
-                         'raise REQUESTING.')
-            raise self.REQUESTING()
+            raise self.ERROR()
 
         logger.debug('C2.2: F. Still not received all OFFERS, but not '
                      'max # attemps reached, raise SELECTING.')
@@ -474,15 +674,31 @@ class DHCPCAPFSM(Automaton):
         """
         logger.debug("C3.2: T. In %s, timeout receiving response to request, ",
                      self.current_state)
-        if self.discover_requests >= MAX_ATTEMPTS_REQUEST:
+        if self.request_attempts >= MAX_ATTEMPTS_REQUEST:
             logger.debug('C2.3: T. Maximum number %s of REQUESTs '
                          'reached, already sent %s, raise ERROR.',
-                         MAX_ATTEMPTS_REQUEST, self.disover_requests)
+                         MAX_ATTEMPTS_REQUEST, self.request_attempts)
             raise self.ERROR()
         logger.debug("C2.3: F. Maximum number of REQUESTs retries not reached,"
                      "raise REQUESTING.")
         raise self.REQUESTING()
 
+    @ATMT.timeout(REBOOTING, TIMEOUT_REBOOTING)
+    def timeout_request_rebooting(self):
+        """Timeout of request on REBOOTING state.
+
+        Not specified in [:rfc:`2131#section-4.4.2`], after
+        MAX_ATTEMPTS_REBOOT requests without answer, fall back to INIT.
+
+        """
+        logger.debug("C7.2:T In %s, timeout receiving response to request.",
+                     self.current_state)
+        if self.request_attempts >= MAX_ATTEMPTS_REBOOT:
+            logger.debug('C7.3: T Maximum number %s of REQUESTs reached, '
+                         'raise INIT.', MAX_ATTEMPTS_REBOOT)
+            raise self.INIT()
+        raise self.REBOOTING()
+
     @ATMT.timeout(RENEWING, TIMEOUT_REQUEST_RENEWING)
     def timeout_request_renewing(self):
         """Timeout of renewing on RENEWING state.
@@ -496,7 +712,7 @@ class DHCPCAPFSM(Automaton):
         if self.request_attempts >= MAX_ATTEMPTS_REQUEST:
             logger.debug('C2.3: T Maximum number %s of REQUESTs '
                          'reached, already sent %s, wait to rebinding time.',
-                         MAX_ATTEMPTS_REQUEST, self.disover_requests)
+                         MAX_ATTEMPTS_REQUEST, self.request_attempts)
             # raise self.ERROR()
         logger.debug("C2.3: F. Maximum number of REQUESTs retries not reached,"
                      "raise RENEWING.")
@@ -515,7 +731,7 @@ class DHCPCAPFSM(Automaton):
         if self.request_attempts >= MAX_ATTEMPTS_REQUEST:
             logger.debug('C.2.3: T. Maximum number %s of REQUESTs '
                          'reached, already sent %s, wait lease time expires.',
-                         MAX_ATTEMPTS_REQUEST, self.disover_requests)
+                         MAX_ATTEMPTS_REQUEST, self.request_attempts)
             # raise self.ERROR()
         logger.debug("C2.3: F. Maximum number of REQUESTs retries not reached,"
                      "raise REBINDING.")
@@ -552,7 +768,11 @@ class DHCPCAPFSM(Automaton):
         """
         logger.debug("C6.3. Timeout lease time, in REBINDING state, "
                      "raise INIT.")
-        raise self.STATE_INIT()
+        self.run_hooks(REASON_EXPIRE)
+        if self.script is not None:
+            self.script.script_init(self.client.lease, REASON_EXPIRE)
+            self.script.script_go()
+        raise self.INIT()
 
     # RECEIVE CONDITIONS
     ####################
@@ -561,15 +781,25 @@ class DHCPCAPFSM(Automaton):
     def receive_offer(self, pkt):
         """Receive offer on SELECTING state."""
         logger.debug("C2. Received OFFER?, in SELECTING state.")
-        if isoffer(pkt):
+        if isoffer(self.reply):
             logger.debug("C2: T, OFFER received")
-            self.offers.append(pkt)
-            if len(self.offers) >= MAX_OFFERS_COLLECTED:
+            offer = self.gen_offer(self.reply)
+            if not self.offer_policy.acceptable(offer):
+                logger.debug("C2.5: F, OFFER not acceptable.")
+                return
+            self.offers.append(offer)
+            if self.offer_policy.satisfies(offer) or \
+                    len(self.offers) >= MAX_OFFERS_COLLECTED:
                 logger.debug("C2.5: T, raise REQUESTING.")
                 self.select_offer()
                 raise self.REQUESTING()
-            logger.debug("C2.5: F, raise SELECTING.")
-            raise self.SELECTING()
+            if len(self.offers) == 1:
+                # the timers are restarted when entering the state
+                logger.debug("C2.5: F, collect offers during %s, "
+                             "raise SELECTING.", self.offer_policy.window)
+                self.set_timeout(STATE_SELECTING, self.timeout_selecting,
+                                 self.offer_policy.window)
+                raise self.SELECTING().action_parameters(selected=False)
 
     # same as:, but would can not be overloaded
     # @ATMT.receive_condition(RENEWING)
@@ -578,7 +808,7 @@ class DHCPCAPFSM(Automaton):
     def receive_ack_requesting(self, pkt):
         """Receive ACK in REQUESTING state."""
         logger.debug("C3. Received ACK?, in REQUESTING state.")
-        if self.process_received_ack(pkt):
+        if self.process_received_ack(self.reply):
             logger.debug("C3: T. Received ACK, in REQUESTING state, "
                          "raise BOUND.")
             raise self.BOUND()
@@ -590,16 +820,35 @@ class DHCPCAPFSM(Automaton):
     def receive_nak_requesting(self, pkt):
         """Receive NAK in REQUESTING state."""
         logger.debug("C3.1. Received NAK?, in REQUESTING state.")
-        if self.process_received_nak(pkt):
+        if self.process_received_nak(self.reply):
             logger.debug("C3.1: T. Received NAK, in REQUESTING state, "
                          "raise INIT.")
             raise self.INIT()
 
+    @ATMT.receive_condition(REBOOTING)
+    def receive_ack_rebooting(self, pkt):
+        """Receive ACK in REBOOTING state."""
+        logger.debug("C7. Received ACK?, in REBOOTING state.")
+        if self.process_received_ack(self.reply):
+            logger.debug("C7: T. Received ACK, in REBOOTING state, "
+                         "raise BOUND.")
+            raise self.BOUND()
+
+    @ATMT.receive_condition(REBOOTING)
+    def receive_nak_rebooting(self, pkt):
+        """Receive NAK in REBOOTING state."""
+        logger.debug("C7.1. Received NAK?, in REBOOTING state.")
+        if self.process_received_nak(self.reply):
+            logger.debug("C7.1: T. Received NAK, in REBOOTING state, "
+                         "raise INIT.")
+            self.forget_lease()
+            raise self.INIT()
+
     @ATMT.receive_condition(RENEWING)
     def receive_ack_renewing(self, pkt):
         """Receive ACK in RENEWING state."""
         logger.debug("C3. Received ACK?, in RENEWING state.")
-        if self.process_received_ack(pkt):
+        if self.process_received_ack(self.reply):
             logger.debug("C3: T. Received ACK, in RENEWING state, "
                          "raise BOUND.")
             raise self.BOUND()
@@ -608,7 +857,7 @@ class DHCPCAPFSM(Automaton):
     def receive_nak_renewing(self, pkt):
         """Receive NAK in RENEWING state."""
         logger.debug("C3.1. Received NAK?, in RENEWING state.")
-        if self.process_received_nak(pkt):
+        if self.process_received_nak(self.reply):
             logger.debug("C3.1: T. Received NAK, in RENEWING state, "
                          " raise INIT.")
             raise self.INIT()
@@ -617,7 +866,7 @@ class DHCPCAPFSM(Automaton):
     def receive_ack_rebinding(self, pkt):
         """Receive ACK in REBINDING state."""
         logger.debug("C3. Received ACK?, in REBINDING state.")
-        if self.process_received_ack(pkt):
+        if self.process_received_ack(self.reply):
             logger.debug("C3: T. Received ACK, in REBINDING state, "
                          "raise BOUND.")
             raise self.BOUND()
@@ -626,7 +875,7 @@ class DHCPCAPFSM(Automaton):
     def receive_nak_rebinding(self, pkt):
         """Receive NAK in REBINDING state."""
         logger.debug("C3.1. Received NAK?, in RENEWING state.")
-        if self.process_received_nak(pkt):
+        if self.process_received_nak(self.reply):
             logger.debug("C3.1: T. Received NAK, in RENEWING state, "
                          "raise INIT.")
             raise self.INIT()
@@ -639,16 +888,35 @@ class DHCPCAPFSM(Automaton):
 
     @ATMT.action(timeout_delay_before_selecting)
     @ATMT.action(timeout_selecting)
-    def action_transmit_discover(self):
-        """Action on timeout, send DISCOVER."""
+    def action_transmit_discover(self, selected=False):
+        """Action on timeout, send DISCOVER, or REQUEST when the collection
+        of offers finished."""
+        if selected:
+            logger.debug('Action on timeout, in state %s: send REQUEST.',
+                         self.current_state)
+            self.send_request()
+            return
         logger.debug('Action on timeout, in state %s: send DISCOVER.',
                      self.current_state)
         self.send_discover()
 
+    @ATMT.action(receive_offer)
+    def action_transmit_request_offer(self, selected=True):
+        """Action on receive OFFER, send REQUEST if an offer was selected."""
+        if selected:
+            self.send_request()
+
+    @ATMT.action(timeout_request_rebooting)
+    def action_retransmit_request_rebooting(self):
+        """Action on timeout in REBOOTING, send REQUEST if not falling back
+        to INIT."""
+        if self.request_attempts < MAX_ATTEMPTS_REBOOT:
+            self.send_request()
+
+    @ATMT.action(init_reboot)
     @ATMT.action(timeout_requesting)
     @ATMT.action(timeout_request_rebinding)
     @ATMT.action(rebinding_time_expires)
-    @ATMT.action(receive_offer)
     @ATMT.action(timeout_request_renewing)
     @ATMT.action(renewing_time_expires)
     def action_transmit_request(self):
@@ -660,6 +928,7 @@ class DHCPCAPFSM(Automaton):
     # ACTIONS: on receive conditions
     # -------------------------------
 
+    @ATMT.action(receive_ack_rebooting)
     @ATMT.action(receive_ack_rebinding)
     @ATMT.action(receive_ack_requesting)
     def on_ack_requesting(self):
@@ -675,6 +944,4 @@ class DHCPCAPFSM(Automaton):
         Not recording lease, but restarting timers.
 
         """
-        self.client.lease.sanitize_net_values()
-        self.client.lease.set_times(self.time_sent_request)
         self.set_timers()
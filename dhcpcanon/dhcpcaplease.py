@@ -5,48 +5,157 @@
 ([:rfc:`7844`]).."""
 from __future__ import absolute_import
 
+import contextlib
+import fcntl
+import functools
 import logging
+import os
+import tempfile
+from datetime import datetime
+from ipaddress import IPv4Address, IPv4Network
 
 import attr
 from attr.validators import instance_of
 
 from .timers import (future_dt_str, gen_rebinding_time, gen_renewing_time,
-                     nowutc)
+                     monotime, nowutc)
 
-from.constants import (LEASE_ATTRS2LEASE_LOG, ENV_OPTIONS_REQ)
+from .constants import (DT_PRINT_FORMAT, ENV_OPTIONS_REQ,
+                        LEASE_ADDRESS_CACHE_SIZE, LEASE_ATTRS2LEASE_FILE,
+                        LEASE_ATTRS2LEASE_LOG, LEASE_FILE_HARDWARE,
+                        LEASE_FILE_QUOTED, LEASE_LOCK_SUFFIX, LEASE_PATH)
 
 logger = logging.getLogger('dhcpcanon')
 
 
-@attr.s
+@functools.lru_cache(maxsize=LEASE_ADDRESS_CACHE_SIZE)
+def parse_address(value):
+    """Parse an IPv4 address string.
+
+    The same server, router, mask and broadcast addresses are in the leases
+    of every client, so they are parsed once and the objects are shared.
+
+    """
+    return IPv4Address(value)
+
+
+def to_address(value):
+    """Convert to an IPv4 address, None when it is not set."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, IPv4Address):
+        return value
+    return parse_address(value)
+
+
+def to_addresses(value):
+    """Convert a space separated string or a sequence to IPv4 addresses."""
+    if isinstance(value, str):
+        value = value.split()
+    return tuple(to_address(address) for address in value or ())
+
+
+def to_network(value):
+    """Convert to an IPv4 network, None when it is not set."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, IPv4Network):
+        return value
+    return IPv4Network(value, strict=False)
+
+
+def to_int(value):
+    """Convert to int, None when it is not set."""
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def to_seconds(value):
+    """Convert to seconds, None when it is not set.
+
+    The times given by the server are integers, the generated ones floats.
+
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        return int(value) if value.isdigit() else float(value)
+    return value
+
+
+def to_view(value):
+    """Return the string of an attribute in the script environment and the
+    lease file."""
+    if value is None:
+        return ''
+    if isinstance(value, tuple):
+        return ' '.join(str(v) for v in value)
+    return str(value)
+
+
+def clear_views(lease, attribute, value):
+    """Clear the cached :attr:`DHCPCAPLease.views` when an attribute is
+    set."""
+    lease._views = None
+    return value
+
+
+@attr.s(slots=True, on_setattr=[attr.setters.convert, clear_views])
 class DHCPCAPLease(object):
-    """."""
-    address = attr.ib(default='', validator=instance_of(str))
-    server_id = attr.ib(default='', validator=instance_of(str))
-    next_server = attr.ib(default='', validator=instance_of(str))
-    router = attr.ib(default='', validator=instance_of(str))
-    subnet_mask = attr.ib(default='', validator=instance_of(str))
-    broadcast_address = attr.ib(default='', validator=instance_of(str))
+    """Lease given by a server.
+
+    The times are numbers of seconds and the addresses
+    :class:`ipaddress.IPv4Address`, None when they are not given.
+    Strings are converted, as the ones parsed from the packets or the lease
+    file. The strings for the script environment, the lease file and the log
+    are in :attr:`views`.
+
+    """
+    address = attr.ib(default=None, converter=to_address)
+    server_id = attr.ib(default=None, converter=to_address)
+    next_server = attr.ib(default=None, converter=to_address)
+    router = attr.ib(default=None, converter=to_address)
+    subnet_mask = attr.ib(default=None, converter=to_address)
+    broadcast_address = attr.ib(default=None, converter=to_address)
     domain = attr.ib(default='', validator=instance_of(str))
-    name_server = attr.ib(default='', validator=instance_of(str))
-    subnet = attr.ib(default='', validator=instance_of(str))
-    lease_time = attr.ib(default='', validator=instance_of(str))
-    renewal_time = attr.ib(default='', validator=instance_of(str))
-    rebinding_time = attr.ib(default='', validator=instance_of(str))
+    name_server = attr.ib(default=(), converter=to_addresses)
+    subnet = attr.ib(default=None, converter=to_address)
+    lease_time = attr.ib(default=None, converter=to_seconds)
+    renewal_time = attr.ib(default=None, converter=to_seconds)
+    rebinding_time = attr.ib(default=None, converter=to_seconds)
     # not given by the server
     interface = attr.ib(default='', validator=instance_of(str))
     # not given by the server, calculated on previous
-    subnet_mask_cidr = attr.ib(default='', validator=instance_of(str))
-    network = attr.ib(default='', validator=instance_of(str))
+    subnet_mask_cidr = attr.ib(default=None, converter=to_int)
+    network = attr.ib(default=None, converter=to_network)
+    # wall times, only to be shown and stored, see :meth:`set_times`
     expiry = attr.ib(default='', validator=instance_of(str))
     renew = attr.ib(default='', validator=instance_of(str))
     rebind = attr.ib(default='', validator=instance_of(str))
+    # monotonic times of expiry, renew and rebind, see :meth:`set_times`
+    deadlines = attr.ib(default=None, cmp=False, repr=False,
+                        on_setattr=attr.setters.NO_OP)
+    _views = attr.ib(default=None, init=False, cmp=False, repr=False,
+                     on_setattr=attr.setters.NO_OP)
+
+    @property
+    def views(self):
+        """Dictionary from attribute name to its string.
+
+        It is built the first time it is needed after an attribute is set.
+
+        """
+        if self._views is None:
+            self._views = {name: to_view(getattr(self, name))
+                           for name in LEASE_VIEW_ATTRS}
+        return self._views
 
     # def __attrs_post_init__(self, sent_dt):
     #     """Initializes attributes after attrs __init__."""
     #     self.set_times(sent_dt)
 
-    def set_times(self, sent_dt):
+    def set_times(self, sent_dt, sent_time=None):
         """
         Set timers for the lease given the time in which the request was sent.
 
@@ -56,16 +165,29 @@ class DHCPCAPLease(object):
             as the sum of the time at which the original request was
             sent and the duration of the lease from the DHCPACK message.
 
+        ``sent_time`` is the :func:`timers.monotime` when the request was
+        sent, now when it is not known. The ``expiry``, ``renew`` and
+        ``rebind`` times are kept on that clock, so that they do not move
+        when the wall time is stepped, eg. by NTP at boot.
+        The wall times from ``sent_dt`` are only to be shown and stored in
+        the lease file.
+
         """
         logger.debug('Modifying Lease obj, setting timers.')
-        elapsed = (nowutc() - sent_dt).seconds
-        if self.renewal_time == '':
+        now = monotime()
+        if sent_time is None:
+            sent_time = now
+        elapsed = now - sent_time
+        if self.renewal_time is None:
             self.renewal_time = gen_renewing_time(self.lease_time, elapsed)
-        if self.rebinding_time == '':
+        if self.rebinding_time is None:
             self.rebinding_time = gen_rebinding_time(self.lease_time, elapsed)
         self.expiry = future_dt_str(sent_dt, self.lease_time)
         self.renew = future_dt_str(sent_dt, self.renewal_time)
         self.rebind = future_dt_str(sent_dt, self.rebinding_time)
+        self.deadlines = {'expiry': sent_time + self.lease_time,
+                          'renew': sent_time + self.renewal_time,
+                          'rebind': sent_time + self.rebinding_time}
         logger.debug('lease time: %s, expires on %s', self.lease_time,
                      self.expiry)
         logger.debug('renewal_time: %s, expires on %s',
@@ -75,14 +197,188 @@ class DHCPCAPLease(object):
 
     def info_lease(self):
         """Print lease information."""
-        for k, v in LEASE_ATTRS2LEASE_LOG. items():
-            logger.debug("'%s'=>'%s'", v, getattr(self, k))
-        for k, v in ENV_OPTIONS_REQ.items():
-            logger.debug("option '%s'=>'1'", k)
-        logger.info('address %s', self.address)
-        logger.info('plen %s (%s)', self.subnet_mask_cidr, self.subnet_mask)
-        logger.info('gateway %s', self.router)
-        logger.info('server identifier %s', self.server_id)
-        logger.info('nameserver %s', self.name_server)
-        logger.info('domain name %s', self.domain)
-        logger.info('lease time %s', self.lease_time)
+        views = self.views
+        if logger.isEnabledFor(logging.DEBUG):
+            for k, v in LEASE_ATTRS2LEASE_LOG.items():
+                logger.debug("'%s'=>'%s'", v, views[k])
+            for k, v in ENV_OPTIONS_REQ.items():
+                logger.debug("option '%s'=>'1'", k)
+        logger.info('address %s', views['address'])
+        logger.info('plen %s (%s)', views['subnet_mask_cidr'],
+                    views['subnet_mask'])
+        logger.info('gateway %s', views['router'])
+        logger.info('server identifier %s', views['server_id'])
+        logger.info('nameserver %s', views['name_server'])
+        logger.info('domain name %s', views['domain'])
+        logger.info('lease time %s', views['lease_time'])
+
+    def time_left(self, name):
+        """Seconds until the ``expiry``, ``renew`` or ``rebind`` time.
+
+        0 when it has already passed. The wall time is only used for the
+        leases read from the lease file, which were set before this boot.
+
+        """
+        if self.deadlines is not None:
+            return max(self.deadlines[name] - monotime(), 0)
+        dt = datetime.strptime(getattr(self, name), DT_PRINT_FORMAT)
+        return max((dt - nowutc()).total_seconds(), 0)
+
+    def has_expired(self):
+        """Whether the lease expiry time has already passed."""
+        if not self.expiry and self.deadlines is None:
+            return True
+        return self.time_left('expiry') <= 0
+
+
+# the attributes in :attr:`DHCPCAPLease.views`
+LEASE_VIEW_ATTRS = [a.name for a in attr.fields(DHCPCAPLease)
+                    if a.name not in ('deadlines', '_views')]
+
+
+def lease2block(lease, client_mac):
+    """Format a lease as a ``dhclient`` lease file ``lease {}`` block."""
+    lines = ['lease {']
+    views = lease.views
+    for k, v in LEASE_ATTRS2LEASE_FILE.items():
+        value = views[k]
+        if value == '':
+            continue
+        if v in LEASE_FILE_QUOTED:
+            value = '"%s"' % value
+        lines.append('  %s %s;' % (v, value))
+        if k == 'interface':
+            lines.append('  %s %s;' % (LEASE_FILE_HARDWARE, client_mac))
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+
+def parse_lease_file(path=LEASE_PATH):
+    """Parse a lease file written by :func:`write_lease`.
+
+    Return a dictionary from interface to (client MAC, lease).
+
+    """
+    keys2attrs = {v: k for k, v in LEASE_ATTRS2LEASE_FILE.items()}
+    keys2attrs[LEASE_FILE_HARDWARE] = 'client_mac'
+    # match the longest statements first, ie. ``renew`` after
+    # ``option dhcp-renewal-time``
+    keys = sorted(keys2attrs, key=len, reverse=True)
+    leases = dict()
+    try:
+        with open(path) as fd:
+            lines = fd.readlines()
+    except (IOError, OSError):
+        return leases
+    attrs_dict = None
+    for line in lines:
+        line = line.strip().rstrip(';')
+        if line == 'lease {':
+            attrs_dict = dict()
+        elif line == '}' and attrs_dict is not None:
+            client_mac = attrs_dict.pop('client_mac', '')
+            try:
+                lease = DHCPCAPLease(**attrs_dict)
+            except (TypeError, ValueError) as e:
+                logger.debug('Ignoring invalid lease %s: %s', attrs_dict, e)
+            else:
+                leases[lease.interface] = (client_mac, lease)
+            attrs_dict = None
+        elif attrs_dict is not None:
+            for key in keys:
+                if line.startswith(key + ' '):
+                    attrs_dict[keys2attrs[key]] = \
+                        line[len(key) + 1:].strip('"')
+                    break
+    return leases
+
+
+@contextlib.contextmanager
+def lock_lease_file(path=LEASE_PATH):
+    """Hold an exclusive lock while the lease file is read and written.
+
+    The clients of several interfaces, in different processes, share the
+    lease file. The lock is taken on a sidecar file, as the lease file is
+    replaced on every write.
+
+    """
+    dirname = os.path.dirname(path) or '.'
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path + LEASE_LOCK_SUFFIX, 'a') as fd:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+
+
+def write_lease(lease, client_mac, path=LEASE_PATH):
+    """Write the lease for its interface to the lease file.
+
+    The leases of other interfaces are kept, see :func:`write_lease_file`.
+
+    """
+    with lock_lease_file(path):
+        leases = parse_lease_file(path)
+        leases[lease.interface] = (client_mac, lease)
+        write_lease_file(leases, path)
+    logger.debug('Lease for %s written to %s.', lease.interface, path)
+
+
+def remove_lease(iface, path=LEASE_PATH):
+    """Remove the lease for the interface from the lease file, if any."""
+    with lock_lease_file(path):
+        leases = parse_lease_file(path)
+        if leases.pop(iface, None) is None:
+            return
+        write_lease_file(leases, path)
+    logger.debug('Lease for %s removed from %s.', iface, path)
+
+
+def write_lease_file(leases, path=LEASE_PATH):
+    """Write the leases, a dictionary from interface to (client MAC, lease).
+
+    The file is replaced atomically, so that it is never found partially
+    written.
+
+    """
+    dirname = os.path.dirname(path) or '.'
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmppath = tempfile.mkstemp(prefix='.dhcpcanon', dir=dirname)
+    try:
+        with os.fdopen(fd, 'w') as tmpfd:
+            for mac, iface_lease in leases.values():
+                tmpfd.write(lease2block(iface_lease, mac))
+            tmpfd.flush()
+            os.fsync(tmpfd.fileno())
+        os.replace(tmppath, path)
+    except Exception:
+        os.unlink(tmppath)
+        raise
+
+
+def read_lease(iface, client_mac, path=LEASE_PATH):
+    """Return the stored lease for the interface when it can be reused.
+
+    [:rfc:`7844#section-3.3`]::
+
+        If the client can ascertain that this is exactly the same network
+        to which it was previously connected, and if the link-layer address
+        did not change, the client MAY issue a DHCPREQUEST to try to
+        reclaim the current address.
+
+    The lease is not returned when the link-layer address changed or when
+    it has expired.
+
+    """
+    client_mac_lease = parse_lease_file(path).get(iface)
+    if client_mac_lease is None:
+        return None
+    mac, lease = client_mac_lease
+    if mac != client_mac:
+        logger.debug('The link-layer address changed, not reusing lease.')
+        return None
+    if lease.has_expired():
+        logger.debug('The lease expired on %s, not reusing it.',
+                     lease.expiry)
+        return None
+    return lease
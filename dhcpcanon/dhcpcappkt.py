@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# Copyright 2016, 2017 juga (juga at riseup dot net), MIT license.
+"""Pre-serialized packets and reply parser for the DHCP client implementation
+of the Anonymity Profile ([:rfc:`7844`]).
+
+The frames built here are byte-identical to the ones scapy builds from
+``Ether/IP/UDP/BOOTP/DHCP`` in :class:`dhcpcap.DHCPCAP`, but the invariant
+part of every frame is serialized only once and only the fields that change
+between transmissions are patched.
+
+The replies are read directly from the frame bytes with ``struct``, without
+dissecting them with scapy.
+
+"""
+from __future__ import absolute_import
+
+import logging
+import socket
+import struct
+
+import attr
+
+from .constants import (BOOTP_HTYPE_ETHER, BOOTP_MAGIC_COOKIE,
+                        BOOTP_OP_REPLY, BOOTP_OP_REQUEST,
+                        DHCP_OFFER_OPTIONS_CODES, DHCP_OPTION_DOMAIN,
+                        DHCP_OPTION_END, DHCP_OPTION_LEASE_TIME,
+                        DHCP_OPTION_MESSAGE_TYPE, DHCP_OPTION_PAD,
+                        DHCP_OPTION_REBINDING_TIME, DHCP_OPTION_RENEWAL_TIME,
+                        DHCP_OPTION_REQUESTED_ADDR, DHCP_OPTION_SERVER_ID,
+                        ETHER_TYPE_IP, IP_PROTO_UDP, IP_TTL)
+
+logger = logging.getLogger(__name__)
+
+ETHER_HDR = struct.Struct('!6s6sH')
+IP_HDR = struct.Struct('!BBHHHBBH4s4s')
+UDP_HDR = struct.Struct('!HHHH')
+BOOTP_HDR = struct.Struct('!BBBBIHH4s4s4s4s16s64s128s')
+# the part of the BOOTP header needed to parse a reply, up to giaddr
+BOOTP_REPLY_HDR = struct.Struct('!BBBBIHH4s4s4s4s')
+XID = struct.Struct('!I')
+CHECKSUM = struct.Struct('!H')
+
+IP_OFFSET = ETHER_HDR.size
+UDP_OFFSET = IP_OFFSET + IP_HDR.size
+BOOTP_OFFSET = UDP_OFFSET + UDP_HDR.size
+XID_OFFSET = BOOTP_OFFSET + 4
+OPTIONS_OFFSET = BOOTP_OFFSET + BOOTP_HDR.size + len(BOOTP_MAGIC_COOKIE)
+# offset of the magic cookie from the start of BOOTP
+COOKIE_OFFSET = BOOTP_HDR.size
+IP_CHECKSUM_OFFSET = IP_OFFSET + 10
+UDP_CHECKSUM_OFFSET = UDP_OFFSET + 6
+# scapy default IP id
+IP_ID = 1
+# options with a 32 bits number of seconds
+TIME_OPTIONS = (DHCP_OPTION_LEASE_TIME, DHCP_OPTION_RENEWAL_TIME,
+                DHCP_OPTION_REBINDING_TIME)
+
+
+def checksum_fold(total):
+    """Fold a sum of 16 bits words into the one's complement checksum."""
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def checksum(data):
+    """Internet checksum [:rfc:`1071`] of ``data``."""
+    if len(data) % 2:
+        data = bytes(data) + b'\x00'
+    return checksum_fold(sum(struct.unpack('!%dH' % (len(data) // 2), data)))
+
+
+def mac2bytes(mac):
+    """Convert a MAC address in the ``00:01:02:03:04:05`` form to bytes."""
+    return bytes(bytearray(int(b, 16) for b in mac.split(':')))
+
+
+def bytes2mac(mac):
+    """Convert a MAC address in bytes to the ``00:01:02:03:04:05`` form."""
+    return ':'.join('%02x' % b for b in bytearray(mac))
+
+
+def gen_options(options):
+    """Serialize DHCP options given as a list of (code, value bytes)."""
+    return b''.join(struct.pack('!BB', code, len(value)) + value
+                    for code, value in options) + \
+        struct.pack('!B', DHCP_OPTION_END)
+
+
+def gen_template(src_mac, dst_mac, src_ip, dst_ip, sport, dport, options,
+                 ciaddr='0.0.0.0', xid=0, op=BOOTP_OP_REQUEST,
+                 yiaddr='0.0.0.0', siaddr='0.0.0.0', chaddr=None):
+    """Serialize a DHCP frame into a :class:`DHCPCAPTemplate`.
+
+    The layout is the one scapy produces with its default field values::
+
+        Ether(src=src_mac, dst=dst_mac) /
+        IP(src=src_ip, dst=dst_ip) /
+        UDP(sport=sport, dport=dport) /
+        BOOTP(op=op, chaddr=[chaddr], xid=xid, ciaddr=ciaddr,
+              yiaddr=yiaddr, siaddr=siaddr) /
+        DHCP(options=options)
+
+    ``chaddr`` is ``src_mac`` by default, as in the client frames.
+
+    """
+    chaddr = mac2bytes(chaddr or src_mac)
+    payload = BOOTP_HDR.pack(op, BOOTP_HTYPE_ETHER, len(chaddr), 0, xid, 0,
+                             0, socket.inet_aton(ciaddr),
+                             socket.inet_aton(yiaddr),
+                             socket.inet_aton(siaddr), b'\x00' * 4, chaddr,
+                             b'', b'') + \
+        BOOTP_MAGIC_COOKIE + gen_options(options)
+    udp_len = UDP_HDR.size + len(payload)
+    ip_len = IP_HDR.size + udp_len
+    ip_hdr = IP_HDR.pack(0x45, 0, ip_len, IP_ID, 0, IP_TTL, IP_PROTO_UDP, 0,
+                         socket.inet_aton(src_ip), socket.inet_aton(dst_ip))
+    ip_hdr = ip_hdr[:10] + CHECKSUM.pack(checksum(ip_hdr)) + ip_hdr[12:]
+    frame = bytearray(ETHER_HDR.pack(mac2bytes(dst_mac), mac2bytes(src_mac),
+                                     ETHER_TYPE_IP) +
+                      ip_hdr + UDP_HDR.pack(sport, dport, udp_len, 0) +
+                      payload)
+    return DHCPCAPTemplate(frame)
+
+
+@attr.s
+class DHCPCAPTemplate(object):
+    """Preallocated client frame in which only xid, requested address,
+    server identifier and UDP checksum are patched on every transmission.
+
+    """
+    frame = attr.ib()
+
+    def __attrs_post_init__(self):
+        """Find the offsets of the patched fields in the frame."""
+        self.option_offsets = dict()
+        i = OPTIONS_OFFSET
+        while i < len(self.frame) and self.frame[i] != DHCP_OPTION_END:
+            if self.frame[i] == DHCP_OPTION_PAD:
+                i += 1
+                continue
+            self.option_offsets[self.frame[i]] = i + 2
+            i += 2 + self.frame[i + 1]
+        udp_len = len(self.frame) - UDP_OFFSET
+        self.udp_words = struct.Struct('!%dH' % (udp_len // 2))
+        self.udp_odd = udp_len % 2
+        # the pseudo header does not change for a template
+        pseudo = self.frame[IP_OFFSET + 12:IP_OFFSET + 20] + \
+            struct.pack('!BBH', 0, IP_PROTO_UDP, udp_len)
+        self.pseudo_sum = sum(struct.unpack('!6H', pseudo))
+
+    def patch_udp_checksum(self):
+        """Recalculate the UDP checksum as scapy does."""
+        CHECKSUM.pack_into(self.frame, UDP_CHECKSUM_OFFSET, 0)
+        total = self.pseudo_sum + sum(self.udp_words.unpack_from(self.frame,
+                                                                 UDP_OFFSET))
+        if self.udp_odd:
+            total += self.frame[-1] << 8
+        chksum = checksum_fold(total)
+        # [:rfc:`768`] a computed checksum of 0 is transmitted as all ones
+        CHECKSUM.pack_into(self.frame, UDP_CHECKSUM_OFFSET, chksum or 0xffff)
+
+    def patch(self, xid, requested_addr=None, server_id=None):
+        """Return the frame bytes for the given per-transmission values.
+
+        The addresses are :class:`ipaddress.IPv4Address`, as in the lease.
+
+        """
+        XID.pack_into(self.frame, XID_OFFSET, xid)
+        if requested_addr is not None:
+            offset = self.option_offsets[DHCP_OPTION_REQUESTED_ADDR]
+            self.frame[offset:offset + 4] = requested_addr.packed
+        if server_id is not None:
+            offset = self.option_offsets[DHCP_OPTION_SERVER_ID]
+            self.frame[offset:offset + 4] = server_id.packed
+        self.patch_udp_checksum()
+        return bytes(self.frame)
+
+
+def pkt2bytes(pkt):
+    """Return the bytes of a received frame.
+
+    The frame might be given as bytes, as a scapy ``Raw`` packet, as
+    returned by the sockets that do not dissect, or as a dissected scapy
+    packet.
+
+    """
+    if isinstance(pkt, (bytes, bytearray, memoryview)):
+        return pkt
+    load = pkt.getfieldval('load') if 'load' in pkt.fields else None
+    if load is not None and not pkt.payload:
+        return load
+    return bytes(pkt)
+
+
+def parse_options(buf, offset):
+    """Parse the DHCP options TLVs in ``buf`` starting at ``offset``.
+
+    Return a dictionary from option code to value bytes. Options that
+    appear several times are concatenated as in [:rfc:`3396`].
+
+    """
+    options = dict()
+    end = len(buf)
+    while offset < end:
+        code = buf[offset]
+        if code == DHCP_OPTION_END:
+            break
+        if code == DHCP_OPTION_PAD:
+            offset += 1
+            continue
+        if offset + 1 >= end:
+            break
+        length = buf[offset + 1]
+        value = bytes(buf[offset + 2:offset + 2 + length])
+        if code in options:
+            options[code] += value
+        else:
+            options[code] = value
+        offset += 2 + length
+    return options
+
+
+def ips2str(value):
+    """Convert a list of IPv4 addresses in bytes to a space separated str."""
+    return ' '.join(socket.inet_ntoa(value[i:i + 4])
+                    for i in range(0, len(value) - 3, 4))
+
+
+def option2str(code, value):
+    """Convert an option value to ``str`` as the scapy based parser does.
+
+    The time options are at least 4 bytes and the domain is UTF-8, see
+    :func:`parse_reply`.
+
+    """
+    if code in TIME_OPTIONS:
+        return str(XID.unpack(value[:4])[0])
+    if code == DHCP_OPTION_DOMAIN:
+        return str(value.decode('utf8'))
+    return ips2str(value)
+
+
+def parse_reply(frame):
+    """Parse a DHCP server reply frame into a :class:`DHCPCAPReply`.
+
+    Only the headers and the options TLVs are read, the options values are
+    converted to strings only when the lease is created.
+    Return None when the frame is not a DHCP reply, when a time option is
+    shorter than 4 bytes or when the domain is not UTF-8, so that it is
+    dropped as the other malformed frames instead of failing when the lease
+    is created.
+
+    """
+    buf = memoryview(frame)
+    if len(buf) < UDP_OFFSET or \
+            ETHER_HDR.unpack_from(buf)[2] != ETHER_TYPE_IP:
+        return None
+    version_ihl = buf[IP_OFFSET]
+    if version_ihl >> 4 != 4 or buf[IP_OFFSET + 9] != IP_PROTO_UDP:
+        return None
+    udp_offset = IP_OFFSET + (version_ihl & 0x0f) * 4
+    bootp_offset = udp_offset + UDP_HDR.size
+    options_offset = bootp_offset + COOKIE_OFFSET + len(BOOTP_MAGIC_COOKIE)
+    if len(buf) < options_offset or \
+            buf[bootp_offset + COOKIE_OFFSET:options_offset] != \
+            BOOTP_MAGIC_COOKIE:
+        return None
+    (op, _, _, _, xid, _, _, _, yiaddr, siaddr, _) = \
+        BOOTP_REPLY_HDR.unpack_from(buf, bootp_offset)
+    if op != BOOTP_OP_REPLY:
+        return None
+    options = parse_options(buf, options_offset)
+    message_type = options.get(DHCP_OPTION_MESSAGE_TYPE)
+    if not message_type:
+        return None
+    for code in TIME_OPTIONS:
+        if code in options and len(options[code]) < 4:
+            logger.debug('Ignoring reply with malformed option %s.', code)
+            return None
+    if DHCP_OPTION_DOMAIN in options:
+        try:
+            bytes(options[DHCP_OPTION_DOMAIN]).decode('utf8')
+        except UnicodeDecodeError:
+            logger.debug('Ignoring reply with malformed option %s.',
+                         DHCP_OPTION_DOMAIN)
+            return None
+    return DHCPCAPReply(
+        server_mac=bytes2mac(buf[6:12]),
+        server_ip=socket.inet_ntoa(buf[IP_OFFSET + 12:IP_OFFSET + 16]),
+        server_port=UDP_HDR.unpack_from(buf, udp_offset)[0],
+        xid=xid,
+        message_type=bytearray(message_type)[0],
+        address=socket.inet_ntoa(yiaddr),
+        next_server=socket.inet_ntoa(siaddr),
+        options=options)
+
+
+@attr.s
+class DHCPCAPReply(object):
+    """DHCP server reply read from the frame bytes."""
+    server_mac = attr.ib()
+    server_ip = attr.ib()
+    server_port = attr.ib()
+    xid = attr.ib()
+    message_type = attr.ib()
+    address = attr.ib()
+    next_server = attr.ib()
+    options = attr.ib(default=attr.Factory(dict))
+
+    def options_attrs(self):
+        """Return the lease options as the attrs_dict built from scapy."""
+        return {name: option2str(code, self.options[code])
+                for code, name in DHCP_OFFER_OPTIONS_CODES.items()
+                if code in self.options}
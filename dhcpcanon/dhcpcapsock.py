@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# Copyright 2016, 2017 juga (juga at riseup dot net), MIT license.
+"""Sockets for the DHCP client implementation of the Anonymity Profile
+([:rfc:`7844`]).
+
+The FSMs open their sockets through a transport: :class:`RawTransport`
+sends and receives Ethernet frames on an interface, and needs
+``CAP_NET_RAW``, while :class:`LoopbackTransport` passes the frames in
+memory to a peer socket, so that the client can run unprivileged against a
+server in the same process, ie in the tests and benchmarks.
+
+"""
+from __future__ import absolute_import
+
+import ctypes
+import errno
+import logging
+import socket
+import struct
+
+import attr
+from scapy.config import conf
+from scapy.data import ETH_P_IP, MTU
+from scapy.supersocket import SuperSocket
+
+from .constants import BOOTP_OP_REPLY, ETHER_TYPE_IP, IP_PROTO_UDP
+from .dhcpcappkt import IP_OFFSET, mac2bytes
+
+logger = logging.getLogger(__name__)
+
+SO_ATTACH_FILTER = 26
+
+# classic BPF instructions used, see linux/filter.h
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_LD_W_IND = 0x40
+BPF_LD_H_IND = 0x48
+BPF_LD_B_IND = 0x50
+BPF_LDX_B_MSH = 0xb1
+BPF_JMP_JEQ_K = 0x15
+BPF_JMP_JSET_K = 0x45
+BPF_RET_K = 0x06
+
+BPF_INSN = struct.Struct('HBBI')
+
+
+def gen_bpf(client_mac, client_port, server_port, xid):
+    """Generate a classic BPF program that accepts only the replies to us.
+
+    Equivalent to the tcpdump filter::
+
+        udp and src port server_port and dst port client_port and
+        ether dst client_mac
+
+    and additionally checks the BOOTP op is reply and the xid is ``xid``,
+    so that stale or foreign replies are dropped in the kernel.
+    Return a list of (code, jt, jf, k) instructions.
+
+    """
+    mac = mac2bytes(client_mac)
+    mac_high, mac_low = struct.unpack('!HI', mac)
+    # the UDP header is at this offset plus the IP header length
+    udp = IP_OFFSET
+    checks = [
+        # ethertype IP
+        (BPF_LD_H_ABS, 12, BPF_JMP_JEQ_K, ETHER_TYPE_IP),
+        # protocol UDP
+        (BPF_LD_B_ABS, IP_OFFSET + 9, BPF_JMP_JEQ_K, IP_PROTO_UDP),
+        # ether dst
+        (BPF_LD_W_ABS, 2, BPF_JMP_JEQ_K, mac_low),
+        (BPF_LD_H_ABS, 0, BPF_JMP_JEQ_K, mac_high),
+        # not a fragment
+        (BPF_LD_H_ABS, IP_OFFSET + 6, BPF_JMP_JSET_K, 0x1fff),
+    ]
+    # the rest of checks are relative to the IP header length
+    checks_ind = [
+        (BPF_LD_H_IND, udp, BPF_JMP_JEQ_K, server_port),
+        (BPF_LD_H_IND, udp + 2, BPF_JMP_JEQ_K, client_port),
+        # BOOTP op
+        (BPF_LD_B_IND, udp + 8, BPF_JMP_JEQ_K, BOOTP_OP_REPLY),
+        # BOOTP xid
+        (BPF_LD_W_IND, udp + 12, BPF_JMP_JEQ_K, xid),
+    ]
+    # every check is 2 instructions, plus ldx and the 2 returns
+    ninsns = 2 * (len(checks) + len(checks_ind)) + 1 + 2
+    insns = []
+
+    def add_check(load, offset, jump, k):
+        insns.append((load, 0, 0, offset))
+        drop = ninsns - 1 - (len(insns) + 1)
+        if jump == BPF_JMP_JSET_K:
+            insns.append((jump, drop, 0, k))
+        else:
+            insns.append((jump, 0, drop, k))
+
+    for check in checks:
+        add_check(*check)
+    # x = IP header length
+    insns.append((BPF_LDX_B_MSH, 0, 0, IP_OFFSET))
+    for check in checks_ind:
+        add_check(*check)
+    insns.append((BPF_RET_K, 0, 0, 0xffff))
+    insns.append((BPF_RET_K, 0, 0, 0))
+    return insns
+
+
+class DHCPCAPListenSocket(SuperSocket):
+    """Layer 2 listening socket that does not dissect the received frames.
+
+    The frames are returned as scapy ``Raw`` packets, to be parsed by
+    :func:`dhcpcappkt.parse_reply`.
+
+    """
+    desc = 'read IP frames at layer 2 without dissecting them'
+
+    def __init__(self, iface=None, type=ETH_P_IP, **kargs):
+        self.iface = iface or conf.iface
+        self.type = type
+        self.ins = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                                 socket.htons(type))
+        self.ins.bind((self.iface, type))
+        self.outs = None
+        self.promisc = None
+        logger.debug('Listening on %s.', self.iface)
+
+    def attach_filter(self, bpf):
+        """Attach (or replace) the classic BPF program ``bpf``.
+
+        The frames queued before the filter was attached are discarded.
+
+        """
+        code = b''.join(BPF_INSN.pack(*insn) for insn in bpf)
+        # keep a reference to the buffer while attaching
+        self.bpf = ctypes.create_string_buffer(code, len(code))
+        fprog = struct.pack('HL', len(bpf), ctypes.addressof(self.bpf))
+        self.ins.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+        self.ins.setblocking(False)
+        try:
+            while True:
+                self.ins.recv(MTU)
+        except (BlockingIOError, socket.error):
+            pass
+        finally:
+            self.ins.setblocking(True)
+        logger.debug('Attached BPF filter to %s.', self.iface)
+
+    def recv(self, x=MTU):
+        """Receive a frame, ignoring the ones sent by this host."""
+        frame, sa_ll = self.ins.recvfrom(x)
+        if sa_ll[2] == socket.PACKET_OUTGOING:
+            return None
+        return conf.raw_layer(load=frame)
+
+    def send(self, x):
+        raise OSError(errno.EOPNOTSUPP, 'Can not send, %s.' % self.desc)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ins.close()
+
+
+class DHCPCAPSendSocket(SuperSocket):
+    """Layer 2 socket to send frames, opened once for all transmissions.
+
+    It does not receive any frame, it is bound with protocol 0.
+    The frames can be given already serialized, as bytes, or as scapy
+    packets.
+
+    """
+    desc = 'send frames at layer 2'
+
+    def __init__(self, iface=None, **kargs):
+        self.iface = iface or conf.iface
+        self.outs = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        self.outs.bind((self.iface, 0))
+        self.ins = None
+        self.promisc = None
+        logger.debug('Opened send socket on %s.', self.iface)
+
+    def send(self, x):
+        if not isinstance(x, (bytes, bytearray)):
+            x = bytes(x)
+        return self.outs.send(x)
+
+    def recv(self, x=MTU):
+        raise OSError(errno.EOPNOTSUPP, 'Can not receive, %s.' % self.desc)
+
+    def fileno(self):
+        return self.outs.fileno()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.outs.close()
+
+
+class DHCPCAPLoopbackSocket(SuperSocket):
+    """Socket to send and receive frames in memory, without an interface.
+
+    It wraps one end of a datagram socket pair, the frames sent are
+    received in the other end. As :class:`DHCPCAPListenSocket`, the frames
+    are returned as scapy ``Raw`` packets.
+
+    """
+    desc = 'send and receive frames in memory'
+
+    def __init__(self, sock):
+        self.ins = self.outs = sock
+        self.promisc = None
+
+    def send(self, x):
+        if not isinstance(x, (bytes, bytearray)):
+            x = bytes(x)
+        return self.outs.send(x)
+
+    def recv(self, x=MTU):
+        return conf.raw_layer(load=self.ins.recv(x))
+
+    def fileno(self):
+        return self.ins.fileno()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ins.close()
+
+
+@attr.s
+class RawTransport(object):
+    """Open layer 2 sockets on the interface the FSM runs on."""
+
+    def listen_socket(self, iface=None, **kargs):
+        """Return the socket where the replies are received."""
+        return DHCPCAPListenSocket(iface=iface)
+
+    def send_socket(self, iface=None, **kargs):
+        """Return the socket the frames are sent through."""
+        return DHCPCAPSendSocket(iface=iface)
+
+    def close(self):
+        pass
+
+
+@attr.s
+class LoopbackTransport(object):
+    """Pass the frames in memory to ``peer``.
+
+    ``peer`` is a datagram socket where the server receives the client
+    frames and sends the replies to the client. The client sends and
+    receives through the same :class:`DHCPCAPLoopbackSocket`.
+
+    """
+    sock = attr.ib(init=False)
+    peer = attr.ib(init=False)
+
+    def __attrs_post_init__(self):
+        sock, self.peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock = DHCPCAPLoopbackSocket(sock)
+
+    def listen_socket(self, **kargs):
+        """Return the client socket."""
+        return self.sock
+
+    def send_socket(self, **kargs):
+        """Return the client socket."""
+        return self.sock
+
+    def close(self):
+        """Close both ends."""
+        self.sock.close()
+        self.peer.close()
@@ -8,16 +8,21 @@ from __future__ import absolute_import
 import logging
 import random
 
+from scapy.arch import get_if_raw_hwaddr
 from scapy.arch.linux import get_if_list
 from scapy.layers.dhcp import DHCP, DHCPTypes
+from scapy.utils import str2mac
 
-from .constants import XID_MIN, XID_MAX
+from .constants import DHCPACK, DHCPNAK, DHCPOFFER, XID_MIN, XID_MAX
+from .dhcpcappkt import DHCPCAPReply
 
 logger = logging.getLogger(__name__)
 
 
 def isoffer(packet):
     """."""
+    if isinstance(packet, DHCPCAPReply):
+        return packet.message_type == DHCPOFFER
     if DHCP in packet and (DHCPTypes.get(packet[DHCP].options[0][1]) ==
                            'offer' or packet[DHCP].options[0][1] == "offer"):
         logger.debug('Packet is Offer.')
@@ -27,6 +32,8 @@ def isoffer(packet):
 
 def isnak(packet):
     """."""
+    if isinstance(packet, DHCPCAPReply):
+        return packet.message_type == DHCPNAK
     if DHCP in packet and (DHCPTypes.get(packet[DHCP].options[0][1]) ==
                            'nak' or packet[DHCP].options[0][1] == 'nak'):
         logger.debug('Packet is NAK.')
@@ -36,6 +43,8 @@ def isnak(packet):
 
 def isack(packet):
     """."""
+    if isinstance(packet, DHCPCAPReply):
+        return packet.message_type == DHCPACK
     if DHCP in packet and (DHCPTypes.get(packet[DHCP].options[0][1]) ==
                            'ack' or packet[DHCP].options[0][1] == 'ack'):
         logger.debug('Packet is ACK.')
@@ -43,6 +52,17 @@ def isack(packet):
     return False
 
 
+def get_client_mac(iface):
+    """Return the MAC address of the interface in ``00:01:02:...`` form."""
+    # scapy for python 3 returns byte, not tuple
+    tempmac = get_if_raw_hwaddr(iface)
+    if isinstance(tempmac, tuple) and len(tempmac) == 2:
+        mac = tempmac[1]
+    else:
+        mac = tempmac
+    return str2mac(mac)
+
+
 def gen_xid():
     return random.randint(XID_MIN, XID_MAX)
 
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# Copyright 2016, 2017 juga (juga at riseup dot net), MIT license.
+"""Python hooks for the DHCP client implementation of the Anonymity Profile
+([:rfc:`7844`]).
+
+A hook is a callable ``hook(lease, reason)`` that is called in the dhcpcanon
+process, every time the external script would be called, with the
+:class:`dhcpcaplease.DHCPCAPLease` and the reason a script would get
+(``BOUND``, ``RENEW``, ``REBIND``, ``EXPIRE``, ...,
+see :data:`constants.STATES2REASONS`).
+The lease times are numbers and the addresses :mod:`ipaddress` objects, the
+strings the script would get are in ``lease.views``.
+
+Packages register hooks in the ``dhcpcanon.hooks`` entry point group, ie::
+
+    setup(...,
+          entry_points={
+              'dhcpcanon.hooks': [
+                  'agent = network_agent.dhcp:on_lease',
+              ]
+          })
+
+and they are enabled by name, ie ``dhcpcanon --hook agent``.
+The hooks run in the FSM, so they must not block.
+
+"""
+from __future__ import absolute_import
+
+import logging
+
+from .constants import HOOKS_ENTRY_POINT_GROUP
+
+logger = logging.getLogger(__name__)
+
+
+def iter_entry_points(group=HOOKS_ENTRY_POINT_GROUP):
+    """Return the entry points installed in ``group``."""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        return pkg_resources.iter_entry_points(group)
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=group)
+    return eps.get(group, [])
+
+
+def load_hooks(names, group=HOOKS_ENTRY_POINT_GROUP):
+    """Load the hooks registered with ``names``.
+
+    Raise ValueError when a hook is not installed.
+
+    """
+    if not names:
+        return []
+    eps = {ep.name: ep for ep in iter_entry_points(group)}
+    hooks = []
+    for name in names:
+        if name not in eps:
+            raise ValueError('Hook %s is not installed.' % name)
+        hooks.append(eps[name].load())
+        logger.debug('Loaded hook %s.', name)
+    return hooks
+
+
+def call_hooks(hooks, lease, reason):
+    """Call the hooks, logging their errors."""
+    for hook in hooks:
+        try:
+            hook(lease, reason)
+        except Exception:
+            logger.error('Hook %r failed for %s', hook, reason,
+                         exc_info=True)
@@ -3,65 +3,401 @@
 # Copyright 2016, 2017 juga (juga at riseup dot net), MIT license.
 """Netowrk utils for the DHCP client implementation of the Anonymity Profile
 ([:rfc:`7844`])."""
+import errno
 import logging
 import os.path
+import socket
+import struct
 import subprocess
 
-from dbus import SystemBus, Interface, DBusException
-from pyroute2 import IPRoute
-from pyroute2.netlink import NetlinkError
+import attr
 
-from .constants import RESOLVCONF, RESOLVCONF_ADMIN
+from .constants import (DNS_BACKEND_RESOLVCONF, DNS_BACKEND_RESOLVCONF_ADMIN,
+                        DNS_BACKEND_RESOLVED, NETLINK_BUFFER_SIZE,
+                        NETLINK_GET_STRICT_CHK, RESOLVCONF, RESOLVCONF_ADMIN,
+                        RESOLVED_SERVICE, RT_TABLE_MAIN, SOL_NETLINK)
+
+# NOTE: pyroute2 and dbus are imported in the functions that use them, so
+# that they are only loaded when the network is configured and, for dbus,
+# only when systemd-resolved is used.
 
 logger = logging.getLogger(__name__)
 
+# netlink context shared by all the interfaces, see get_netlink
+netlink = None
+# D-Bus context shared by all the interfaces, see get_dns
+dns = None
 
-def set_net(lease):
-    ipr = IPRoute()
-    try:
-        index = ipr.link_lookup(ifname=lease.interface)[0]
-    except IndexError as e:
-        logger.error('Interface %s not found, can not set IP.',
-                     lease.interface)
+
+@attr.s(frozen=True)
+class NetConfig(object):
+    """Network configuration of a lease, as it is applied to the system."""
+    interface = attr.ib(default='')
+    address = attr.ib(default='')
+    prefixlen = attr.ib(default=0)
+    router = attr.ib(default='')
+    name_server = attr.ib(default='')
+
+    @classmethod
+    def from_lease(cls, lease):
+        views = lease.views
+        return cls(interface=lease.interface, address=views['address'],
+                   prefixlen=lease.subnet_mask_cidr or 0,
+                   router=views['router'], name_server=views['name_server'])
+
+
+class NetlinkContext(object):
+    """Netlink connection and interface indexes cache.
+
+    The connection is opened once and shared by the address, route and DNS
+    configuration of all the interfaces. The interface indexes are cached and
+    kept updated with the RTM_NEWLINK and RTM_DELLINK notifications, which
+    are read from a non blocking socket before every lookup.
+
+    The addresses and routes of an interface are dumped with the filter
+    checked by the kernel (``NETLINK_GET_STRICT_CHK``, linux >= 4.20), so
+    that only the ones of the interface are sent, instead of all the routing
+    table. Older kernels ignore the filter, and it is applied here.
+
+    The configuration applied to every interface is kept in ``applied``, to
+    compare it with the one of the next lease.
+
+    """
+
+    def __init__(self):
+        from pyroute2 import IPRoute
+        from pyroute2.netlink.rtnl import RTMGRP_LINK
+        from pyroute2.netlink.rtnl.marshal import MarshalRtnl
+        self.ipr = IPRoute()
+        self.monitor = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                     socket.NETLINK_ROUTE)
+        self.monitor.bind((0, RTMGRP_LINK))
+        self.monitor.setblocking(False)
+        self.request = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                     socket.NETLINK_ROUTE)
+        try:
+            self.request.setsockopt(SOL_NETLINK, NETLINK_GET_STRICT_CHK, 1)
+        except OSError as e:
+            logger.debug('Netlink dumps are not filtered by the kernel: %s.',
+                         e)
+        self.request.bind((0, 0))
+        self.sequence_number = 0
+        self.marshal = MarshalRtnl()
+        self.ifindexes = dict()
+        self.applied = dict()
+
+    def handle_link_event(self, msg):
+        """Update the interface indexes cache with a link notification."""
+        index = msg['index']
+        for ifname in [k for k, v in self.ifindexes.items() if v == index]:
+            del self.ifindexes[ifname]
+            self.applied.pop(ifname, None)
+        if msg['event'] == 'RTM_NEWLINK':
+            ifname = msg.get_attr('IFLA_IFNAME')
+            if ifname is not None:
+                self.ifindexes[ifname] = index
+
+    def poll_link_events(self):
+        """Read the pending link notifications, without blocking."""
+        while True:
+            try:
+                data = self.monitor.recv(NETLINK_BUFFER_SIZE)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                # the indexes are looked up again
+                self.ifindexes.clear()
+                if e.errno == errno.ENOBUFS:
+                    logger.debug('Link notifications lost: %s.', e)
+                    continue
+                logger.error('Could not read the link notifications: %s.',
+                             e)
+                return
+            for msg in self.marshal.parse(data):
+                if msg.get('event') in ('RTM_NEWLINK', 'RTM_DELLINK'):
+                    self.handle_link_event(msg)
+
+    def link_index(self, ifname):
+        """Return the index of the interface, None if it does not exist."""
+        self.poll_link_events()
+        index = self.ifindexes.get(ifname)
+        if index is None:
+            indexes = self.ipr.link_lookup(ifname=ifname)
+            if not indexes:
+                return None
+            index = self.ifindexes[ifname] = indexes[0]
+            logger.debug('Interface %s has index %s.', ifname, index)
+        return index
+
+    def dump(self, msg, msg_type):
+        """Send a dump request and return the messages answered."""
+        from pyroute2.netlink import (NLM_F_DUMP, NLM_F_REQUEST, NLMSG_DONE,
+                                      NLMSG_ERROR, NetlinkError)
+        self.sequence_number += 1
+        msg['header']['type'] = msg_type
+        msg['header']['flags'] = NLM_F_REQUEST | NLM_F_DUMP
+        msg['header']['sequence_number'] = self.sequence_number
+        msg.encode()
+        self.request.send(msg.data)
+        msgs = []
+        while True:
+            data = self.request.recv(NETLINK_BUFFER_SIZE)
+            for reply in self.marshal.parse(data):
+                header = reply['header']
+                if header['sequence_number'] != self.sequence_number:
+                    continue
+                if header['type'] == NLMSG_DONE:
+                    # the errors of a dump are sent in NLMSG_DONE
+                    if header['length'] >= 20:
+                        error = struct.unpack_from('i', reply.data,
+                                                   reply.offset + 16)[0]
+                        if error < 0:
+                            raise NetlinkError(-error)
+                    return msgs
+                if header['type'] == NLMSG_ERROR:
+                    raise header['error']
+                msgs.append(reply)
+
+    def addresses(self, index):
+        """Return the IPv4 addresses of ``index`` and their prefix length."""
+        from pyroute2.netlink.rtnl import RTM_GETADDR
+        from pyroute2.netlink.rtnl.ifaddrmsg import ifaddrmsg
+        msg = ifaddrmsg()
+        msg['family'] = socket.AF_INET
+        msg['index'] = index
+        return {addr.get_attr('IFA_ADDRESS'): addr['prefixlen']
+                for addr in self.dump(msg, RTM_GETADDR)
+                if addr['index'] == index}
+
+    def default_gateways(self, index):
+        """Return the gateways of the default routes through ``index``."""
+        from pyroute2.netlink.rtnl import RTM_GETROUTE
+        from pyroute2.netlink.rtnl.rtmsg import rtmsg
+        msg = rtmsg()
+        msg['family'] = socket.AF_INET
+        msg['table'] = RT_TABLE_MAIN
+        msg['attrs'] = [('RTA_TABLE', RT_TABLE_MAIN), ('RTA_OIF', index)]
+        return [route.get_attr('RTA_GATEWAY')
+                for route in self.dump(msg, RTM_GETROUTE)
+                if route['dst_len'] == 0 and
+                route.get_attr('RTA_OIF') == index and
+                route.get_attr('RTA_TABLE') == RT_TABLE_MAIN]
+
+    def close(self):
+        self.request.close()
+        self.monitor.close()
+        self.ipr.close()
+
+
+def get_netlink():
+    """Return the shared :class:`NetlinkContext`, opening it once."""
+    global netlink
+    if netlink is None:
+        netlink = NetlinkContext()
+    return netlink
+
+
+def close_netlink():
+    """Close the shared :class:`NetlinkContext`, if it was opened."""
+    global netlink
+    if netlink is not None:
+        netlink.close()
+        netlink = None
+
+
+def set_address(nl, index, config, applied=None):
+    """Set the address of ``config`` when it is not in the interface.
+
+    The address of the previously ``applied`` configuration, and the same
+    address with other prefix length, are removed.
+
+    """
+    from pyroute2.netlink import NetlinkError
+    addresses = nl.addresses(index)
+    if addresses.get(config.address) == config.prefixlen:
+        logger.debug('Interface %s is already set to IP %s',
+                     config.interface, config.address)
+        return False
+    stale = set(address for address in
+                (config.address, applied and applied.address)
+                if address in addresses)
     try:
-        ipr.addr('add', index, address=lease.address,
-                 mask=int(lease.subnet_mask_cidr))
+        for address in stale:
+            nl.ipr.addr('del', index=index, address=address,
+                        mask=addresses[address])
+            logger.debug('Removed IP %s from interface %s', address,
+                         config.interface)
+        nl.ipr.addr('add', index=index, address=config.address,
+                    mask=config.prefixlen)
     except NetlinkError as e:
-        if ipr.get_addr(index=index)[0].\
-                get_attrs('IFA_ADDRESS')[0] == lease.address:
-            logger.debug('Interface %s is already set to IP %s' %
-                         (lease.interface, lease.address))
-        else:
-            logger.error(e)
-    else:
-        logger.debug('Interface %s set to IP %s' %
-                     (lease.interface, lease.address))
+        logger.error(e)
+        return False
+    logger.debug('Interface %s set to IP %s', config.interface,
+                 config.address)
+    return True
+
+
+def set_default_route(nl, index, config, applied=None):
+    """Set the default route of ``config`` when it is not in the table.
+
+    The default route through the router of the previously ``applied``
+    configuration is removed.
+
+    """
+    from pyroute2.netlink import NetlinkError
+    if not config.router:
+        return False
+    gateways = nl.default_gateways(index)
+    if config.router in gateways:
+        logger.debug('Default gateway is already set to %s', config.router)
+        return False
     try:
-        ipr.route('add', dst='0.0.0.0', gateway=lease.router, oif=index)
+        if applied is not None and applied.router in gateways:
+            nl.ipr.route('del', dst='0.0.0.0/0', gateway=applied.router,
+                         oif=index)
+            logger.debug('Removed default gateway %s', applied.router)
+        nl.ipr.route('add', dst='0.0.0.0', gateway=config.router, oif=index)
     except NetlinkError as e:
-        if ipr.get_routes(table=254)[0].\
-                get_attrs('RTA_GATEWAY')[0] == lease.router:
-            logger.debug('Default gateway is already set to %s' %
-                         (lease.router))
-        else:
-            logger.error(e)
+        logger.error(e)
+        return False
+    logger.debug('Default gateway set to %s', config.router)
+    return True
+
+
+def set_net(lease):
+    """Configure the interface of the lease, changing only what differs.
+
+    The address and default route are compared with the ones in the kernel,
+    which is read with filtered dumps, and the DNS servers with the ones of
+    the configuration previously applied to the interface, so that renewing
+    a lease with the same parameters does not write anything.
+
+    """
+    nl = get_netlink()
+    index = nl.link_index(lease.interface)
+    if index is None:
+        logger.error('Interface %s not found, can not set IP.',
+                     lease.interface)
+        return
+    config = NetConfig.from_lease(lease)
+    applied = nl.applied.get(lease.interface)
+    set_address(nl, index, config, applied)
+    set_default_route(nl, index, config, applied)
+    if applied is None or applied.name_server != config.name_server:
+        set_dns(lease)
     else:
-        logger.debug('Default gateway set to %s', lease.router)
-    ipr.close()
-    set_dns(lease)
+        logger.debug('DNS servers are already set to %s', config.name_server)
+    nl.applied[lease.interface] = config
+
+
+class DNSContext(object):
+    """D-Bus connection and DNS backend detection.
+
+    The system bus connection is opened once, and the DNS backend is
+    detected the first time it is needed. When a call to systemd-resolved
+    fails, because it was restarted or stopped, the connection is opened
+    and the backend detected again, see :func:`set_dns_systemd_resolved`.
+
+    """
+
+    def __init__(self):
+        self.bus = None
+        self.backend = None
+        self.resolved_manager = None
+        self.unit_path = None
+
+    def get_bus(self):
+        """Return the system bus connection, opening it once."""
+        if self.bus is None:
+            from dbus import SystemBus
+            self.bus = SystemBus()
+        return self.bus
+
+    def refresh(self):
+        """Forget the connection and the backend, to get them again."""
+        logger.debug('DNS backend will be detected again.')
+        self.bus = None
+        self.backend = None
+        self.resolved_manager = None
+        self.unit_path = None
+
+    def systemd_resolved_status(self):
+        """Whether the systemd-resolved unit is active."""
+        from dbus import Interface
+        bus = self.get_bus()
+        if self.unit_path is None:
+            systemd = bus.get_object('org.freedesktop.systemd1',
+                                     '/org/freedesktop/systemd1')
+            manager = Interface(
+                systemd, dbus_interface='org.freedesktop.systemd1.Manager')
+            self.unit_path = str(manager.LoadUnit(RESOLVED_SERVICE))
+        proxy = bus.get_object('org.freedesktop.systemd1', self.unit_path)
+        r = proxy.Get('org.freedesktop.systemd1.Unit',
+                      'ActiveState',
+                      dbus_interface='org.freedesktop.DBus.Properties')
+        return str(r) == 'active'
+
+    def get_backend(self):
+        """Return the DNS backend, detecting it the first time."""
+        if self.backend is None:
+            from dbus import DBusException
+            try:
+                resolved = self.systemd_resolved_status()
+            except DBusException as e:
+                logger.debug('Can not get systemd-resolved status: %s', e)
+                resolved = False
+            if resolved:
+                self.backend = DNS_BACKEND_RESOLVED
+            elif os.path.exists(RESOLVCONF_ADMIN):
+                self.backend = DNS_BACKEND_RESOLVCONF_ADMIN
+            elif os.path.exists(RESOLVCONF):
+                self.backend = DNS_BACKEND_RESOLVCONF
+            else:
+                self.backend = ''
+            logger.debug('DNS backend: %s', self.backend or 'none')
+        return self.backend
+
+    def get_resolved_manager(self):
+        """Return the systemd-resolved manager interface."""
+        if self.resolved_manager is None:
+            from dbus import Interface
+            resolved = self.get_bus().get_object('org.freedesktop.resolve1',
+                                                 '/org/freedesktop/resolve1')
+            self.resolved_manager = Interface(
+                resolved, dbus_interface='org.freedesktop.resolve1.Manager')
+        return self.resolved_manager
+
+    def close(self):
+        self.refresh()
+
+
+def get_dns():
+    """Return the shared :class:`DNSContext`, creating it once."""
+    global dns
+    if dns is None:
+        dns = DNSContext()
+    return dns
+
+
+def close_dns():
+    """Close the shared :class:`DNSContext`, if it was created."""
+    global dns
+    if dns is not None:
+        dns.close()
+        dns = None
 
 
 def set_dns(lease):
-    if systemd_resolved_status() is True:
-        set_dns_systemd_resolved(lease)
-    elif os.path.exists(RESOLVCONF_ADMIN):
-        set_dns_resolvconf_admin(lease)
-    elif os.path.exists(RESOLVCONF):
-        set_dns_resolvconf(lease)
+    backend = get_dns().get_backend()
+    if backend:
+        return DNS_BACKENDS[backend](lease)
+    logger.debug('No DNS backend, DNS servers not set.')
+    return False
 
 
 def set_dns_resolvconf_admin(lease):
-    cmd = [RESOLVCONF_ADMIN, 'add', lease.interface, lease.name_server]
+    cmd = [RESOLVCONF_ADMIN, 'add', lease.interface,
+           lease.views['name_server']]
     proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                             stderr=subprocess.PIPE)
     try:
@@ -76,8 +412,7 @@ def set_dns_resolvconf(lease):
     cmd = [RESOLVCONF, '-a', lease.interface]
     proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdin = '\n'.join(['nameserver ' + nm for nm in
-                       lease.name_server.split()])
+    stdin = '\n'.join(['nameserver %s' % nm for nm in lease.name_server])
     stdin = str.encode(stdin)
     try:
         (stdout, stderr) = proc.communicate(stdin)
@@ -90,42 +425,38 @@ def set_dns_resolvconf(lease):
 def set_dns_systemd_resolved(lease):
     # NOTE: if systemd-resolved is not already running, we might not want to
     # run it in case there's specific system configuration for other resolvers
-    ipr = IPRoute()
-    index = ipr.link_lookup(ifname=lease.interface)[0]
+    from dbus import DBusException
+    index = get_netlink().link_index(lease.interface)
     # Construct the argument to pass to DBUS.
     # the equivalent argument for:
     # busctl call org.freedesktop.resolve1 /org/freedesktop/resolve1 \
     # org.freedesktop.resolve1.Manager SetLinkDNS 'ia(iay)' 2 1 2 4 1 2 3 4
     # is SetLinkDNS(2, [(2, [8, 8, 8, 8])]_
-    iay = [(2, [int(b) for b in ns.split('.')])
-           for ns in lease.name_server.split()]
+    iay = [(2, list(ns.packed)) for ns in lease.name_server]
     #        if '.' in ns
     #        else (10, [ord(x) for x in
     #            socket.inet_pton(socket.AF_INET6, ns)])
-    bus = SystemBus()
-    resolved = bus.get_object('org.freedesktop.resolve1',
-                              '/org/freedesktop/resolve1')
-    manager = Interface(resolved,
-                        dbus_interface='org.freedesktop.resolve1.Manager')
-    try:
-        manager.SetLinkDNS(index, iay)
-        return True
-    except DBusException as e:
-        logger.error(e)
-        return False
+    context = get_dns()
+    for _ in range(2):
+        try:
+            context.get_resolved_manager().SetLinkDNS(index, iay)
+            return True
+        except DBusException as e:
+            # systemd-resolved was restarted or stopped
+            logger.debug('Can not set the DNS servers: %s', e)
+            context.refresh()
+        if context.get_backend() != DNS_BACKEND_RESOLVED:
+            return set_dns(lease)
+    logger.error('systemd-resolved did not set the DNS servers.')
+    return False
 
 
 def systemd_resolved_status():
-    bus = SystemBus()
-    systemd = bus.get_object('org.freedesktop.systemd1',
-                             '/org/freedesktop/systemd1')
-    manager = Interface(systemd,
-                        dbus_interface='org.freedesktop.systemd1.Manager')
-    unit = manager.LoadUnit('sytemd-resolved.service')
-    proxy = bus.get_object('org.freedesktop.systemd1', str(unit))
-    r = proxy.Get('org.freedesktop.systemd1.Unit',
-                  'ActiveState',
-                  dbus_interface='org.freedesktop.DBus.Properties')
-    if str(r) == 'active':
-        return True
-    return False
+    return get_dns().systemd_resolved_status()
+
+
+DNS_BACKENDS = {
+    DNS_BACKEND_RESOLVED: set_dns_systemd_resolved,
+    DNS_BACKEND_RESOLVCONF_ADMIN: set_dns_resolvconf_admin,
+    DNS_BACKEND_RESOLVCONF: set_dns_resolvconf,
+}
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# Copyright 2016, 2017 juga (juga at riseup dot net), MIT license.
+"""Offer selection policies for the DHCP client implementation of the
+Anonymity Profile ([:rfc:`7844`]).
+
+[:rfc:`2131#section-4.4.1`]::
+
+    The time
+    over which the client collects messages and the mechanism used to
+    select one DHCPOFFER are implementation dependent.
+
+A policy decides whether an offer is acceptable, whether an offer is good
+enough to stop collecting offers and request it at once (early commit), and
+which offer to select when the collection window, started when the first
+offer is received, expires.
+
+"""
+from __future__ import absolute_import
+
+import logging
+import socket
+import struct
+
+import attr
+
+from .constants import (DHCP_OPTION_LEASE_TIME, DHCP_OPTION_SERVER_ID,
+                        OFFER_WINDOW)
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s
+class Offer(object):
+    """A received offer and the seconds it took since the DISCOVER."""
+    reply = attr.ib()
+    latency = attr.ib(default=0.0)
+
+    @property
+    def server_id(self):
+        server_id = self.reply.options.get(DHCP_OPTION_SERVER_ID)
+        if server_id is None or len(server_id) < 4:
+            return self.reply.server_ip
+        return socket.inet_ntoa(server_id[:4])
+
+    @property
+    def lease_time(self):
+        lease_time = self.reply.options.get(DHCP_OPTION_LEASE_TIME)
+        if lease_time is None or len(lease_time) < 4:
+            return 0
+        return struct.unpack('!I', lease_time[:4])[0]
+
+
+@attr.s
+class FirstOfferPolicy(object):
+    """Request the first offer received, without waiting for more."""
+    window = attr.ib(default=OFFER_WINDOW)
+
+    def acceptable(self, offer):
+        """Whether the offer can be selected."""
+        return True
+
+    def satisfies(self, offer):
+        """Whether the offer is requested without waiting for more."""
+        return True
+
+    def select(self, offers):
+        """Select an offer from the ones collected."""
+        return offers[0]
+
+
+@attr.s
+class LowestLatencyPolicy(FirstOfferPolicy):
+    """Select the offer that arrived the soonest after its DISCOVER.
+
+    An offer arriving in less than ``max_latency`` seconds is requested
+    without waiting for more.
+
+    """
+    max_latency = attr.ib(default=None)
+
+    def satisfies(self, offer):
+        return self.max_latency is not None and \
+            offer.latency <= self.max_latency
+
+    def select(self, offers):
+        return min(offers, key=lambda offer: offer.latency)
+
+
+@attr.s
+class LongestLeasePolicy(FirstOfferPolicy):
+    """Select the offer with the longest lease time.
+
+    An offer with a lease of at least ``min_lease_time`` seconds is requested
+    without waiting for more.
+
+    """
+    min_lease_time = attr.ib(default=None)
+
+    def satisfies(self, offer):
+        return self.min_lease_time is not None and \
+            offer.lease_time >= self.min_lease_time
+
+    def select(self, offers):
+        return max(offers, key=lambda offer: offer.lease_time)
+
+
+@attr.s
+class PreferredServerPolicy(FirstOfferPolicy):
+    """Select the offer from the most preferred server in ``server_ids``.
+
+    An offer from the most preferred server is requested without waiting for
+    more. When no offer comes from a preferred server, the first one is
+    selected, unless ``only_preferred``.
+
+    """
+    server_ids = attr.ib(default=attr.Factory(list))
+    only_preferred = attr.ib(default=False)
+
+    def acceptable(self, offer):
+        return not self.only_preferred or offer.server_id in self.server_ids
+
+    def satisfies(self, offer):
+        return bool(self.server_ids) and \
+            offer.server_id == self.server_ids[0]
+
+    def select(self, offers):
+        def preference(offer):
+            if offer.server_id in self.server_ids:
+                return self.server_ids.index(offer.server_id)
+            return len(self.server_ids)
+        # min returns the first of the offers with the same preference
+        return min(offers, key=preference)
+
+
+OFFER_POLICIES = {
+    'first': FirstOfferPolicy,
+    'latency': LowestLatencyPolicy,
+    'lease': LongestLeasePolicy,
+    'server': PreferredServerPolicy,
+}
+
+
+def gen_offer_policy(name='first', **kwargs):
+    """Create the offer selection policy called ``name``.
+
+    The keyword arguments with None value are not passed, so that the
+    policy defaults are used.
+
+    """
+    kwargs = {k: v for k, v in kwargs.items() if v is not None}
+    logger.debug('Offer policy %s with %s.', name, kwargs)
+    return OFFER_POLICIES[name](**kwargs)
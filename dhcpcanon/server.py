@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# Copyright 2016, 2017 juga (juga at riseup dot net), MIT license.
+"""DHCP server stand-in to run the DHCP client implementation of the
+Anonymity Profile ([:rfc:`7844`]) end to end in tests and benchmarks.
+
+It is not a DHCP server to deploy: it serves a single subnet from a
+consecutive address pool, does not store its bindings and answers without
+checking whether the addresses are in use. The faults a client finds in
+real networks can be injected: ``latency`` delays every reply, ``drop_rate``
+is the probability of ignoring a received message and ``nak_rate`` the
+probability of answering a valid REQUEST with a DHCPNAK.
+
+The server answers on datagram sockets, ie the ``peer`` of a
+:class:`dhcpcapsock.LoopbackTransport`, or on layer 2 sockets opened with
+:func:`raw_socket`, ie on one end of a veth pair in a network namespace::
+
+    server = DHCPServer(lease_time=60, drop_rate=0.1)
+    server.start([transport.peer])
+    ...
+    server.stop()
+    print(server.stats)
+
+"""
+from __future__ import absolute_import
+
+import collections
+import heapq
+import itertools
+import logging
+import random
+import select
+import socket
+import struct
+import threading
+import time
+
+import attr
+from scapy.data import ETH_P_IP, MTU
+
+from .constants import (BOOTP_MAGIC_COOKIE, BOOTP_OP_REPLY,
+                        BOOTP_OP_REQUEST, BROADCAST_ADDR, CLIENT_PORT,
+                        DHCP_OPTION_BROADCAST_ADDRESS, DHCP_OPTION_DOMAIN,
+                        DHCP_OPTION_LEASE_TIME, DHCP_OPTION_MESSAGE_TYPE,
+                        DHCP_OPTION_NAME_SERVER, DHCP_OPTION_REBINDING_TIME,
+                        DHCP_OPTION_RENEWAL_TIME, DHCP_OPTION_REQUESTED_ADDR,
+                        DHCP_OPTION_ROUTER, DHCP_OPTION_SERVER_ID,
+                        DHCP_OPTION_SUBNET_MASK, DHCPACK, DHCPDECLINE,
+                        DHCPDISCOVER, DHCPINFORM, DHCPNAK, DHCPOFFER,
+                        DHCPRELEASE, DHCPREQUEST, ETHER_TYPE_IP,
+                        IP_PROTO_UDP, SERVER_LEASE_TIME,
+                        SERVER_POLL_INTERVAL, SERVER_PORT)
+from .dhcpcappkt import (BOOTP_HDR, COOKIE_OFFSET, ETHER_HDR, IP_OFFSET,
+                         UDP_HDR, UDP_OFFSET, XID, bytes2mac, gen_template,
+                         parse_options)
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_TYPES2NAMES = {
+    DHCPDISCOVER: 'discover',
+    DHCPOFFER: 'offer',
+    DHCPREQUEST: 'request',
+    DHCPDECLINE: 'decline',
+    DHCPACK: 'ack',
+    DHCPNAK: 'nak',
+    DHCPRELEASE: 'release',
+    DHCPINFORM: 'inform',
+}
+
+
+@attr.s
+class DHCPRequest(object):
+    """DHCP client message read from the frame bytes."""
+    xid = attr.ib()
+    client_mac = attr.ib()
+    ciaddr = attr.ib()
+    message_type = attr.ib()
+    options = attr.ib(default=attr.Factory(dict))
+
+    def option_addr(self, code):
+        """Return the address in the option ``code`` or None."""
+        value = self.options.get(code)
+        if value is None or len(value) < 4:
+            return None
+        return socket.inet_ntoa(value[:4])
+
+
+def parse_request(frame):
+    """Parse a DHCP client frame into a :class:`DHCPRequest`.
+
+    Return None when the frame is not a DHCP message to a server.
+
+    """
+    buf = memoryview(frame)
+    if len(buf) < UDP_OFFSET or \
+            ETHER_HDR.unpack_from(buf)[2] != ETHER_TYPE_IP:
+        return None
+    version_ihl = buf[IP_OFFSET]
+    if version_ihl >> 4 != 4 or buf[IP_OFFSET + 9] != IP_PROTO_UDP:
+        return None
+    udp_offset = IP_OFFSET + (version_ihl & 0x0f) * 4
+    bootp_offset = udp_offset + UDP_HDR.size
+    options_offset = bootp_offset + COOKIE_OFFSET + len(BOOTP_MAGIC_COOKIE)
+    if len(buf) < options_offset or \
+            UDP_HDR.unpack_from(buf, udp_offset)[1] != SERVER_PORT or \
+            buf[bootp_offset + COOKIE_OFFSET:options_offset] != \
+            BOOTP_MAGIC_COOKIE:
+        return None
+    (op, _, hlen, _, xid, _, _, ciaddr, _, _, _, chaddr, _, _) = \
+        BOOTP_HDR.unpack_from(buf, bootp_offset)
+    if op != BOOTP_OP_REQUEST:
+        return None
+    options = parse_options(buf, options_offset)
+    message_type = options.get(DHCP_OPTION_MESSAGE_TYPE)
+    if not message_type:
+        return None
+    return DHCPRequest(xid=xid, client_mac=bytes2mac(chaddr[:hlen]),
+                       ciaddr=socket.inet_ntoa(ciaddr),
+                       message_type=bytearray(message_type)[0],
+                       options=options)
+
+
+def raw_socket(iface):
+    """Open a layer 2 socket on ``iface`` to serve the clients on its link.
+
+    It needs ``CAP_NET_RAW``.
+
+    """
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW,
+                         socket.htons(ETH_P_IP))
+    sock.bind((iface, ETH_P_IP))
+    return sock
+
+
+def addr2int(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def int2addr(number):
+    return socket.inet_ntoa(struct.pack('!I', number))
+
+
+@attr.s
+class DHCPServer(object):
+    """DHCP server stand-in, with the faults described in the module.
+
+    The addresses are allocated from ``pool_size`` consecutive addresses
+    starting at ``pool_start``. The renewal and rebinding times are only
+    sent when given. ``seed`` makes the injected faults reproducible.
+    ``stats`` counts the messages received, dropped and sent by type.
+
+    """
+    server_mac = attr.ib(default='00:0a:0b:0c:0d:0f')
+    server_ip = attr.ib(default='192.168.1.1')
+    subnet_mask = attr.ib(default='255.255.255.0')
+    pool_start = attr.ib(default='192.168.1.100')
+    pool_size = attr.ib(default=100)
+    name_server = attr.ib(default='192.168.1.1')
+    domain = attr.ib(default='localdomain')
+    lease_time = attr.ib(default=SERVER_LEASE_TIME)
+    renewal_time = attr.ib(default=None)
+    rebinding_time = attr.ib(default=None)
+    latency = attr.ib(default=0.0)
+    drop_rate = attr.ib(default=0.0)
+    nak_rate = attr.ib(default=0.0)
+    seed = attr.ib(default=None)
+
+    def __attrs_post_init__(self):
+        self.random = random.Random(self.seed)
+        start = addr2int(self.pool_start)
+        self.free = collections.deque(int2addr(start + i)
+                                      for i in range(self.pool_size))
+        # client MAC to address offered or bound
+        self.bindings = dict()
+        self.stats = collections.Counter()
+        mask = addr2int(self.subnet_mask)
+        self.broadcast_address = int2addr(
+            addr2int(self.server_ip) & mask | ~mask & 0xffffffff)
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def allocate(self, client_mac, address=None):
+        """Return the address bound to the client, binding a free one.
+
+        ``address`` is bound when it is free. Return None when there is no
+        free address.
+
+        """
+        if client_mac in self.bindings:
+            return self.bindings[client_mac]
+        if address is not None and address in self.free:
+            self.free.remove(address)
+        elif self.free:
+            address = self.free.popleft()
+        else:
+            logger.warning('No free addresses for %s.', client_mac)
+            return None
+        self.bindings[client_mac] = address
+        return address
+
+    def release(self, client_mac, reuse=True):
+        """Remove the client binding, reusing its address unless declined."""
+        address = self.bindings.pop(client_mac, None)
+        if address is not None and reuse:
+            self.free.append(address)
+
+    def gen_options(self, message_type):
+        options = [(DHCP_OPTION_MESSAGE_TYPE, struct.pack('!B', message_type)),
+                   (DHCP_OPTION_SERVER_ID, socket.inet_aton(self.server_ip))]
+        if message_type == DHCPNAK:
+            return options
+        options.append((DHCP_OPTION_LEASE_TIME,
+                        XID.pack(int(self.lease_time))))
+        if self.renewal_time is not None:
+            options.append((DHCP_OPTION_RENEWAL_TIME,
+                            XID.pack(int(self.renewal_time))))
+        if self.rebinding_time is not None:
+            options.append((DHCP_OPTION_REBINDING_TIME,
+                            XID.pack(int(self.rebinding_time))))
+        options.extend([
+            (DHCP_OPTION_SUBNET_MASK, socket.inet_aton(self.subnet_mask)),
+            (DHCP_OPTION_BROADCAST_ADDRESS,
+             socket.inet_aton(self.broadcast_address)),
+            (DHCP_OPTION_ROUTER, socket.inet_aton(self.server_ip)),
+            (DHCP_OPTION_NAME_SERVER, socket.inet_aton(self.name_server)),
+            (DHCP_OPTION_DOMAIN, self.domain.encode('utf8')),
+        ])
+        return options
+
+    def gen_reply(self, request, message_type, address=None):
+        """Serialize the reply of ``message_type`` to ``request``."""
+        self.stats[MESSAGE_TYPES2NAMES[message_type]] += 1
+        return gen_template(
+            self.server_mac, request.client_mac, self.server_ip,
+            address or BROADCAST_ADDR, SERVER_PORT, CLIENT_PORT,
+            self.gen_options(message_type), xid=request.xid,
+            op=BOOTP_OP_REPLY, yiaddr=address or '0.0.0.0',
+            siaddr=self.server_ip, chaddr=request.client_mac).patch(
+            request.xid)
+
+    def handle_request(self, request):
+        """Answer a DHCPREQUEST [:rfc:`2131#section-4.3.2`].
+
+        The requested address is the one in the Requested IP Address option
+        when selecting or rebooting, and ``ciaddr`` when renewing or
+        rebinding. It is acknowledged when it is the one bound to the
+        client, or when the client has no binding and it is free.
+
+        """
+        server_id = request.option_addr(DHCP_OPTION_SERVER_ID)
+        if server_id is not None and server_id != self.server_ip:
+            # the client selected the offer of another server
+            self.release(request.client_mac)
+            return []
+        requested = request.option_addr(DHCP_OPTION_REQUESTED_ADDR)
+        if requested is None:
+            requested = request.ciaddr
+        address = self.bindings.get(request.client_mac)
+        if address is None and requested in self.free:
+            address = self.allocate(request.client_mac, requested)
+        if address != requested or self.random.random() < self.nak_rate:
+            return [self.gen_reply(request, DHCPNAK)]
+        return [self.gen_reply(request, DHCPACK, address)]
+
+    def handle(self, frame):
+        """Return the reply frames to a received frame."""
+        request = parse_request(frame)
+        if request is None:
+            return []
+        name = MESSAGE_TYPES2NAMES.get(request.message_type)
+        if name is None:
+            return []
+        self.stats['received ' + name] += 1
+        if self.random.random() < self.drop_rate:
+            self.stats['dropped'] += 1
+            return []
+        if request.message_type == DHCPDISCOVER:
+            address = self.allocate(
+                request.client_mac,
+                request.option_addr(DHCP_OPTION_REQUESTED_ADDR))
+            if address is None:
+                return []
+            return [self.gen_reply(request, DHCPOFFER, address)]
+        if request.message_type == DHCPREQUEST:
+            return self.handle_request(request)
+        if request.message_type == DHCPRELEASE:
+            self.release(request.client_mac)
+        elif request.message_type == DHCPDECLINE:
+            self.release(request.client_mac, reuse=False)
+        return []
+
+    def serve(self, socks, stopped):
+        """Answer the frames received on ``socks`` until ``stopped`` is set.
+
+        The replies are sent ``latency`` seconds later, through the socket
+        where the message was received.
+
+        """
+        pending = []
+        counter = itertools.count()
+        while not stopped.is_set():
+            timeout = SERVER_POLL_INTERVAL
+            if pending:
+                timeout = min(timeout,
+                              max(pending[0][0] - time.monotonic(), 0))
+            for sock in select.select(socks, [], [], timeout)[0]:
+                try:
+                    frame = sock.recv(MTU)
+                except OSError:
+                    continue
+                due = time.monotonic() + self.latency
+                for reply in self.handle(frame):
+                    heapq.heappush(pending, (due, next(counter), sock, reply))
+            now = time.monotonic()
+            while pending and pending[0][0] <= now:
+                sock, reply = heapq.heappop(pending)[2:]
+                try:
+                    sock.send(reply)
+                except OSError as e:
+                    logger.debug('Can not send reply: %s', e)
+
+    def start(self, socks):
+        """Serve ``socks`` in a thread."""
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.serve,
+                                       args=(socks, self.stopped),
+                                       name='dhcpcanon-server', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the thread started by :meth:`start`."""
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
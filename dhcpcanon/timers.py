@@ -5,11 +5,17 @@
 ([:rfc:`7844`])."""
 from __future__ import absolute_import
 
+import asyncio
+import heapq
+import itertools
 import logging
 import random
+import selectors
+import time
 from datetime import datetime, timedelta
 
-from .constants import (DT_PRINT_FORMAT, MAX_DELAY_SELECTING, REBIND_PERC,
+from .constants import (DT_PRINT_FORMAT, MAX_DELAY_SELECTING,
+                        MIN_TIMERS_CANCELLED_COMPACT, REBIND_PERC,
                         RENEW_PERC)
 
 logger = logging.getLogger(__name__)
@@ -17,19 +23,110 @@ logger = logging.getLogger(__name__)
 
 def future_dt_str(dt, td):
     """."""
-    if isinstance(td, str):
-        td = float(td)
     td = timedelta(seconds=td)
     future_dt = dt + td
     return future_dt.strftime(DT_PRINT_FORMAT)
 
 
+class Clock(object):
+    """Local wall time and monotonic time of the system."""
+
+    def now(self):
+        # NOTE: Not using UTC, as all the timers are set in reference to
+        # local time
+        # now = datetime.utcnow().replace(tzinfo=utc)
+        return datetime.now()
+
+    def monotonic(self):
+        """Seconds of a clock that is not stepped when the wall time is set.
+
+        ``CLOCK_BOOTTIME`` when available, as unlike ``CLOCK_MONOTONIC`` it
+        also counts the time suspended, during which the leases also pass.
+
+        """
+        if hasattr(time, 'CLOCK_BOOTTIME'):
+            return time.clock_gettime(time.CLOCK_BOOTTIME)
+        return time.monotonic()
+
+
+class VirtualClock(Clock):
+    """Simulated clock that only advances when the client would wait.
+
+    The event loops created with :meth:`new_event_loop` take their time from
+    this clock and, when no file descriptor is ready, advance it to the next
+    timer instead of sleeping, so that a lease lifetime runs at once.
+    Install it with :func:`set_clock` so that :func:`nowutc` and
+    :func:`monotime`, and then the lease times, also return the simulated
+    time.
+
+    """
+
+    def __init__(self, start=None):
+        self.start = start or datetime.now()
+        self.elapsed = 0.0
+
+    def now(self):
+        return self.start + timedelta(seconds=self.elapsed)
+
+    def monotonic(self):
+        """Seconds since the clock was created."""
+        return self.elapsed
+
+    def advance(self, seconds):
+        self.elapsed += max(seconds, 0)
+
+    def new_event_loop(self):
+        """Create an asyncio event loop running on this clock."""
+        return VirtualClockLoop(self)
+
+
+class VirtualClockSelector(selectors.DefaultSelector):
+    """Selector that advances a :class:`VirtualClock` instead of waiting."""
+
+    def __init__(self, clock):
+        super(VirtualClockSelector, self).__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        ready = super(VirtualClockSelector, self).select(0)
+        if ready or timeout == 0:
+            return ready
+        if timeout is None:
+            # nothing scheduled, only another thread can wake the loop
+            return super(VirtualClockSelector, self).select(None)
+        self.clock.advance(timeout)
+        return []
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Event loop whose time is a :class:`VirtualClock`."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        super(VirtualClockLoop, self).__init__(VirtualClockSelector(clock))
+
+    def time(self):
+        return self.clock.monotonic()
+
+
+clock = Clock()
+
+
+def set_clock(new_clock=None):
+    """Set the clock :func:`nowutc` and :func:`monotime` read, the system
+    one by default."""
+    global clock
+    clock = new_clock or Clock()
+
+
 def nowutc():
-    """."""
-    # NOTE: Not using UTC, as all the timers are set in reference to local time
-    # now = datetime.utcnow().replace(tzinfo=utc)
-    now = datetime.now()
-    return now
+    """Return the local wall time of the current clock."""
+    return clock.now()
+
+
+def monotime():
+    """Return the monotonic time of the current clock."""
+    return clock.monotonic()
 
 
 def gen_delay_selecting():
@@ -43,8 +140,9 @@ def gen_delay_selecting():
     """
     delay = float(random.randint(0, MAX_DELAY_SELECTING))
     logger.debug('Delay to enter in SELECTING %s.', delay)
-    logger.debug('SELECTING will happen on %s',
-                 future_dt_str(nowutc(), delay))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('SELECTING will happen on %s',
+                     future_dt_str(nowutc(), delay))
     return delay
 
 
@@ -70,8 +168,9 @@ def gen_timeout_resend(attempts):
 
     """
     timeout = 2 ** (attempts + 1) + random.uniform(-1, +1)
-    logger.debug('next timeout resending will happen on %s',
-                 future_dt_str(nowutc(), timeout))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('next timeout resending will happen on %s',
+                     future_dt_str(nowutc(), timeout))
     return timeout
 
 
@@ -89,11 +188,12 @@ def gen_timeout_request_renew(lease):
         DHCPREQUEST message.
 
     """
-    time_left = (lease.rebinding_time - lease.renewing_time) * RENEW_PERC
+    time_left = (lease.rebinding_time - lease.renewal_time) * RENEW_PERC
     if time_left < 60:
         time_left = 60
-    logger.debug('Next request in renew will happen on %s',
-                 future_dt_str(nowutc(), time_left))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Next request in renew will happen on %s',
+                     future_dt_str(nowutc(), time_left))
     return time_left
 
 
@@ -102,8 +202,9 @@ def gen_timeout_request_rebind(lease):
     time_left = (lease.lease_time - lease.rebinding_time) * RENEW_PERC
     if time_left < 60:
         time_left = 60
-    logger.debug('Next request on rebinding will happen on %s',
-                 future_dt_str(nowutc(), time_left))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Next request on rebinding will happen on %s',
+                     future_dt_str(nowutc(), time_left))
     return time_left
 
 
@@ -119,11 +220,11 @@ def gen_renewing_time(lease_time, elapsed=0):
         client reacquisition.
 
     """
-    renewing_time = int(lease_time) * RENEW_PERC - elapsed
+    renewing_time = lease_time * RENEW_PERC - elapsed
     # FIXME:80 [:rfc:`2131#section-4.4.5`]: the chosen "fuzz" could fingerprint
     # the implementation
     # NOTE: here using same "fuzz" as systemd?
-    range_fuzz = int(lease_time) * REBIND_PERC - renewing_time
+    range_fuzz = lease_time * REBIND_PERC - renewing_time
     logger.debug('rebinding fuzz range %s', range_fuzz)
     fuzz = random.uniform(-(range_fuzz),
                           +(range_fuzz))
@@ -134,14 +235,127 @@ def gen_renewing_time(lease_time, elapsed=0):
 
 def gen_rebinding_time(lease_time, elapsed=0):
     """."""
-    rebinding_time = int(lease_time) * REBIND_PERC - elapsed
+    rebinding_time = lease_time * REBIND_PERC - elapsed
     # FIXME:90 [:rfc:`2131#section-4.4.5`]: the chosen "fuzz" could fingerprint
     # the implementation
     # NOTE: here using same "fuzz" as systemd?
-    range_fuzz = int(lease_time) - rebinding_time
+    range_fuzz = lease_time - rebinding_time
     logger.debug('rebinding fuzz range %s', range_fuzz)
     fuzz = random.uniform(-(range_fuzz),
                           +(range_fuzz))
     rebinding_time += fuzz
     logger.debug('Rebinding time %s.', rebinding_time)
     return rebinding_time
+
+
+class Timer(object):
+    """Timer returned by :meth:`TimerHeap.call_at`, it can be cancelled."""
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled', 'heap')
+
+    def __init__(self, when, callback, args, heap):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.heap = heap
+
+    def __repr__(self):
+        return '<Timer when=%s callback=%s cancelled=%s>' % (
+            self.when, self.callback, self.cancelled)
+
+    def cancel(self):
+        """Cancel the timer, it is removed from the heap lazily."""
+        if not self.cancelled:
+            self.cancelled = True
+            self.heap.timer_cancelled(self)
+
+
+class TimerHeap(object):
+    """Heap of deadlines shared by several clients on an asyncio loop.
+
+    It owns the retransmission, renewing, rebinding and expiry timers of all
+    the clients, but only one loop timer, set to the next deadline, is
+    pending at any time.
+    Inserting a timer is O(log n) and cancelling it O(1): cancelled timers
+    are only marked and are discarded when they reach the top of the heap,
+    or when they are more than half of the heap.
+
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.heap = []
+        self.counter = itertools.count()
+        self.ncancelled = 0
+        self.handle = None
+        # as in asyncio, run the timers due within the clock resolution
+        self.resolution = time.get_clock_info('monotonic').resolution
+
+    def __len__(self):
+        return len(self.heap) - self.ncancelled
+
+    def time(self):
+        return self.loop.time()
+
+    def call_later(self, delay, callback, *args):
+        """Call ``callback(*args)`` after ``delay`` seconds."""
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        """Call ``callback(*args)`` at the loop time ``when``."""
+        timer = Timer(when, callback, args, self)
+        heapq.heappush(self.heap, (when, next(self.counter), timer))
+        if self.handle is None or when < self.handle.when():
+            self.wakeup()
+        return timer
+
+    def timer_cancelled(self, timer):
+        """Account a cancelled timer, compacting the heap when needed."""
+        self.ncancelled += 1
+        if self.heap and self.heap[0][2] is timer:
+            self.wakeup()
+        elif self.ncancelled > MIN_TIMERS_CANCELLED_COMPACT and \
+                self.ncancelled * 2 > len(self.heap):
+            self.heap = [entry for entry in self.heap
+                         if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.ncancelled = 0
+
+    def wakeup(self):
+        """Set the loop timer to the next deadline that is not cancelled."""
+        while self.heap and self.heap[0][2].cancelled:
+            heapq.heappop(self.heap)
+            self.ncancelled -= 1
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.heap:
+            self.handle = self.loop.call_at(self.heap[0][0], self.run_due)
+
+    def run_due(self):
+        """Run the callbacks of the timers that are due."""
+        self.handle = None
+        now = self.time() + self.resolution
+        while self.heap and self.heap[0][0] <= now:
+            _, _, timer = heapq.heappop(self.heap)
+            if timer.cancelled:
+                self.ncancelled -= 1
+                continue
+            # a timer that already run can not be cancelled
+            timer.cancelled = True
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception('Error running timer %r.', timer)
+        self.wakeup()
+
+    def close(self):
+        """Cancel the loop timer and forget all the timers."""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        for _, _, timer in self.heap:
+            timer.cancelled = True
+        self.heap = []
+        self.ncancelled = 0
@@ -60,7 +60,7 @@ setup(
     url=dhcpcanon.__website__,
     packages=find_packages(exclude=['contrib', 'docs', 'tests*']),
     install_requires=[
-        "attrs>=16.3",
+        "attrs>=20.1",
         "dbus-python>=1.2",
         "netaddr>=0.7",
         "lockfile>=0.12",
@@ -4,9 +4,17 @@
 # SPDX-License-Identifier: MIT
 """."""
 import pytest
+from dhcpcanon.clientscript import close_script_runner
 from dhcpcanon.dhcpcap import DHCPCAP
 
 
+@pytest.fixture(autouse=True)
+def script_runner():
+    """ close the shared script runner after each test. """
+    yield
+    close_script_runner()
+
+
 @pytest.fixture
 def dhcpcap_maker(request):
     """ return a function which creates initialized dhcpcap instances. """
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""."""
+import asyncio
+
+from dhcpcanon.constants import (DHCP_OPTION_MESSAGE_TYPE, DHCPDISCOVER,
+                                 DHCPREQUEST)
+from dhcpcanon.dhcpcappkt import (OPTIONS_OFFSET, XID, XID_OFFSET,
+                                  parse_options)
+from dhcpcap_pkts import dhcp_ack, dhcp_offer
+
+
+class Server(object):
+    """Answer the client frames received on ``sock`` with offers and ack.
+
+    ``acks`` are the replies to the next requests, None to drop a request.
+
+    """
+
+    def __init__(self, sock, offers=None, acks=None):
+        self.sock = sock
+        self.offers = offers or [dhcp_offer]
+        self.acks = list(acks or [])
+        self.frames = []
+
+    def on_readable(self):
+        frame = self.sock.recv(1500)
+        self.frames.append(frame)
+        xid = XID.unpack_from(frame, XID_OFFSET)[0]
+        message_type = parse_options(frame, OPTIONS_OFFSET)[
+            DHCP_OPTION_MESSAGE_TYPE][0]
+        if message_type == DHCPDISCOVER:
+            replies = self.offers
+        elif message_type == DHCPREQUEST:
+            ack = self.acks.pop(0) if self.acks else dhcp_ack
+            replies = [ack] if ack is not None else []
+        else:
+            return
+        for reply in replies:
+            reply = reply.copy()
+            reply.xid = xid
+            self.sock.send(bytes(reply))
+
+
+def run_until(loop, condition, timeout=2):
+    deadline = loop.time() + timeout
+    while not condition() and loop.time() < deadline:
+        loop.run_until_complete(asyncio.sleep(0.01))
+    return condition()
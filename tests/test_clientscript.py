@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Tests for the external script of the DHCP client implementation of the
+Anonymity Profile ([:rfc:`7844`])."""
+import io
+import sys
+import threading
+import time
+
+import pytest
+
+from dhcpcanon.clientscript import (ClientScript, HookHelper, ScriptRunner,
+                                    encode_record, read_record)
+from dhcpcanon.constants import STATE_BOUND, STATE_RENEWING
+from dhcpcanon.dhcpcaplease import DHCPCAPLease
+
+SCRIPT = """#!/bin/sh
+sleep $SLEEP
+echo $interface $reason >> %s
+"""
+
+HELPER = """#!PYTHON
+import os
+import struct
+import sys
+
+while True:
+    header = sys.stdin.buffer.read(4)
+    if len(header) < 4:
+        break
+    entries = sys.stdin.buffer.read(struct.unpack('!I', header)[0])
+    with open(LOG, 'a') as fd:
+        fd.write('%s %s\\n' % (os.getpid(), entries.decode()))
+    if os.environ.get('DHCPCANON_HELPER') != '1' or b'EXIT' in entries:
+        break
+"""
+
+
+@pytest.fixture
+def script(tmpdir):
+    log = tmpdir.join('log')
+    path = tmpdir.join('script')
+    path.write(SCRIPT % log)
+    path.chmod(0o755)
+    return str(path), log
+
+
+def test_runner_order(script):
+    scriptname, log = script
+    runner = ScriptRunner(workers=2)
+    for iface, sleep in (('eth0', '0.2'), ('eth1', '0'), ('eth0', '0')):
+        runner.submit(iface, scriptname, {'interface': iface,
+                                          'reason': 'BOUND' + sleep,
+                                          'SLEEP': sleep})
+    runner.close()
+    # the scripts of an interface run in order, the other does not wait
+    assert log.read().splitlines() == ['eth1 BOUND0', 'eth0 BOUND0.2',
+                                       'eth0 BOUND0']
+
+
+def test_runner_timeout(script):
+    scriptname, log = script
+    runner = ScriptRunner(timeout=0.1)
+    results = []
+    runner.submit('eth0', scriptname, {'reason': 'BOUND', 'SLEEP': '5'},
+                  lambda reason, returncode: results.append(
+                      (reason, returncode)))
+    runner.close()
+    assert results == [('BOUND', None)]
+    assert not log.check()
+
+
+def test_runner_failed(script, monkeypatch):
+    scriptname, log = script
+    runner = ScriptRunner()
+    results = []
+
+    def fail(scriptname, env, timeout):
+        raise OSError('failed')
+    monkeypatch.setattr('dhcpcanon.clientscript.run_script', fail)
+    runner.submit('eth0', scriptname, {'reason': 'PREINIT'},
+                  lambda reason, returncode: results.append(reason))
+    runner.submit('eth0', scriptname, {'reason': 'BOUND'},
+                  lambda reason, returncode: 1 / 0)
+    runner.submit('eth0', scriptname, {'reason': 'RENEW'},
+                  lambda reason, returncode: results.append(reason))
+    # a failed script or callback does not block the next ones
+    runner.close()
+    assert results == ['PREINIT', 'RENEW']
+
+
+def test_script_go_not_blocking(script):
+    scriptname, log = script
+    runner = ScriptRunner()
+    done = threading.Event()
+    results = []
+
+    def callback(reason, returncode):
+        results.append((reason, returncode))
+        done.set()
+    client_script = ClientScript(scriptname, runner=runner, callback=callback)
+    client_script.env['SLEEP'] = '0.5'
+    lease = DHCPCAPLease(interface='eth0')
+    t0 = time.perf_counter()
+    client_script.script_init(lease, STATE_BOUND)
+    assert client_script.script_go()
+    # the environment of the running script does not change
+    client_script.script_init(lease, STATE_RENEWING)
+    assert time.perf_counter() - t0 < 0.5
+    assert done.wait(5)
+    runner.close()
+    assert results == [('BOUND', 0)]
+    assert log.read() == 'eth0 BOUND\n'
+
+
+@pytest.fixture
+def helper(tmpdir):
+    log = tmpdir.join('log')
+    path = tmpdir.join('helper')
+    path.write(HELPER.replace('PYTHON', sys.executable)
+               .replace('LOG', repr(str(log))))
+    path.chmod(0o755)
+    return str(path), log
+
+
+def test_record():
+    env = {'reason': 'BOUND', 'interface': 'eth0', 'new_routers': ''}
+    record = encode_record(env)
+    assert record[:4] == b'\0\0\0\x28'
+    stream = io.BytesIO(record * 2)
+    assert read_record(stream) == env
+    assert read_record(stream) == env
+    assert read_record(stream) is None
+
+
+def test_hook_helper(helper):
+    scriptname, log = helper
+    hook_helper = HookHelper(scriptname)
+    results = []
+
+    def submit(reason):
+        hook_helper.submit('eth0', scriptname,
+                           {'interface': 'eth0', 'reason': reason},
+                           lambda reason, returncode: results.append(
+                               (reason, returncode)))
+    submit('BOUND')
+    submit('EXIT')
+    for _ in range(100):
+        if len(results) == 2 and hook_helper.proc.poll() is not None:
+            break
+        time.sleep(0.05)
+    submit('RENEW')
+    hook_helper.close()
+    lines = [line.split(' ', 1) for line in log.read().splitlines()]
+    assert [entries for pid, entries in lines] == \
+        ['interface=eth0\0reason=BOUND', 'interface=eth0\0reason=EXIT',
+         'interface=eth0\0reason=RENEW']
+    # the helper is started once, and again after it exits
+    assert lines[0][0] == lines[1][0] != lines[2][0]
+    assert results == [('BOUND', 0), ('EXIT', 0), ('RENEW', 0)]
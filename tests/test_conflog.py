@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Tests for the logging configuration of the DHCP client implementation of
+the Anonymity Profile ([:rfc:`7844`])."""
+import logging
+import threading
+import time
+
+from dhcpcanon.conflog import BoundedQueueHandler, configure_logging
+
+
+class BlockedHandler(logging.Handler):
+    """Handler that blocks until it is released, like a stalled journald."""
+
+    def __init__(self):
+        super(BlockedHandler, self).__init__()
+        self.released = threading.Event()
+        self.messages = []
+
+    def emit(self, record):
+        self.released.wait()
+        self.messages.append(record.getMessage())
+
+
+def test_bounded_queue_handler():
+    handler = BoundedQueueHandler(maxsize=2)
+    log = logging.getLogger('test_conflog.bounded')
+    log.propagate = False
+    log.addHandler(handler)
+    for i in range(5):
+        log.warning('record %s', i)
+    assert handler.dropped == 3
+    assert [handler.queue.get_nowait().getMessage()
+            for _ in range(2)] == ['record 0', 'record 1']
+    log.warning('record 5')
+    # the drops are reported before the next record
+    assert [handler.queue.get_nowait().getMessage()
+            for _ in range(2)] == ['3 log records dropped', 'record 5']
+    log.removeHandler(handler)
+
+
+def test_configure_logging():
+    blocked = BlockedHandler()
+    listeners = configure_logging({
+        'version': 1,
+        'disable_existing_loggers': False,
+        'handlers': {'blocked': {'()': lambda: blocked}},
+        'loggers': {'test_conflog.blocked': {'handlers': ['blocked'],
+                                             'level': 'INFO',
+                                             'propagate': False}},
+    }, maxsize=4)
+    log = logging.getLogger('test_conflog.blocked')
+    t0 = time.perf_counter()
+    for i in range(10):
+        log.info('record %s', i)
+    # logging does not wait for the blocked handler
+    assert time.perf_counter() - t0 < 0.5
+    blocked.released.set()
+    queue_handler = log.handlers[0]
+    while not queue_handler.queue.empty():
+        time.sleep(0.01)
+    log.info('record 10')
+    for listener in listeners:
+        listener.stop()
+    assert blocked.messages[0] == 'record 0'
+    assert blocked.messages[-2:] == ['%d log records dropped' %
+                                     queue_handler.dropped, 'record 10']
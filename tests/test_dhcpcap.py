@@ -4,10 +4,17 @@
 # SPDX-License-Identifier: MIT
 """"""
 import logging
+import struct
 from datetime import datetime
 
+import attr
+from scapy.layers.dhcp import DHCP
+
+from dhcpcanon.dhcpcappkt import parse_reply
+from dhcpcanon.dhcpcaputils import isack, isnak, isoffer
 from dhcpcap_leases import LEASE_ACK, LEASE_REQUEST
-from dhcpcap_pkts import dhcp_ack, dhcp_discover, dhcp_offer, dhcp_request
+from dhcpcap_pkts import (dhcp_ack, dhcp_discover, dhcp_nak, dhcp_offer,
+                          dhcp_request, dhcp_request_unicast)
 
 FORMAT = "%(levelname)s: %(filename)s:%(lineno)s - %(funcName)s - " + \
          "%(message)s"
@@ -15,6 +22,23 @@ logging.basicConfig(format=FORMAT, level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 
+def scapy_raw(pkt):
+    """Serialize a scapy packet.
+
+    scapy >= 2.4 only builds the Parameter Request List from a list of ints.
+
+    """
+    try:
+        return bytes(pkt)
+    except struct.error:
+        pkt = pkt.copy()
+        pkt[DHCP].options = [
+            (o[0], list(bytearray(o[1])))
+            if isinstance(o, tuple) and o[0] == 'param_req_list' else o
+            for o in pkt[DHCP].options]
+        return bytes(pkt)
+
+
 class TestDHCPCAP:
     def test_intialize(self, dhcpcap):
         assert dhcpcap.client_mac == "00:01:02:03:04:05"
@@ -51,3 +75,76 @@ class TestDHCPCAP:
         dhcpcap.handle_ack(dhcp_ack, datetime(2017, 6, 23))
         lease = dhcpcap.lease
         assert lease == LEASE_ACK
+
+    def test_gen_discover_raw(self, dhcpcap):
+        assert dhcpcap.gen_discover_raw() == scapy_raw(dhcp_discover)
+        # xid is patched in the template
+        dhcpcap.xid = 12345
+        assert dhcpcap.gen_discover_raw() == \
+            scapy_raw(dhcpcap.gen_discover())
+
+    def test_gen_request_raw(self, dhcpcap):
+        dhcpcap.lease = LEASE_REQUEST
+        assert dhcpcap.gen_request_raw() == scapy_raw(dhcp_request)
+        dhcpcap.xid = 12345
+        dhcpcap.lease = attr.evolve(LEASE_ACK, address='192.168.1.42',
+                                    server_id='192.168.1.2')
+        assert dhcpcap.gen_request_raw() == scapy_raw(dhcpcap.gen_request())
+
+    def test_gen_request_reboot_raw(self, dhcpcap):
+        dhcpcap.lease = LEASE_ACK
+        assert dhcpcap.gen_request_reboot_raw() == \
+            scapy_raw(dhcpcap.gen_request_reboot())
+        # it does not share the template with the REQUEST in SELECTING
+        assert dhcpcap.gen_request_raw() == scapy_raw(dhcpcap.gen_request())
+
+    def test_gen_request_unicast_raw(self, dhcpcap):
+        dhcpcap.server_mac = '00:0a:0b:0c:0d:0f'
+        dhcpcap.server_ip = '192.168.1.1'
+        dhcpcap.client_ip = '192.168.1.23'
+        assert dhcpcap.gen_request_unicast_raw() == \
+            scapy_raw(dhcp_request_unicast)
+        # the template is regenerated when the client is bound again
+        dhcpcap.client_ip = '192.168.1.42'
+        assert dhcpcap.gen_request_unicast_raw() == \
+            scapy_raw(dhcpcap.gen_request_unicast())
+
+    def test_parse_reply(self):
+        offer = parse_reply(scapy_raw(dhcp_offer))
+        assert isoffer(offer) and not isack(offer) and not isnak(offer)
+        assert isack(parse_reply(scapy_raw(dhcp_ack)))
+        assert isnak(parse_reply(scapy_raw(dhcp_nak)))
+        assert offer.server_mac == '00:0a:0b:0c:0d:0f'
+        assert offer.server_ip == '192.168.1.1'
+        assert offer.server_port == 67
+        # client packets are not replies
+        assert parse_reply(scapy_raw(dhcp_discover)) is None
+        assert parse_reply(b'\x00' * 20) is None
+
+    def test_parse_reply_truncated_time(self):
+        """A reply with a lease time shorter than 4 bytes is dropped."""
+        ack = dhcp_ack.copy()
+        ack[DHCP].options = [
+            b'\x33\x02\x00\x01' if o[0] == 'lease_time' else o
+            for o in dhcp_ack[DHCP].options]
+        assert parse_reply(scapy_raw(ack)) is None
+
+    def test_parse_reply_domain_not_utf8(self):
+        """A reply with a domain that is not UTF-8 is dropped."""
+        ack = dhcp_ack.copy()
+        ack[DHCP].options = [
+            b'\x0f\x02\xff\xfe' if o[0] == 'domain' else o
+            for o in dhcp_ack[DHCP].options]
+        assert parse_reply(scapy_raw(ack)) is None
+
+    def test_handle_offer_reply(self, dhcpcap):
+        dhcpcap.handle_offer(parse_reply(scapy_raw(dhcp_offer)))
+        assert dhcpcap.lease == LEASE_REQUEST
+
+    def test_handle_ack_reply(self, dhcpcap):
+        dhcpcap.lease = LEASE_REQUEST
+        dhcpcap.handle_ack(parse_reply(scapy_raw(dhcp_ack)),
+                           datetime(2017, 6, 23))
+        assert dhcpcap.lease == LEASE_ACK
+        assert dhcpcap.server_mac == '00:0a:0b:0c:0d:0f'
+        assert dhcpcap.server_ip == '192.168.1.1'
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Tests for the asyncio FSM of the DHCP client implementation of the
+Anonymity Profile ([:rfc:`7844`])."""
+import asyncio
+import socket
+from datetime import datetime
+
+import pytest
+from scapy.layers.dhcp import DHCP
+
+from dhcpcanon.constants import (DHCP_OPTION_MESSAGE_TYPE,
+                                 DHCP_OPTION_REQUESTED_ADDR,
+                                 DHCP_OPTION_SERVER_ID, DHCPREQUEST,
+                                 STATE_BOUND, STATE_RENEWING)
+from dhcpcanon.dhcpcapasync import DHCPCAPAsyncFSM
+from dhcpcanon.dhcpcaplease import read_lease
+from dhcpcanon.dhcpcappkt import IP_OFFSET, OPTIONS_OFFSET, parse_options
+from dhcpcanon.dhcpcapsock import LoopbackTransport
+from dhcpcanon.offers import gen_offer_policy
+from dhcpcanon.server import DHCPServer
+from dhcpcanon.timers import VirtualClock, set_clock
+from dhcpcapasync_objs import Server, run_until
+from dhcpcap_pkts import dhcp_offer
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def lease_file(tmpdir):
+    return str(tmpdir.join('dhcpcanon.leases'))
+
+
+@pytest.fixture
+def fsm_server_maker(loop, lease_file):
+    """Return a function that starts a client and a server."""
+    started = []
+
+    def maker(offers=None, **kwargs):
+        client_sock, server_sock = socket.socketpair(socket.AF_UNIX,
+                                                     socket.SOCK_DGRAM)
+        server = Server(server_sock, offers)
+        loop.add_reader(server_sock.fileno(), server.on_readable)
+        fsm = DHCPCAPAsyncFSM(iface='lo', client_mac='00:01:02:03:04:05',
+                              scriptfile='/bin/true', listen_sock=client_sock,
+                              send_sock=client_sock, loop=loop,
+                              lease_file=lease_file, **kwargs)
+        fsm.start()
+        started.append((fsm, client_sock, server_sock))
+        return fsm, server
+    yield maker
+    for fsm, client_sock, server_sock in started:
+        loop.remove_reader(server_sock.fileno())
+        fsm.stop()
+        client_sock.close()
+        server_sock.close()
+
+
+@pytest.fixture
+def fsm_server(fsm_server_maker):
+    return fsm_server_maker()
+
+
+class TestDHCPCAPAsyncFSM:
+    def test_bound(self, loop, fsm_server):
+        fsm, server = fsm_server
+        loop.run_until_complete(asyncio.wait_for(fsm.wait_bound(), 2))
+        assert fsm.current_state == STATE_BOUND
+        assert str(fsm.client.lease.address) == '192.168.1.23'
+        assert sorted(fsm.timers) == ['expiry', 'rebinding', 'renewing']
+
+    def test_renew(self, loop, fsm_server):
+        fsm, server = fsm_server
+        loop.run_until_complete(asyncio.wait_for(fsm.wait_bound(), 2))
+        fsm.renewing_time_expires()
+        assert fsm.current_state == STATE_RENEWING
+        assert run_until(loop, lambda: fsm.current_state == STATE_BOUND)
+        # the renewing request is unicast to the server
+        assert socket.inet_ntoa(server.frames[-1][IP_OFFSET + 16:
+                                                  IP_OFFSET + 20]) == \
+            '192.168.1.1'
+
+    def test_init_reboot(self, loop, lease_file, fsm_server_maker):
+        fsm, server = fsm_server_maker()
+        loop.run_until_complete(asyncio.wait_for(fsm.wait_bound(), 2))
+        assert read_lease('lo', '00:01:02:03:04:05',
+                          lease_file).views['address'] == '192.168.1.23'
+        # a restarted client requests the stored lease without DISCOVER
+        fsm, server = fsm_server_maker()
+        loop.run_until_complete(asyncio.wait_for(fsm.wait_bound(), 2))
+        assert len(server.frames) == 1
+        options = parse_options(server.frames[0], OPTIONS_OFFSET)
+        assert options[DHCP_OPTION_MESSAGE_TYPE][0] == DHCPREQUEST
+        assert socket.inet_ntoa(options[DHCP_OPTION_REQUESTED_ADDR]) == \
+            '192.168.1.23'
+        assert DHCP_OPTION_SERVER_ID not in options
+
+    def test_offer_policy(self, loop, fsm_server_maker):
+        offer_longer = dhcp_offer.copy()
+        offer_longer.yiaddr = '192.168.1.42'
+        offer_longer[DHCP].options = [
+            ('server_id', '192.168.1.2') if o[0] == 'server_id' else
+            ('lease_time', 86400) if o[0] == 'lease_time' else o
+            for o in dhcp_offer[DHCP].options]
+        fsm, server = fsm_server_maker(
+            offers=[dhcp_offer, offer_longer],
+            offer_policy=gen_offer_policy('lease', window=0.1))
+        loop.run_until_complete(asyncio.wait_for(fsm.wait_bound(), 2))
+        assert [offer.lease_time for offer in fsm.offers] == [43200, 86400]
+        options = parse_options(server.frames[1], OPTIONS_OFFSET)
+        assert socket.inet_ntoa(options[DHCP_OPTION_REQUESTED_ADDR]) == \
+            '192.168.1.42'
+        assert socket.inet_ntoa(options[DHCP_OPTION_SERVER_ID]) == \
+            '192.168.1.2'
+
+    def test_hooks(self, loop, fsm_server_maker):
+        reasons = []
+        fsm, server = fsm_server_maker(
+            hooks=[lambda lease, reason: reasons.append(
+                (lease.views['address'], reason))])
+        loop.run_until_complete(asyncio.wait_for(fsm.wait_bound(), 2))
+        fsm.lease_expires()
+        assert reasons == [('', 'PREINIT'), ('192.168.1.23', 'BOUND'),
+                           ('192.168.1.23', 'EXPIRE')]
+
+
+@pytest.fixture
+def virtual_clock():
+    clock = VirtualClock(datetime(2017, 6, 23))
+    set_clock(clock)
+    loop = clock.new_event_loop()
+    yield clock, loop
+    loop.close()
+    set_clock()
+
+
+def test_lifecycle_virtual_clock(virtual_clock, lease_file):
+    """A 24 hours lease is renewed, rebound and expires in simulated time."""
+    clock, loop = virtual_clock
+    server = DHCPServer(lease_time=86400, renewal_time=43200,
+                        rebinding_time=75600)
+    transport = LoopbackTransport()
+
+    def on_readable():
+        for frame in server.handle(transport.peer.recv(4096)):
+            transport.peer.send(frame)
+    loop.add_reader(transport.peer.fileno(), on_readable)
+    reasons = []
+    fsm = DHCPCAPAsyncFSM(
+        iface='lo', client_mac='00:01:02:03:04:05', scriptfile='/bin/true',
+        loop=loop, transport=transport, lease_file=lease_file,
+        hooks=[lambda lease, reason: reasons.append(
+            (reason, round(clock.monotonic())))])
+    fsm.start()
+    try:
+        loop.run_until_complete(asyncio.wait_for(fsm.wait_bound(), 2))
+        assert fsm.client.lease.lease_time == 86400
+        # renewed at T1
+        loop.run_until_complete(asyncio.sleep(50000))
+        assert reasons[-2:] == [('RENEW', 43200), ('BOUND', 43200)]
+        assert fsm.current_state == STATE_BOUND
+        # the server stops answering until after the lease expired
+        server.drop_rate = 1
+        loop.run_until_complete(asyncio.sleep(43200 + 86400 - 50000 + 100))
+        assert reasons[-3:] == [('RENEW', 43200 + 43200),
+                                ('REBIND', 43200 + 75600),
+                                ('EXPIRE', 43200 + 86400)]
+        assert fsm.client.lease.address is None
+        assert clock.now() > datetime(2017, 6, 24, 12)
+        server.drop_rate = 0
+        loop.run_until_complete(asyncio.wait_for(fsm.wait_bound(), 600))
+        assert fsm.current_state == STATE_BOUND
+    finally:
+        loop.remove_reader(transport.peer.fileno())
+        fsm.stop()
+        transport.close()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Tests for the daemon mode of the DHCP client implementation of the
+Anonymity Profile ([:rfc:`7844`])."""
+import errno
+import socket
+
+from dhcpcanon.constants import STATE_BOUND, STATE_END
+from dhcpcanon.dhcpcapdaemon import DHCPCAPDaemon
+from dhcpcapasync_objs import Server, run_until
+
+IFACES = {'eth0': '00:01:02:03:04:05', 'eth1': '00:01:02:03:04:06'}
+
+
+def test_daemon():
+    daemon = DHCPCAPDaemon(scriptfile='/bin/true')
+    socks = []
+    for iface, client_mac in IFACES.items():
+        client_sock, server_sock = socket.socketpair(socket.AF_UNIX,
+                                                     socket.SOCK_DGRAM)
+        socks.extend([client_sock, server_sock])
+        daemon.loop.add_reader(server_sock.fileno(),
+                               Server(server_sock).on_readable)
+        daemon.add_iface(iface, client_mac=client_mac,
+                         listen_sock=client_sock, send_sock=client_sock)
+    daemon.start()
+    try:
+        assert run_until(daemon.loop, lambda: all(
+            fsm.current_state == STATE_BOUND
+            for fsm in daemon.fsms.values()))
+        # every interface has its own client and lease
+        assert {iface: fsm.client.client_mac
+                for iface, fsm in daemon.fsms.items()} == IFACES
+        assert daemon.fsms['eth0'].client.xid != \
+            daemon.fsms['eth1'].client.xid
+        fsm = daemon.fsms['eth1']
+        sock = fsm.listen_sock
+        daemon.remove_iface('eth1')
+        assert fsm.current_state == STATE_END
+        assert list(daemon.fsms) == ['eth0']
+        # the sockets of the removed interface are closed
+        assert sock.fileno() == -1
+        assert fsm.listen_sock is None and fsm.send_sock is None
+    finally:
+        daemon.stop()
+        daemon.loop.close()
+        for sock in socks:
+            sock.close()
+
+
+class MissingIfaceTransport(object):
+    """Transport of an interface that disappeared."""
+
+    def listen_socket(self, iface=None, **kargs):
+        raise OSError(errno.ENODEV, 'No such device')
+
+
+def test_daemon_start_failed():
+    daemon = DHCPCAPDaemon(scriptfile='/bin/true')
+    client_sock, server_sock = socket.socketpair(socket.AF_UNIX,
+                                                 socket.SOCK_DGRAM)
+    daemon.loop.add_reader(server_sock.fileno(),
+                           Server(server_sock).on_readable)
+    daemon.add_iface('eth0', client_mac=IFACES['eth0'],
+                     listen_sock=client_sock, send_sock=client_sock)
+    daemon.add_iface('eth1', client_mac=IFACES['eth1'],
+                     transport=MissingIfaceTransport())
+    fsm = daemon.fsms['eth0']
+    try:
+        daemon.start()
+        # the client that could not start is removed, the other runs
+        assert list(daemon.fsms) == ['eth0']
+        assert run_until(daemon.loop, lambda: fsm.current_state ==
+                         STATE_BOUND)
+        assert daemon.add_iface('eth2', client_mac=IFACES['eth1'],
+                                transport=MissingIfaceTransport()) is None
+        assert list(daemon.fsms) == ['eth0']
+    finally:
+        # stopping twice, as on a second SIGTERM
+        daemon.stop()
+        daemon.stop()
+        daemon.loop.close()
+        server_sock.close()
+    assert fsm.current_state == STATE_END
+    assert fsm.listen_sock is None
+
+
+def test_stop_fsm():
+    daemon = DHCPCAPDaemon(scriptfile='/bin/true')
+    fsm = daemon.add_iface('eth0', client_mac=IFACES['eth0'])
+    fsm.stop()
+    assert fsm.current_state == STATE_END
+    daemon.loop.close()
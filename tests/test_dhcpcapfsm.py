@@ -10,23 +10,37 @@
    Test for more cases:
    - delays getting OFFERs
    - delays getting ACK
-   - RENEWING state
-   - REBINDING state
    - lease expires
 
 """
 import logging
 import logging.config
+import select
+import threading
+import time
 import pytest
-from datetime import datetime
+from datetime import datetime, timedelta
+
+import attr
 
 from scapy.automaton import Automaton
 from scapy.config import conf
+from scapy.layers.dhcp import DHCP
 
+from dhcpcanon.clientscript import close_script_runner
 from dhcpcanon.conflog import LOGGING
-from dhcpcanon.constants import STATES2NAMES
+from dhcpcanon.constants import (DHCP_OPTION_MESSAGE_TYPE, DHCPDISCOVER,
+                                 DHCPREQUEST, DT_PRINT_FORMAT,
+                                 STATE_RENEWING, STATE_SELECTING,
+                                 STATES2NAMES)
 from dhcpcanon.dhcpcapfsm import DHCPCAPFSM
-from dhcpcap_pkts import dhcp_ack, dhcp_offer
+from dhcpcanon.dhcpcaplease import parse_lease_file, write_lease
+from dhcpcanon.dhcpcappkt import OPTIONS_OFFSET, parse_options
+from dhcpcanon.dhcpcapsock import LoopbackTransport
+from dhcpcanon.timers import nowutc
+from dhcpcapasync_objs import Server
+from dhcpcap_leases import LEASE_ACK
+from dhcpcap_pkts import dhcp_ack, dhcp_nak, dhcp_offer
 from dhcpcapfsm_objs import (fsm_bound, fsm_init, fsm_preinit, fsm_requesting,
                              fsm_selecting)
 
@@ -76,7 +90,7 @@ class TestDHCPCAPFSM:
                                xid=900000000,
                                # scriptfile='/sbin/dhcpcanon-script',
                                delay_selecting=1, timeout_select=1,
-                               ll=DummySocket)
+                               ll=DummySocket, recvsock=DummySocket)
         assert dhcpcanon.dict_self() == fsm_preinit
         logger.debug('Test INIT')
         logger.debug('============')
@@ -160,3 +174,104 @@ class TestDHCPCAPFSM:
         assert dhcpcanon.dict_self()['client'] == \
             fsm_bound['client']
         assert dhcpcanon.dict_self() == fsm_bound
+
+
+@pytest.fixture
+def loopback_server():
+    """Return a function that starts a server on a loopback transport."""
+    transport = LoopbackTransport()
+    stop = threading.Event()
+    threads = []
+
+    def serve(server):
+        while not stop.is_set():
+            if select.select([transport.peer], [], [], 0.05)[0]:
+                server.on_readable()
+
+    def maker(**kwargs):
+        server = Server(transport.peer, **kwargs)
+        thread = threading.Thread(target=serve, args=(server,))
+        thread.start()
+        threads.append(thread)
+        return transport, server
+    yield maker
+    stop.set()
+    for thread in threads:
+        thread.join()
+    transport.close()
+
+
+def test_lifecycle_loopback(loopback_server):
+    """DISCOVER, REQUEST, RENEW not answered and REBIND over the loopback."""
+    ack_short = dhcp_ack.copy()
+    ack_short[DHCP].options = [
+        ('lease_time', 4) if o[0] == 'lease_time' else
+        ('renewal_time', 1) if o[0] == 'renewal_time' else
+        ('rebinding_time', 2) if o[0] == 'rebinding_time' else o
+        for o in dhcp_ack[DHCP].options]
+    transport, server = loopback_server(acks=[ack_short, None, ack_short])
+    reasons = []
+    fsm = DHCPCAPFSM(iface='lo', client_mac='00:01:02:03:04:05',
+                     scriptfile='/bin/true', transport=transport,
+                     hooks=[lambda lease, reason: reasons.append(reason)])
+    fsm.runbg()
+    deadline = time.time() + 10
+    while len(reasons) < 5 and time.time() < deadline:
+        time.sleep(0.05)
+    fsm.stop()
+    close_script_runner()
+    assert reasons[:5] == ['PREINIT', 'BOUND', 'RENEW', 'REBIND', 'BOUND']
+    assert str(fsm.client.lease.address) == '192.168.1.23'
+    # DISCOVER and the REQUESTs when requesting, renewing and rebinding
+    assert len(server.frames) == 4
+
+
+def test_renewing_retransmit_hooks(loopback_server, monkeypatch):
+    """The hooks are called once when RENEWING retransmits the REQUEST."""
+    ack_short = dhcp_ack.copy()
+    ack_short[DHCP].options = [
+        ('lease_time', 8) if o[0] == 'lease_time' else
+        ('renewal_time', 1) if o[0] == 'renewal_time' else
+        ('rebinding_time', 6) if o[0] == 'rebinding_time' else o
+        for o in dhcp_ack[DHCP].options]
+    monkeypatch.setattr('dhcpcanon.dhcpcapfsm.gen_timeout_request_renew',
+                        lambda lease: 0.3)
+    transport, server = loopback_server(acks=[ack_short] + [None] * 20)
+    reasons = []
+    fsm = DHCPCAPFSM(iface='lo', client_mac='00:01:02:03:04:05',
+                     scriptfile='/bin/true', transport=transport,
+                     hooks=[lambda lease, reason: reasons.append(reason)])
+    # the first REQUEST when renewing is sent from BOUND, which does not
+    # set the timeout of its retransmission
+    fsm.set_timeout(STATE_RENEWING, fsm.timeout_request_renewing, 0.3)
+    fsm.runbg()
+    # DISCOVER, REQUEST, the REQUEST when renewing and two retransmissions
+    deadline = time.time() + 10
+    while len(server.frames) < 5 and time.time() < deadline:
+        time.sleep(0.05)
+    fsm.stop()
+    assert len(server.frames) >= 5
+    assert reasons == ['PREINIT', 'BOUND', 'RENEW']
+
+
+def test_init_reboot_nak(loopback_server, tmpdir):
+    """A NAKed stored lease is forgotten and the client goes to SELECTING."""
+    lease_file = str(tmpdir.join('dhcpcanon.leases'))
+    expiry = (nowutc() + timedelta(hours=1)).strftime(DT_PRINT_FORMAT)
+    write_lease(attr.evolve(LEASE_ACK, interface='lo', expiry=expiry),
+                '00:01:02:03:04:05', lease_file)
+    # the NAK answers the REQUEST and is ignored when selecting
+    transport, server = loopback_server(offers=[dhcp_nak], acks=[dhcp_nak])
+    fsm = DHCPCAPFSM(iface='lo', client_mac='00:01:02:03:04:05',
+                     transport=transport, lease_file=lease_file)
+    fsm.runbg()
+    deadline = time.time() + 5
+    while len(server.frames) < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    state = fsm.current_state
+    fsm.stop()
+    assert state == STATE_SELECTING
+    assert [parse_options(frame, OPTIONS_OFFSET)[DHCP_OPTION_MESSAGE_TYPE]
+            for frame in server.frames[:2]] == [bytes([DHCPREQUEST]),
+                                                bytes([DHCPDISCOVER])]
+    assert parse_lease_file(lease_file) == {}
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Tests for the lease file of the DHCP client implementation of the
+Anonymity Profile ([:rfc:`7844`])."""
+import multiprocessing
+import os
+from datetime import datetime, timedelta
+from ipaddress import IPv4Address
+
+import attr
+
+from dhcpcanon.constants import DT_PRINT_FORMAT
+from dhcpcanon.dhcpcaplease import (DHCPCAPLease, parse_lease_file,
+                                    read_lease, write_lease)
+from dhcpcanon.timers import VirtualClock, monotime, nowutc, set_clock
+from dhcpcap_leases import LEASE_ACK
+
+CLIENT_MAC = '00:01:02:03:04:05'
+
+
+def lease_expiring(seconds, **kwargs):
+    expiry = (nowutc() + timedelta(seconds=seconds)).strftime(DT_PRINT_FORMAT)
+    return attr.evolve(LEASE_ACK, expiry=expiry, **kwargs)
+
+
+def write_leases(prefix, path, count=20):
+    for i in range(count):
+        write_lease(lease_expiring(3600, interface=prefix + str(i)),
+                    CLIENT_MAC, path)
+
+
+class TestLeaseFile:
+    def test_write_read(self, tmpdir):
+        path = str(tmpdir.join('dhcpcanon.leases'))
+        lease = lease_expiring(3600)
+        write_lease(lease, CLIENT_MAC, path)
+        # the values calculated from the stored ones are not stored
+        assert read_lease('eth0', CLIENT_MAC, path) == \
+            attr.evolve(lease, next_server='', subnet='', subnet_mask_cidr='')
+        # only the lease file and its lock are left in the directory
+        assert sorted(os.listdir(str(tmpdir))) == \
+            ['dhcpcanon.leases', 'dhcpcanon.leases.lock']
+
+    def test_write_other_iface(self, tmpdir):
+        path = str(tmpdir.join('dhcpcanon.leases'))
+        write_lease(lease_expiring(3600), CLIENT_MAC, path)
+        write_lease(lease_expiring(3600, interface='eth1',
+                                   address='192.168.1.42'),
+                    '00:01:02:03:04:06', path)
+        write_lease(lease_expiring(3600, address='192.168.1.24'),
+                    CLIENT_MAC, path)
+        leases = parse_lease_file(path)
+        assert sorted(leases) == ['eth0', 'eth1']
+        assert str(leases['eth0'][1].address) == '192.168.1.24'
+        assert leases['eth1'][0] == '00:01:02:03:04:06'
+
+    def test_write_processes(self, tmpdir):
+        path = str(tmpdir.join('dhcpcanon.leases'))
+        ctx = multiprocessing.get_context('fork')
+        processes = [ctx.Process(target=write_leases,
+                                 args=('eth%d.' % i, path))
+                     for i in range(2)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            assert process.exitcode == 0
+        # no process overwrote the leases written by the other
+        assert len(parse_lease_file(path)) == 2 * 20
+
+    def test_read_not_reusable(self, tmpdir):
+        path = str(tmpdir.join('dhcpcanon.leases'))
+        assert read_lease('eth0', CLIENT_MAC, path) is None
+        write_lease(lease_expiring(3600), CLIENT_MAC, path)
+        # [:rfc:`7844#section-3.3`] the link-layer address changed
+        assert read_lease('eth0', '00:01:02:03:04:06', path) is None
+        write_lease(lease_expiring(-1), CLIENT_MAC, path)
+        assert read_lease('eth0', CLIENT_MAC, path) is None
+
+
+class TestLeaseTimes:
+    def test_wall_time_step(self):
+        clock = VirtualClock(datetime(2017, 6, 23))
+        set_clock(clock)
+        try:
+            lease = attr.evolve(LEASE_ACK)
+            clock.advance(2)
+            lease.set_times(datetime(2017, 6, 23), monotime() - 2)
+            assert lease.renew == '17-06-23 06:00:00'
+            assert lease.time_left('renew') == 21600 - 2
+            # NTP sets the wall time a day forward, the lease times stay
+            clock.start += timedelta(days=1)
+            assert lease.time_left('renew') == 21600 - 2
+            assert not lease.has_expired()
+            clock.advance(43200)
+            assert lease.time_left('rebind') == 0
+            assert lease.has_expired()
+        finally:
+            set_clock()
+
+    def test_types_views(self):
+        lease = attr.evolve(LEASE_ACK)
+        assert lease.address == IPv4Address('192.168.1.23')
+        assert lease.name_server == (IPv4Address('192.168.1.1'),
+                                     IPv4Address('8.8.8.8'))
+        assert (lease.lease_time, lease.subnet_mask_cidr) == (43200, 24)
+        assert lease.next_server is not None and lease.network is None
+        assert lease == DHCPCAPLease(**lease.views)
+        views = lease.views
+        assert views['name_server'] == '192.168.1.1 8.8.8.8'
+        assert views['lease_time'] == '43200'
+        assert views['network'] == ''
+        assert lease.views is views
+        # setting an attribute converts it and builds the views again
+        lease.address = '192.168.1.24'
+        assert lease.address == IPv4Address('192.168.1.24')
+        assert lease.views['address'] == '192.168.1.24'
+        assert not hasattr(lease, '__dict__')
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Tests for the sockets of the DHCP client implementation of the Anonymity
+Profile ([:rfc:`7844`])."""
+import errno
+import select
+import socket
+
+import pytest
+
+from dhcpcanon.dhcpcappkt import pkt2bytes
+from dhcpcanon.dhcpcapsock import (DHCPCAPListenSocket, DHCPCAPSendSocket,
+                                   gen_bpf)
+from dhcpcap_pkts import dhcp_ack, dhcp_offer
+
+XID = 900000000
+
+
+@pytest.fixture
+def listen_sock():
+    try:
+        sock = DHCPCAPListenSocket(iface='lo')
+    except (PermissionError, OSError) as e:
+        pytest.skip('Can not open a raw socket: %s' % e)
+    yield sock
+    sock.close()
+
+
+def send_lo(*frames):
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+    sock.bind(('lo', 0))
+    for frame in frames:
+        sock.send(frame)
+    sock.close()
+
+
+def recv_all(listen_sock):
+    frames = []
+    while select.select([listen_sock.ins], [], [], 0.2)[0]:
+        pkt = listen_sock.recv()
+        if pkt is not None:
+            frames.append(pkt2bytes(pkt))
+    return frames
+
+
+def reply(pkt, xid):
+    pkt = pkt.copy()
+    pkt.xid = xid
+    return bytes(pkt)
+
+
+class TestDHCPCAPListenSocket:
+    def test_bpf(self, listen_sock, dhcpcap):
+        listen_sock.attach_filter(gen_bpf('00:01:02:03:04:05', 68, 67, XID))
+        offer = reply(dhcp_offer, XID)
+        send_lo(reply(dhcp_offer, XID + 1), dhcpcap.gen_discover_raw(), offer)
+        assert recv_all(listen_sock) == [offer]
+
+    def test_bpf_reattach(self, listen_sock):
+        listen_sock.attach_filter(gen_bpf('00:01:02:03:04:05', 68, 67, XID))
+        listen_sock.attach_filter(gen_bpf('00:01:02:03:04:05', 68, 67,
+                                          XID + 1))
+        ack = reply(dhcp_ack, XID + 1)
+        send_lo(reply(dhcp_ack, XID), ack)
+        assert recv_all(listen_sock) == [ack]
+
+    def test_bpf_other_mac(self, listen_sock):
+        listen_sock.attach_filter(gen_bpf('00:01:02:03:04:06', 68, 67, XID))
+        send_lo(reply(dhcp_offer, XID))
+        assert recv_all(listen_sock) == []
+
+
+class TestDHCPCAPSendSocket:
+    def test_send(self, listen_sock, dhcpcap):
+        send_sock = DHCPCAPSendSocket(iface='lo')
+        discover = dhcpcap.gen_discover_raw()
+        # the same socket is reused for several frames
+        send_sock.send(discover)
+        send_sock.send(discover)
+        send_sock.close()
+        assert recv_all(listen_sock) == [discover, discover]
+
+    def test_one_direction(self, listen_sock, dhcpcap):
+        send_sock = DHCPCAPSendSocket(iface='lo')
+        with pytest.raises(OSError) as e:
+            send_sock.recv()
+        assert e.value.errno == errno.EOPNOTSUPP
+        with pytest.raises(OSError) as e:
+            listen_sock.send(dhcpcap.gen_discover_raw())
+        assert e.value.errno == errno.EOPNOTSUPP
+        send_sock.close()
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Tests for the Python hooks of the DHCP client implementation of the
+Anonymity Profile ([:rfc:`7844`])."""
+import pytest
+
+from dhcpcanon.dhcpcaplease import DHCPCAPLease
+from dhcpcanon.hooks import call_hooks, load_hooks
+
+HOOK_MODULE = """
+leases = []
+
+
+def on_lease(lease, reason):
+    leases.append((str(lease.address), reason))
+"""
+
+ENTRY_POINTS = """[dhcpcanon.hooks]
+agent = dhcpcanon_test_hook:on_lease
+"""
+
+
+@pytest.fixture
+def installed_hook(tmpdir, monkeypatch):
+    """Install a package with a hook in a temporary path."""
+    tmpdir.join('dhcpcanon_test_hook.py').write(HOOK_MODULE)
+    dist_info = tmpdir.mkdir('dhcpcanon_test_hook-0.1.dist-info')
+    dist_info.join('METADATA').write('Name: dhcpcanon_test_hook\n'
+                                     'Version: 0.1\n')
+    dist_info.join('entry_points.txt').write(ENTRY_POINTS)
+    monkeypatch.syspath_prepend(str(tmpdir))
+
+
+def test_load_hooks(installed_hook):
+    hooks = load_hooks(['agent'])
+    call_hooks(hooks, DHCPCAPLease(address='192.168.1.23'), 'BOUND')
+    import dhcpcanon_test_hook
+    assert dhcpcanon_test_hook.leases == [('192.168.1.23', 'BOUND')]
+
+
+def test_load_hooks_not_installed(installed_hook):
+    assert load_hooks(None) == []
+    with pytest.raises(ValueError):
+        load_hooks(['agent', 'other'])
+
+
+def test_call_hooks_error():
+    called = []
+
+    def failing(lease, reason):
+        raise RuntimeError(reason)
+    call_hooks([failing, lambda lease, reason: called.append(reason)],
+               DHCPCAPLease(), 'RENEW')
+    assert called == ['RENEW']
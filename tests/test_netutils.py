@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Tests for the network configuration of the DHCP client implementation of
+the Anonymity Profile ([:rfc:`7844`])."""
+import errno
+
+import pytest
+from pyroute2.netlink.rtnl.ifinfmsg import ifinfmsg
+
+from dhcpcanon import netutils
+from dhcpcanon.constants import DNS_BACKEND_RESOLVCONF
+from dhcpcanon.dhcpcaplease import DHCPCAPLease
+
+
+def link_event(event, index, ifname):
+    msg = ifinfmsg()
+    msg['index'] = index
+    msg['attrs'] = [('IFLA_IFNAME', ifname)]
+    msg['event'] = event
+    return msg
+
+
+@pytest.fixture
+def netlink():
+    nl = netutils.get_netlink()
+    yield nl
+    netutils.close_netlink()
+
+
+class TestNetlinkContext:
+    def test_shared(self, netlink):
+        assert netutils.get_netlink() is netlink
+
+    def test_link_index_cached(self, netlink, monkeypatch):
+        lookups = []
+        link_lookup = netlink.ipr.link_lookup
+
+        def counted_link_lookup(**kwargs):
+            lookups.append(kwargs)
+            return link_lookup(**kwargs)
+        monkeypatch.setattr(netlink.ipr, 'link_lookup', counted_link_lookup)
+        assert netlink.link_index('lo') == 1
+        assert netlink.link_index('lo') == 1
+        assert lookups == [{'ifname': 'lo'}]
+        assert netlink.link_index('nonexistent0') is None
+
+    def test_link_events(self, netlink):
+        netlink.handle_link_event(link_event('RTM_NEWLINK', 42, 'veth0'))
+        assert netlink.ifindexes['veth0'] == 42
+        # renamed interface
+        netlink.handle_link_event(link_event('RTM_NEWLINK', 42, 'veth1'))
+        assert 'veth0' not in netlink.ifindexes
+        assert netlink.ifindexes['veth1'] == 42
+        netlink.handle_link_event(link_event('RTM_DELLINK', 42, 'veth1'))
+        assert 'veth1' not in netlink.ifindexes
+
+    def test_addresses(self, netlink):
+        assert netlink.addresses(netlink.link_index('lo')) == \
+            {'127.0.0.1': 8}
+
+    def test_default_gateways(self, netlink):
+        assert netlink.default_gateways(netlink.link_index('lo')) == []
+
+
+class Netlink(netutils.NetlinkContext):
+    """Netlink context with the kernel state in memory."""
+
+    def __init__(self):
+        self.ipr = self
+        self.ifindexes = {'eth0': 2}
+        self.applied = dict()
+        self.kernel_addresses = dict()
+        self.kernel_gateways = []
+        self.calls = []
+
+    def poll_link_events(self):
+        pass
+
+    def addresses(self, index):
+        return dict(self.kernel_addresses)
+
+    def default_gateways(self, index):
+        return list(self.kernel_gateways)
+
+    def addr(self, command, index, address, mask):
+        self.calls.append(('addr', command, address))
+        if command == 'add':
+            self.kernel_addresses[address] = mask
+        else:
+            del self.kernel_addresses[address]
+
+    def route(self, command, dst, gateway, oif):
+        self.calls.append(('route', command, gateway))
+        if command == 'add':
+            self.kernel_gateways.append(gateway)
+        else:
+            self.kernel_gateways.remove(gateway)
+
+
+class Monitor(object):
+    """Netlink socket raising the errors given."""
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+
+    def recv(self, size):
+        if not self.errors:
+            raise AssertionError('recv after an error that is not ENOBUFS')
+        raise self.errors.pop(0)
+
+
+@pytest.mark.parametrize('errors', [
+    [OSError(errno.ENOBUFS, 'No buffer space available'), BlockingIOError()],
+    [OSError(errno.EBADF, 'Bad file descriptor')],
+])
+def test_poll_link_events_errors(errors):
+    nl = Netlink()
+    nl.monitor = Monitor(errors)
+    netutils.NetlinkContext.poll_link_events(nl)
+    assert nl.monitor.errors == []
+    assert nl.ifindexes == {}
+
+
+def test_set_net_changes(monkeypatch):
+    nl = Netlink()
+    dns = []
+    monkeypatch.setattr(netutils, 'netlink', nl)
+    monkeypatch.setattr(netutils, 'set_dns',
+                        lambda lease: dns.append(lease.views['name_server']))
+    lease = DHCPCAPLease(interface='eth0', address='192.168.1.23',
+                         subnet_mask_cidr='24', router='192.168.1.1',
+                         name_server='192.168.1.1')
+    netutils.set_net(lease)
+    assert nl.calls == [('addr', 'add', '192.168.1.23'),
+                        ('route', 'add', '192.168.1.1')]
+    assert dns == ['192.168.1.1']
+    # renewing with the same parameters does not change anything
+    del nl.calls[:]
+    netutils.set_net(lease)
+    assert nl.calls == []
+    assert dns == ['192.168.1.1']
+    # the configuration removed by others is set again
+    nl.kernel_gateways = []
+    netutils.set_net(lease)
+    assert nl.calls == [('route', 'add', '192.168.1.1')]
+    # the previous address and router are replaced
+    del nl.calls[:]
+    lease.address = '192.168.1.24'
+    lease.router = '192.168.1.254'
+    netutils.set_net(lease)
+    assert nl.calls == [('addr', 'del', '192.168.1.23'),
+                        ('addr', 'add', '192.168.1.24'),
+                        ('route', 'del', '192.168.1.1'),
+                        ('route', 'add', '192.168.1.254')]
+    assert dns == ['192.168.1.1']
+
+
+def test_dns_backend_cached(monkeypatch, tmpdir):
+    pytest.importorskip('dbus')
+    context = netutils.DNSContext()
+    statuses = []
+
+    def systemd_resolved_status():
+        statuses.append(False)
+        return False
+    monkeypatch.setattr(context, 'systemd_resolved_status',
+                        systemd_resolved_status)
+    monkeypatch.setattr(netutils, 'RESOLVCONF_ADMIN',
+                        str(tmpdir.join('resolvconf-admin')))
+    monkeypatch.setattr(netutils, 'RESOLVCONF',
+                        str(tmpdir.ensure('resolvconf')))
+    assert context.get_backend() == DNS_BACKEND_RESOLVCONF
+    assert context.get_backend() == DNS_BACKEND_RESOLVCONF
+    assert len(statuses) == 1
+    # a call to systemd-resolved failed
+    context.refresh()
+    assert context.get_backend() == DNS_BACKEND_RESOLVCONF
+    assert len(statuses) == 2
+
+
+class ResolvedManager(object):
+    """systemd-resolved manager, failing once the service restarted."""
+
+    def __init__(self, exception):
+        self.exception = exception
+        self.restarted = False
+        self.calls = []
+
+    def SetLinkDNS(self, index, iay):
+        if self.restarted:
+            raise self.exception('org.freedesktop.DBus.Error.NoReply')
+        self.calls.append((index, iay))
+
+
+def test_dns_resolved_restart(monkeypatch):
+    dbus = pytest.importorskip('dbus')
+    context = netutils.DNSContext()
+    managers = []
+
+    def get_resolved_manager():
+        if context.resolved_manager is None:
+            context.resolved_manager = ResolvedManager(dbus.DBusException)
+            managers.append(context.resolved_manager)
+        return context.resolved_manager
+    monkeypatch.setattr(context, 'get_resolved_manager', get_resolved_manager)
+    monkeypatch.setattr(context, 'systemd_resolved_status', lambda: True)
+    monkeypatch.setattr(netutils, 'dns', context)
+    monkeypatch.setattr(netutils, 'netlink', Netlink())
+    lease = DHCPCAPLease(interface='eth0', name_server='192.168.1.1')
+    assert netutils.set_dns(lease)
+    managers[0].restarted = True
+    # the manager of the restarted service is got again
+    assert netutils.set_dns(lease)
+    assert len(managers) == 2
+    assert managers[1].calls == [(2, [(2, [192, 168, 1, 1])])]
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Tests for the offer selection policies of the DHCP client implementation
+of the Anonymity Profile ([:rfc:`7844`])."""
+import socket
+import struct
+
+import attr
+import pytest
+
+from dhcpcanon.constants import DHCP_OPTION_LEASE_TIME, DHCP_OPTION_SERVER_ID
+from dhcpcanon.dhcpcappkt import parse_reply
+from dhcpcanon.offers import Offer, gen_offer_policy
+from dhcpcap_pkts import dhcp_offer
+
+REPLY = parse_reply(bytes(dhcp_offer))
+
+
+def gen_offer(server_id, lease_time, latency):
+    options = dict(REPLY.options)
+    options[DHCP_OPTION_SERVER_ID] = socket.inet_aton(server_id)
+    options[DHCP_OPTION_LEASE_TIME] = struct.pack('!I', lease_time)
+    return Offer(attr.evolve(REPLY, options=options), latency)
+
+
+OFFERS = [gen_offer('192.168.1.1', 3600, 0.2),
+          gen_offer('192.168.1.2', 86400, 0.1),
+          gen_offer('192.168.1.3', 7200, 0.3)]
+
+
+@pytest.mark.parametrize('name, kwargs, satisfied, selected', [
+    ('first', {}, [True, True, True], 0),
+    ('latency', {}, [False, False, False], 1),
+    ('latency', {'max_latency': 0.2}, [True, True, False], 1),
+    ('lease', {}, [False, False, False], 1),
+    ('lease', {'min_lease_time': 7200}, [False, True, True], 1),
+    ('server', {'server_ids': ['192.168.1.3', '192.168.1.2']},
+     [False, False, True], 2),
+    ('server', {'server_ids': ['192.168.1.4']}, [False, False, False], 0),
+])
+def test_policy(name, kwargs, satisfied, selected):
+    policy = gen_offer_policy(name, window=None, **kwargs)
+    assert [policy.satisfies(offer) for offer in OFFERS] == satisfied
+    assert policy.select(OFFERS) is OFFERS[selected]
+
+
+def test_policy_only_preferred():
+    policy = gen_offer_policy('server', server_ids=['192.168.1.2'],
+                              only_preferred=True)
+    assert [policy.acceptable(offer) for offer in OFFERS] == \
+        [False, True, False]
+
+
+def test_offer():
+    offer = Offer(REPLY)
+    assert offer.server_id == '192.168.1.1'
+    assert offer.lease_time == 43200
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Tests for the DHCP server stand-in."""
+import asyncio
+
+import pytest
+
+from dhcpcanon.constants import DHCPACK, DHCPNAK, DHCPOFFER, STATE_BOUND
+from dhcpcanon.dhcpcap import DHCPCAP
+from dhcpcanon.dhcpcapasync import DHCPCAPAsyncFSM
+from dhcpcanon.dhcpcaplease import DHCPCAPLease
+from dhcpcanon.dhcpcappkt import parse_reply
+from dhcpcanon.dhcpcapsock import LoopbackTransport
+from dhcpcanon.server import DHCPServer
+
+CLIENT_MAC = '00:01:02:03:04:05'
+
+
+def client(address='', server_id=''):
+    return DHCPCAP(iface='eth0', client_mac=CLIENT_MAC, xid=42,
+                   lease=DHCPCAPLease(address=address, server_id=server_id))
+
+
+def test_discover_request():
+    server = DHCPServer(lease_time=60, renewal_time=30)
+    [frame] = server.handle(client().gen_discover_raw())
+    offer = parse_reply(frame)
+    assert offer.message_type == DHCPOFFER
+    assert offer.xid == 42
+    assert offer.address == '192.168.1.100'
+    attrs = offer.options_attrs()
+    assert attrs['server_id'] == '192.168.1.1'
+    assert attrs['lease_time'] == '60'
+    assert attrs['renewal_time'] == '30'
+    assert 'rebinding_time' not in attrs
+    assert attrs['broadcast_address'] == '192.168.1.255'
+    [frame] = server.handle(client('192.168.1.100',
+                                   '192.168.1.1').gen_request_raw())
+    assert parse_reply(frame).message_type == DHCPACK
+    # an address not bound to the client is not acknowledged
+    [frame] = server.handle(client('192.168.1.101',
+                                   '192.168.1.1').gen_request_raw())
+    assert parse_reply(frame).message_type == DHCPNAK
+    # the request for another server releases the offered address
+    assert server.handle(client('192.168.1.100',
+                                '192.168.1.2').gen_request_raw()) == []
+    assert CLIENT_MAC not in server.bindings
+    assert server.stats == {'received discover': 1, 'received request': 3,
+                            'offer': 1, 'ack': 1, 'nak': 1}
+
+
+def test_faults():
+    server = DHCPServer(drop_rate=1)
+    assert server.handle(client().gen_discover_raw()) == []
+    assert server.stats['dropped'] == 1
+    server = DHCPServer(nak_rate=1)
+    server.handle(client().gen_discover_raw())
+    [frame] = server.handle(client('192.168.1.100',
+                                   '192.168.1.1').gen_request_raw())
+    assert parse_reply(frame).message_type == DHCPNAK
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_loopback(loop):
+    transport = LoopbackTransport()
+    server = DHCPServer(latency=0.01)
+    server.start([transport.peer])
+    fsm = DHCPCAPAsyncFSM(iface='lo', client_mac=CLIENT_MAC,
+                          scriptfile='/bin/true', loop=loop,
+                          transport=transport)
+    fsm.start()
+    try:
+        loop.run_until_complete(asyncio.wait_for(fsm.wait_bound(), 2))
+        assert fsm.current_state == STATE_BOUND
+        assert str(fsm.client.lease.address) == '192.168.1.100'
+    finally:
+        fsm.stop()
+        server.stop()
+        transport.close()
+    assert server.bindings == {CLIENT_MAC: '192.168.1.100'}
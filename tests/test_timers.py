@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:expandtab 2
+# SPDX-FileCopyrightText: 2016, juga <juga at riseup dot net>
+# SPDX-License-Identifier: MIT
+"""Tests for the timers of the DHCP client implementation of the Anonymity
+Profile ([:rfc:`7844`])."""
+import asyncio
+import logging
+
+import pytest
+
+from dhcpcanon import timers
+from dhcpcanon.constants import MIN_TIMERS_CANCELLED_COMPACT
+from dhcpcanon.timers import TimerHeap, gen_timeout_resend
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_timeout_debug_date_not_formatted(monkeypatch, caplog):
+    def future_dt_str(dt, td):
+        raise AssertionError('debug date formatted at INFO level')
+    monkeypatch.setattr(timers, 'future_dt_str', future_dt_str)
+    caplog.set_level(logging.INFO, logger=timers.__name__)
+    assert 3 <= gen_timeout_resend(1) <= 5
+
+
+class TestTimerHeap:
+    def test_order(self, loop):
+        heap = TimerHeap(loop)
+        called = []
+        for delay in (0.03, 0.01, 0.02, 0.01):
+            heap.call_later(delay, called.append, delay)
+        loop.run_until_complete(asyncio.sleep(0.05))
+        assert called == [0.01, 0.01, 0.02, 0.03]
+        assert len(heap) == 0
+        assert heap.handle is None
+
+    def test_cancel(self, loop):
+        heap = TimerHeap(loop)
+        called = []
+        first = heap.call_later(0.01, called.append, 'first')
+        heap.call_later(0.02, called.append, 'second')
+        third = heap.call_later(0.03, called.append, 'third')
+        third.cancel()
+        # cancelling the next deadline moves the loop timer to the next one
+        first.cancel()
+        assert heap.handle.when() == heap.heap[0][0]
+        assert len(heap) == 1
+        loop.run_until_complete(asyncio.sleep(0.05))
+        assert called == ['second']
+
+    def test_one_loop_timer(self, loop):
+        heap = TimerHeap(loop)
+        for delay in range(100, 0, -1):
+            heap.call_later(delay, lambda: None)
+        # only the earliest deadline is scheduled in the loop
+        assert len([handle for handle in loop._scheduled
+                    if not handle.cancelled()]) == 1
+        assert heap.handle.when() == pytest.approx(loop.time() + 1, abs=0.1)
+        heap.close()
+
+    def test_compact(self, loop):
+        heap = TimerHeap(loop)
+        n = MIN_TIMERS_CANCELLED_COMPACT * 4
+        timers = [heap.call_later(i + 1, lambda: None) for i in range(n)]
+        for timer in timers[1:]:
+            timer.cancel()
+        assert len(heap) == 1
+        assert len(heap.heap) <= MIN_TIMERS_CANCELLED_COMPACT * 2
+        heap.close()